@@ -1,34 +1,28 @@
-import serial
+import time
+STARTUP = [('start', time.perf_counter())] # (milestone, perf_counter) for --profile-startup
+
 import sys
 import glob
-import RPi.GPIO as IO
-import time
 import os
 from os import path
-import itertools
-import pandas as pd
-import pyowm
-import json
-import requests
-import thingspeak
-import socket
-from datetime import datetime
+import threading
+import argparse
+from alarm_store import ALARM_HEADERS, AlarmStore, read_snapshot, write_snapshot
+from hal import DigitalOutput, LOW, PWMGroup, PWMOutput, open_backend
+from history import TelemetryStore
+from lamp_control import get_weather_data, new_lamp, schedule_jobs, start_control, update_plan
+from light_filter import BrightnessControl, load_tuning
+import lamp_logging
+from lamp_logging import get_logger
+import metrics
+from scheduler import Scheduler
+from supervisor import StateFile, Supervisor, restore
+STARTUP.append(('imports', time.perf_counter()))
+
+# pyserial, requests and the network clients are imported by main() once the
+# PWM output is running, they are the slow part of a cold start on a Pi Zero
 
 
-class NoDataRead(Exception):
-    def __init__(self, data):
-        self.data = data
-        
-    def __str__(self):
-        return repr(self.data)
-    
-class MappingError(Exception):
-    def __init__(self, data):
-        self.data = data
-        
-    def __str__(self):
-        return repr(self.data)
-
 class InvalidTimeInput(Exception):
     def __init__(self, data):
         self.data = data
@@ -37,6 +31,10 @@ class InvalidTimeInput(Exception):
         return repr(self.data)
     
 
+log = get_logger('control')
+alarm_log = get_logger('alarms')
+
+
 def serial_ports():
     """ Lists serial port names
 
@@ -55,6 +53,8 @@ def serial_ports():
     else:
         raise EnvironmentError('Unsupported platform')
 
+    import serial
+
     result = []
     for port in ports:
         try:
@@ -66,81 +66,6 @@ def serial_ports():
     return result
 
 
-def voltage_serial(ports):
-    voltage_list = []
-    flag = 0
-    for port in ports:
-        try:
-            ser = serial.Serial(port, 9600, timeout=1)
-            ser.flush()
-            start_time = time.time()
-            while True:
-                if ser.in_waiting > 0:
-                    line = float(ser.readline().decode('utf-8').rstrip())
-                    #print(line, 'bits')
-                    voltage_list.append(line)
-                try:   
-                    if time.time() - start_time > 25:
-                        raise NoDataRead("Read time cannot take more 33 seconds")
-                except NoDataRead as e:
-                    print ("Received error:", e.data)
-                    break
-                
-                if len(voltage_list)>21:
-                    voltage_list= voltage_list[1:-1]
-                    flag = 1
-                    break
-            break
-        except OSError:
-            print("No serial connection with port = ", port)
-        
-    return voltage_list, flag
-
-def average(voltage_values):
-    try:
-        if len(voltage_values)==0:
-            raise NoDataRead("No data was read from the SPI")
-    except NoDataRead as e:
-        print ("Received error:", e.data)
-        voltage_values = voltage_serial(ports)
-        if len(voltage_values)==0:
-            print("Check connection to SPI device")
-            return
-    return int(sum(voltage_values)/len(voltage_values))
-
-
-def mapping(input_start, input_end, output_start, output_end, voltage):
-    output =  output_start + ((output_end - output_start) / (input_end - input_start)) * (voltage - input_start)
-    try:
-        if not (output_start<=output<=output_end):
-            raise MappingError("Mapped value is not within the desired range")
-    except NoDataRead as e:
-        print ("Received error:", e.data)
-        # Try again
-        output = mapping(input_start, input_end, output_start, output_end, voltage)
-        if not output_start<=output<=output_end:
-            print("Error in bounds")
-            return
-    return output
-
-def photoresistor_Range(value):
-    # Room Light is Minimum
-    if 0<=value<=33:
-        value = 100
-        print("Set Led to High")
-        
-    # Room Light is Medium
-    elif 33<value<=66:
-        value = 50
-        print("Set Led to Medium")
-        
-    # Room Light is Medium/High
-    elif 66<value<=100:
-        value = 0
-        print("Set Led to Off")
-        
-    return value
-
 def createAlarm():
     hour, min, day = 0,0,0
     local_time = time.localtime(time.time())
@@ -217,211 +142,60 @@ def createAlarm():
         if finished_flag=='1':
             return finished_flag
         
-def createDataFrame(alarm):
-    headers = ['Hour', 'Minute', 'Week_Day']
-    df = pd.DataFrame(alarm, columns = headers)
-    print(df)
-    return df
-
-def createCSV(df, path):
-    df.to_csv(path, sep=',', encoding='utf-8', index=False)
+def printAlarms(alarm):
+    print(' '.join('%8s' % h for h in ALARM_HEADERS))
+    for row in alarm:
+        print(' '.join('%8d' % v for v in row))
+
+def createCSV(alarm, path):
+    write_snapshot(path, alarm)
     return path
 
 def openCSV(path):
-    df = pd.read_csv(path, sep =',', usecols=['Week_Day', 'Hour','Minute'])
-    return df
-
-def convert_to_list(df):
-    return df.values.tolist()
-
-def checkDuplicates(list1):
-    flag = 0
-    list1.sort()
-    new_list = list(i for i,_ in itertools.groupby(list1))
-    if len(new_list) != len(list1):
-        flag=1
-        return new_list, flag
-    else:   
-        return new_list, flag
-
-def setup_weatherAPI():
-    json_data = 0
-    try:
-        api_key = 'b24f242112ab2a5b4cff7d50ae875dae'
-        owm = pyowm.OWM(api_key)
-        # Get Local IP Address Information
-        local_ip = 'https://extreme-ip-lookup.com/json/'
-        r = requests.get(local_ip)
-        data = json.loads(r.content.decode())
-        if owm.is_API_online():
-    # Get Weather based on latitude and longitud
-            api_call = 'http://api.openweathermap.org/data/2.5/weather?'+'lat='+str(float(data.get('lat'))) + \
-                '&lon=' +str(float(data.get('lon'))) + '&appid=' + api_key
-            #api_call = 'http://api.openweathermap.org/data/2.5/weather?'+'lat=36.246618' + \
-                #'&lon=-116.8169955' + '&appid=' + api_key
-            json_data = requests.get(api_call).json()
-
-        return json_data
-    except: 
-        print('Invalid API Key. Please try again!')
-
-def get_weather_data(data):
-    try:
-        if data['weather']:
-            weather_data = {}
-            try:
-                temperature = round(data['main']['feels_like']-273.15, 2)
-                weather_data['temperature'] = temperature
-            except KeyError as e:
-                weather_data['temperature'] = 'No data'
-                print('No data found for:', e)
-                pass
-                
-            try:
-                clouds = data['clouds']['all']
-                weather_data['clouds'] = clouds
-            except KeyError as e:
-                weather_data['clouds'] = "No data"
-                print('No data found for:', e)
-                pass
-            
-            try: 
-                description = data['weather'][0]['description']
-                weather_data['description'] = description
-            except KeyError as e:
-                weather_data['description'] = 'No data'
-                print('No data found for:', e)
-                pass
-            
-            try: 
-                rain= data['rain']['1h']
-                weather_data['rain'] = rain                
-            except KeyError as e:
-                weather_data['rain'] = 0
-                print('No data found for:', e) 
-                pass
-            
-            try: 
-                snow= data['snow']['1h']
-                weather_data['snow'] = snow                
-            except KeyError as e:
-                weather_data['snow'] = 0
-                print('No data found for:', e)                    
-                pass
-            
-            try: 
-                sunrise_time = [time.localtime(data['sys']['sunrise']).tm_hour,
-                                                   time.localtime(data['sys']['sunrise']).tm_min]
-                weather_data['sunrise'] = sunrise_time
-                                               
-            except KeyError as e:
-                print('No data found for:', e)
-                pass
-                
-            try: 
-                sunset_time = [time.localtime(data['sys']['sunset']).tm_hour,
-                                               time.localtime(data['sys']['sunset']).tm_min]
-                weather_data['sunset'] = sunset_time
-            
-            except KeyError as e:
-                print('No data found for:', e)
-                
-            return weather_data
-            
-    except KeyError:
-        print('No data found. Please try again later')
+    # Rows as [Hour, Minute, Week_Day] whatever the column order in the file
+    return read_snapshot(path)
+
+def print_startup():
+    print('Startup profile:')
+    for (_, previous), (label, t) in zip(STARTUP, STARTUP[1:]):
+        print('  %-16s %7.1f ms' % (label, (t - previous) * 1000))
+    print('  %-16s %7.1f ms' % ('total', (STARTUP[-1][1] - STARTUP[0][1]) * 1000))
+
+def main(clock=None, backend=None, profile_startup=False, protocol='ascii', baudrate=9600,
+         metrics_port=9108, interactive=True, api_port=8765, runtime='async', planning=False,
+         state_path=None, tuning_path=None, log_file=None, log_levels=None, zones_path=None,
+         adaptive_sampling=False, ports=None, run_for=None):
+    # Pass a scheduler.FakeClock to run the jobs without waiting on the real clock
+    # and backend='mock' to run without GPIO hardware. runtime='async' runs the
+    # jobs as asyncio tasks (runtime.py), 'threads' on the job scheduler.
+    # ports replaces the serial port scan, run_for returns after that many
+    # seconds (of the clock given) with the lamp state, for tests
+    if clock is not None:
+        runtime = 'threads' # asyncio sleeps on the real clock
+    # Log calls on the control path only queue the record, a writer thread
+    # writes the console and the JSON-lines file
+    lamp_logging.configure(log_file, log_levels)
+    STARTUP.append(('main', time.perf_counter()))
+    scheduler = Scheduler(clock)
 
-def sendData(channel, flag, val_int, *data):
-    try:
-        now = datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        print("Current Time =", current_time)
-        
-        if flag ==0:
-            val_int = round(val_int*5/1023, 2)
-            try:
-                response = channel.update({'field5':val_int})
-                print(response)
-                time.sleep(15)
-            except:
-                print("connection failed")
-                
-        else:
-            data = data[0]
-            print(data)
-            try:
-                if not isinstance(data['temperature'], str) and not isinstance(data['clouds'], str):
-                    val1 = data['temperature']
-                    val2 = data['clouds']
-                    val3 = data['rain']
-                    val4 = data['snow']
-                    val5 = round(val_int*5/1023,2)
-                    response = channel.update({'field1':val1,'field2':val2,
-                                               'field3':val3,
-                                                    'field4':val4,
-                                                       'field5':val5})
-                    print(response)                          
-                    time.sleep(15)
-                    
-                    
-                elif isinstance(data['temperature'], str) and not isinstance(data['clouds'], str):
-                    val2 = data['clouds']
-                    val3 = data['rain']
-                    val4 = data['snow']
-                    val5 = round(val_int*5/1023,2)
-                    response = channel.update({'field2':val2, 'field3':val3,
-                                                    'field4':val4,
-                                                       'field5':val5})
-                    print(response)
-                    time.sleep(15)
-                    
-                elif not isinstance(data['temperature'], str) and  isinstance(data['clouds'], str):
-                    val1 = data['temperature']
-                    val3 = data['rain']
-                    val4 = data['snow']
-                    val5 = round(val_int*5/1023,2)
-                    response = channel.update({'field1':val1, 'field3':val3,
-                                                    'field4':val4,
-                                                       'field5':val5})
-                    print(response)
-                    time.sleep(15)
-                else:
-                    val3 = data['rain']
-                    val4 = data['snow']
-                    val5 = round(val_int*5000/1023,2)
-                    response = channel.update({'field3':val3,'field4':val4,
-                                                       'field5':val5})
-
-                    print(response)
-                    time.sleep(15)
-            except:
-                print("connection failed")
-
-            
-    except KeyboardInterrupt:
-        print('Interrupted')
-                     
-        
-def main():
     # Variables
-    ph_voltage = []
-    ports = []
     average_voltage = 0
-    active_alarms = []
-    mapped_value = 0
-    dc_value = 0
     
     file = os.getcwd() +'/Alarms.csv'
-    userAlarms = []
-    existingDF = 0
-    alarmsDF = 0
-    all_data = {'clouds': [], 'sunset': [], 'sunrise': [], 'snow':[],
-                        'rain':[], 'temperature': [], 'description': [], 'photoresistor':[]}
+    history = TelemetryStore(os.getcwd() + '/history') # Bounded on-disk sample history
 
 
     # Arduino serial read bit bounds
     arduino_lb = 0
     arduino_ub = 500
+    # Bounds and thresholds found by tuning.py replace the defaults
+    tuning = load_tuning(tuning_path or os.getcwd() + '/lamp_config.json')
+    arduino_lb = tuning.get('arduino_lb', arduino_lb)
+    arduino_ub = tuning.get('arduino_ub', arduino_ub)
+    brightness = BrightnessControl(arduino_lb, arduino_ub, **{key: tuning[key] for key in
+                                                           ('low', 'high', 'deadband') if key in tuning})
+    if tuning:
+        log.info('Tuning: %s', tuning)
 
     # Dutty Cycle bounds
     dc_lb = 0
@@ -435,205 +209,205 @@ def main():
     time_struct = 0
     light_flag = 0
     active_flag=0
-    print_flag = 0
     dupli_flag=0
-    send_flag = 0
-    read_flag = 0
-    photo_flag = 0
-    weather_flag = 0
     
     # Initialize PWM
-    IO.setwarnings(False)
-    IO.setmode(IO.BOARD)
-    IO.setup(12, IO.OUT)
-    pwm = IO.PWM(12,1000)
-    pwm.start(0)
+    # Outputs only touch the pins when a value changes. After a crash the
+    # lamp comes back at the brightness it had
+    state = StateFile(state_path or os.getcwd() + '/lamp_state.json')
+    last_state = state.load()
+    gpio = open_backend(backend)
+    if zones_path:
+        # One output per zone, alarms and the night switch them together
+        from zones import ZoneSet, load_zones
+        zone_config = load_zones(zones_path)
+        channels = zone_config['channels']
+        pwm = PWMGroup(PWMOutput(gpio, zone['pwm_pin'], 1000, duty=last_state.get('duty', 0))
+                       for zone in zone_config['zones'])
+    else:
+        zone_config, channels = None, 1
+        pwm = PWMOutput(gpio, pwm_pin, 1000, duty=last_state.get('duty', 0))
 
     # Initialize Temperature LEDS
-    leds = [38,40]
-    IO.setup(leds, IO.OUT, initial=IO.LOW)
+    leds = DigitalOutput(gpio, [38,40], initial=LOW)
+    STARTUP.append(('gpio', time.perf_counter()))
+
+    import requests
+    from firmware import AdaptiveSampling
+    from serial_reader import SerialReader
+    from uploader import ThingSpeakUploader
+    from weather import WeatherProvider
+    STARTUP.append(('network imports', time.perf_counter()))
+
+    # Keep one serial port open in the background instead of rescanning every read
+    # The sketch reads fast while the light changes and averages more when
+    # it is steady, told so over the serial line (text protocols only)
+    ports = serial_ports if ports is None else ports
+    reader = SerialReader(ports, baudrate, protocol=protocol, channels=channels,
+                          sampling=AdaptiveSampling() if adaptive_sampling else None)
+    reader.start()
 
     # Thingspeak API Key
     channel_id = '1054814'
     write_key  = 'EXCRCT30P24J5EYR'
-    channel = thingspeak.Channel(id=channel_id,api_key=write_key)
+    session = requests.Session() # One connection pool for every HTTP client
+    uploader = ThingSpeakUploader(channel_id, write_key, journal=os.getcwd() + '/ThingSpeak_Journal.jsonl',
+                                  session=session, queue_size=1024)
+    if runtime == 'threads':
+        uploader.start() # The asyncio runtime flushes from its upload task
+
+    # Weather API, the cached answer on disk is used until the first job runs
+    # A daylight plan only needs the clouds refreshed every few hours
+    weather = WeatherProvider('b24f242112ab2a5b4cff7d50ae875dae', os.getcwd(), session=session,
+                              ttl=3*3600 if planning else 600)
+    STARTUP.append(('clients', time.perf_counter()))
+    if profile_startup:
+        print_startup()
+        reader.stop()
+        uploader.stop()
+        gpio.cleanup()
+        return
 
-    # Weather API
-    data = setup_weatherAPI()
-    
     # Initialize Alarms 
+    # Alarms.csv is the snapshot, edits are appended to Alarms.log and picked
+    # up while running, the csv is only rewritten when the log is compacted
     if path.exists(file):
-        print('File Exists!')
-        existingDF = openCSV(file)
-        print(existingDF)
-        userAlarms = convert_to_list(existingDF)
+        alarm_log.info('File Exists!')
+    else:
+        alarm_log.info('File Not Found!')
+    alarms = AlarmStore(file)
+    printAlarms(alarms.rows())
 
+    if interactive:
         print('Create Alarms......')
         while True:
             try:
                 time_struct = createAlarm()
-                userAlarms.append([time_struct.tm_hour, time_struct.tm_min, time_struct.tm_wday])
-                userAlarms, dupli_flag = checkDuplicates(userAlarms)
-                if dupli_flag==1:
+                if not alarms.add(time_struct.tm_hour, time_struct.tm_min, time_struct.tm_wday):
                     print('Duplicate found. Alarm Deleted!')
-                print("Available Alarms: ", userAlarms)              
+                print("Available Alarms: ", alarms.rows())
             except KeyboardInterrupt:
                 break
             except AttributeError:
                 if time_struct=='1':
                     break
-    else:
-        print('File Not Found!')
-        print('Create Alarms......')
-        while True:
-            try:
-                time_struct = createAlarm()
-                userAlarms.append([time_struct.tm_hour, time_struct.tm_min, time_struct.tm_wday])
-                userAlarms, dupli_flag = checkDuplicates(userAlarms)
-                if dupli_flag==1:
-                    print('Duplicate found. Alarm Deleted!')
-                print("Available Alarms: ", userAlarms)
-                
-            except KeyboardInterrupt:
-                break
-            except AttributeError:
-                if time_struct=='1':
-                    break
-    try:    
-        alarmsDF = createDataFrame(userAlarms)
-        createCSV(alarmsDF, file)
-        active_alarms = []
-    except ValueError:
-        print('No Active Alarms In File!')
-        
-    
-    print('Start Lamp Brightness Control')
-    while True:
-        if len(userAlarms)!=0:
-            for alarm in userAlarms:
-                if (alarm[0]>=(time.localtime().tm_hour) and alarm[1]>(time.localtime().tm_min)):
-                    active_alarms.append(alarm)
-                    active_alarms, dupli_flag = checkDuplicates(active_alarms)
-                    
-                    
-            
-            try:
-                if active_flag==1 or ((time.localtime().tm_hour==active_alarms[0][0]) and (time.localtime().tm_min==active_alarms[0][1]) and (0<time.localtime().tm_sec<=5)):
-
-                    if time.localtime().tm_min==1 and active_alarms[0][1]+10==60:
-                        print("Alarm Deactivated At Hour:", time.localtime().tm_hour, ' Min:', time.localtime().tm_min)
-                        light_flag=0
-                        active_flag=0
-                        print_flag=0
-                        active_alarms.remove(active_alarms[0])
-                        
-                    elif time.localtime().tm_min<=active_alarms[0][1]+10:
-                        if print_flag==0:
-                            print_flag=1
-                            active_flag=1
-                            light_flag = 1
-                            print('Lights On!')
-                            print("Activate Alarm Hour:", time.localtime().tm_hour, ' Min:', time.localtime().tm_min, ' Stay Active for 10 Min')
-                            print(active_alarms)
-                            pwm.ChangeDutyCycle(100)
-       
-                    else:
-                        print("Alarm Deactivated At Hour:", time.localtime().tm_hour, ' Min:', time.localtime().tm_min)
-                        light_flag=0
-                        active_flag=0
-                        print_flag=0
-                        active_alarms.remove(active_alarms[0])
-                
-            except IndexError:
-                pass
-                
-           
-        if ((time.localtime().tm_min % 3 == 0) and (time.localtime().tm_min !=30)) and (0<=time.localtime().tm_sec<=1) and photo_flag == 1: # Open serial port every 3 min
-            time.sleep(1)
-            photo_flag=0
-            
-            print("Reading Photoresistor")
-            while True:
-                    ports = serial_ports() # Detect USB Serial Ports
-                    ph_voltage, read_flag = voltage_serial(ports) # Read arduino data
-                    
-                    if read_flag == 1:
-                        # Flag to verify that data was read from arduino
-                        average_voltage = average(ph_voltage) # Average the read values
-                        send_flag =0
-                        sendData(channel, send_flag, average_voltage)
-                        all_data.setdefault('photoresistor',[]).append(round(average_voltage*5/1023,2))
-                        mapped_value = mapping(arduino_lb, arduino_ub, dc_lb, dc_up, average_voltage) # Map the values to the desiered range
-                        dc_value = photoresistor_Range(mapped_value) # Set mapped value to the correspoding range for dutty cycle
-                        
-
-                        # PWM Of LED
-                        if light_flag==0 and (not time.localtime().tm_hour==23 and not 0<=time.localtime().tm_hour<6):
-                            print("Led Brightness Modulation")
-                            pwm.ChangeDutyCycle(dc_value)
-                
-                        elif time.localtime().tm_hour==23 or 0<=time.localtime().tm_hour<6:
-                            
-                            print("Lights Off")
-                            pwm.ChangeDutyCycle(0)
-                            
-                    print('Waiting.....')
-                    break
-                
-                
-        val = time.localtime().tm_min/10
-        if ((time.localtime().tm_min==18) or (time.localtime().tm_min==48) and (30<=time.localtime().tm_sec<31)) or (
-                int(str(val)[2]) == 8 and 0 <= time.localtime().tm_sec < 1) and weather_flag==1: # Get weather data from openweather API every modulo 7
-            weather_flag=0
-            print('Get Weather Data!!!!')
-            time.sleep(1)
-            json_data = setup_weatherAPI()
-            weather_data = get_weather_data(json_data)
-
-            if weather_data['temperature']<=10:
-                print('Temperature Very Cold')
-                IO.output(leds, [IO.LOW, IO.HIGH])
-
-            if 10<weather_data['temperature']<=20:
-                print('Temperature Cold')
-                IO.output(leds, [IO.HIGH, IO.LOW])
-
-            if 20<weather_data['temperature']<=30:
-                print('Temperature Mild')
-                IO.output(leds, [IO.LOW, IO.HIGH])
-
-            if weather_data['temperature']>30:
-                print('Temperature Hot')
-                IO.output(leds, IO.HIGH)
-
-            send_flag=1
-            sendData(channel, send_flag, average_voltage, weather_data)
-            
-            for key in weather_data:
-                all_data.setdefault(key,[]).append(weather_data[key])
-            
-
-        if (time.localtime().tm_min + 1) % 3 ==0 and time.localtime().tm_sec==50:
-            if time.localtime().tm_min+1==48 or time.localtime().tm_min+1== 18:
-                weather_flag = 1
-                print('Weather Flag: ', weather_flag)
-            
-            photo_flag = 1
-            print('Photo Flag: ', photo_flag)
-            time.sleep(1)
-
-        if (int(str(val)[2]) + 1) == 8 and time.localtime().tm_sec==50:
-            weather_flag=1
-            print('Weather Flag: ', weather_flag)
-            time.sleep(1)
+    if len(alarms)==0:
+        alarm_log.info('No Active Alarms In File!')
+    alarms.compact()
+    printAlarms(alarms.rows())
+
+
+    if metrics_port:
+        # Prometheus scrapes http://127.0.0.1:<port>/metrics
+        metrics.start_server(metrics_port)
+    if api_port:
+        # Bulk alarm edits while running, see alarm_api.py for the cli
+        import alarm_api
+        alarm_api.start_server(alarms, api_port, localtime=scheduler.clock.localtime)
+
+    log.info('Start Lamp Brightness Control')
+    lamp = new_lamp(reader=reader, clock=scheduler.clock, pwm=pwm, leds=leds,
+                    uploader=uploader, weather=weather, alarms=alarms,
+                    history=history, average_voltage=average_voltage,
+                    light_flag=light_flag, active_flag=active_flag,
+                    arduino_lb=arduino_lb, arduino_ub=arduino_ub, dc_lb=dc_lb, dc_up=dc_up,
+                    planning=planning, brightness=brightness,
+                    zones=ZoneSet(zone_config, pwm.outputs, brightness) if zone_config else None)
+    if planning and weather.cached() is not None:
+        # Plan from the weather on disk until the first weather job
+        update_plan(lamp, get_weather_data(weather.cached()))
+    restore(lamp, last_state)
+
+    def start_reader():
+        reader = SerialReader(ports, baudrate, protocol=protocol,
+                              listener=lamp['reader'].listener, channels=channels,
+                              sampling=AdaptiveSampling() if adaptive_sampling else None)
+        reader.start()
+        lamp['reader'] = reader
+        lamp['samples_seen'] = 0
+        return reader
+
+    def start_uploader():
+        # Journals what the dead one held, a hung one no longer writes the journal
+        lamp['uploader'].stop(timeout=1)
+        uploader = ThingSpeakUploader(channel_id, write_key, journal=os.getcwd() + '/ThingSpeak_Journal.jsonl',
+                                      session=session, queue_size=1024)
+        uploader.start()
+        lamp['uploader'] = uploader
+        return uploader
+
+    # Sensor, uploads and the jobs are restarted on their own when they die
+    # or hang, the state is saved every second
+    supervisor = Supervisor(lamp, state)
+    timer = None
+    try:
+        if clock is not None:
+            schedule_jobs(scheduler, lamp)
+            scheduler.run(until=None if run_for is None else scheduler.clock.monotonic() + run_for)
+        else:
+            if run_for is not None:
+                timer = threading.Timer(run_for, supervisor.stop)
+                timer.daemon = True
+                timer.start()
+            supervisor.add('serial', start_reader, heartbeat=lambda: lamp['reader'].heartbeat,
+                           timeout=10, handle=reader)
+            if runtime == 'threads':
+                supervisor.add('uploader', start_uploader, handle=uploader)
+            supervisor.add('control', lambda: start_control(lamp, runtime),
+                           heartbeat=lambda: lamp['heartbeat'],
+                           timeout=max(30, 3*lamp['adjust_interval']))
+            supervisor.run()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        supervisor.stop()
+        # Journal readings that were not uploaded yet so they survive a restart
+        lamp['uploader'].stop(timeout=5)
+        lamp['reader'].stop(timeout=2)
+        history.flush()
+        gpio.cleanup()
+        lamp_logging.shutdown() # Write what is queued, a returning main() leaves no writer behind
+    return lamp
 
-        
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Smart lamp brightness control')
+    parser.add_argument('--backend', choices=['rpi', 'lgpio', 'mock'],
+                        help='GPIO library, detected when left out')
+    parser.add_argument('--protocol', choices=['ascii', 'binary', 'auto'], default='ascii',
+                        help='serial format of photoresistor.ino (binary needs BINARY_FRAMES 1)')
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--metrics-port', type=int, default=9108,
+                        help='local port of the /metrics endpoint, 0 disables it')
+    parser.add_argument('--api-port', type=int, default=8765,
+                        help='local port of the alarm HTTP API, 0 disables it')
+    parser.add_argument('--runtime', choices=['async', 'threads'], default='async',
+                        help='asyncio tasks, or the job scheduler thread')
+    parser.add_argument('--plan', action='store_true',
+                        help='follow a daylight plan from sun times and clouds, sampling the sensor every 5 min')
+    parser.add_argument('--state', help='last known state, default lamp_state.json')
+    parser.add_argument('--tuning', help='tuning.py output, default lamp_config.json')
+    parser.add_argument('--zones', help='json of sensor zones and their PWM pins, for a CHANNELS > 1 sketch')
+    parser.add_argument('--adaptive-sampling', action='store_true',
+                        help='let the sketch oversample less while the light changes (firmware 2, text protocol)')
+    parser.add_argument('--log-file', help='JSON-lines log, rotated at 1 MB')
+    parser.add_argument('--log-level', type=lamp_logging.parse_levels, default='info',
+                        help='e.g. info,weather=debug,serial=warning')
+    parser.add_argument('--no-prompt', action='store_true',
+                        help='start with the stored alarms without asking for new ones')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print import and initialization times, then exit')
+    args = parser.parse_args()
+    if args.adaptive_sampling and args.protocol == 'binary':
+        parser.error('--adaptive-sampling needs the text replies of firmware 2, use --protocol ascii or auto')
     try:
-        main()
+        main(backend=args.backend, profile_startup=args.profile_startup,
+             protocol=args.protocol, baudrate=args.baudrate, metrics_port=args.metrics_port,
+             interactive=not args.no_prompt, api_port=args.api_port, runtime=args.runtime,
+             planning=args.plan, state_path=args.state,
+             tuning_path=args.tuning, log_file=args.log_file, log_levels=args.log_level,
+             zones_path=args.zones, adaptive_sampling=args.adaptive_sampling)
     except KeyboardInterrupt:
         print('Exit Program')
-        IO.cleanup()
         try:
             sys.exit(0)
         except SystemExit:
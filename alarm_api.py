@@ -0,0 +1,321 @@
+import argparse
+import csv
+import io
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from alarm_schedule import InvalidAlarm
+from alarm_store import ALARM_HEADERS, AlarmStore
+
+DAYS = {'daily': range(7), 'weekdays': range(5), 'weekends': (5, 6)}
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# ?count of /alarms/next is clamped to this range
+MAX_NEXT = 1000
+
+
+class RuleError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def _clock(value):
+    try:
+        hour, minute = (int(v) for v in str(value).split(':'))
+    except ValueError:
+        raise RuleError("Time %r is not HH:MM" % (value,))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise RuleError("Time %r is out of range" % (value,))
+    return hour * 60 + minute
+
+
+def _days(value):
+    if isinstance(value, str):
+        if value in DAYS:
+            return list(DAYS[value])
+        value = value.split(',')
+    days = []
+    for day in value:
+        if isinstance(day, str) and day[:3].lower() in DAY_NAMES:
+            day = DAY_NAMES.index(day[:3].lower())
+        if not isinstance(day, int) and not str(day).isdigit() or not 0 <= int(day) < 7:
+            raise RuleError("Day %r is not 0-6 or mon-sun" % (day,))
+        days.append(int(day))
+    return days
+
+
+def expand_rule(rule):
+    """ [hour, minute, week_day] rows of one recurring rule.
+
+        {'at': '07:30', 'days': 'weekdays'} fires once a day,
+        {'every': 20, 'start': '18:00', 'end': '22:00', 'days': 'daily'}
+        every 20 minutes from start up to and including end. ``days`` is
+        daily (default), weekdays, weekends or a list such as [0, 2] or
+        'mon,wed'.
+    """
+    days = _days(rule.get('days', 'daily'))
+    if 'every' in rule:
+        every = int(rule['every'])
+        if every <= 0:
+            raise RuleError("'every' must be a positive number of minutes")
+        start = _clock(rule.get('start', '00:00'))
+        end = _clock(rule.get('end', '23:59'))
+        minutes = range(start, end + 1, every)
+    elif 'at' in rule:
+        minutes = [_clock(rule['at'])]
+    else:
+        raise RuleError("Rule %r needs 'at' or 'every'" % (rule,))
+    return [[m // 60, m % 60, day] for day in days for m in minutes]
+
+
+def expand(body):
+    """ Rows from an API body: {'alarms': [[h, m, d], ...], 'rules': [...]} """
+    rows = [list(row) for row in body.get('alarms', ())]
+    for rule in body.get('rules', ()):
+        if not isinstance(rule, dict):
+            raise RuleError('Rule %r is not an object' % (rule,))
+        rows.extend(expand_rule(rule))
+    return rows
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(ALARM_HEADERS)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def from_csv(text):
+    return [[int(row[h]) for h in ALARM_HEADERS] for row in csv.DictReader(io.StringIO(text))]
+
+
+def firings(store, now, count):
+    return [{'in_minutes': minutes, 'hour': row[0], 'minute': row[1], 'week_day': row[2]}
+            for minutes, row in store.upcoming(now, count)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ JSON control API of one AlarmStore.
+
+        GET    /alarms            all alarms (?format=csv for Alarms.csv)
+        GET    /alarms/next       next firings (?count=10, 1 to MAX_NEXT)
+        POST   /alarms            add alarms and rules, csv bodies are accepted
+        PUT    /alarms            replace every alarm
+        DELETE /alarms            remove the alarms and rules in the body
+    """
+    store = None
+    localtime = staticmethod(time.localtime)
+
+    def _reply(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        text = self.rfile.read(length).decode('utf-8')
+        if 'csv' in (self.headers.get('Content-Type') or ''):
+            return from_csv(text)
+        body = json.loads(text or '{}')
+        if not isinstance(body, dict):
+            raise ValueError('Body must be a JSON object with alarms or rules')
+        return expand(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/alarms':
+            rows = self.store.rows()
+            if query.get('format') == ['csv']:
+                self._reply(200, to_csv(rows), 'text/csv')
+            else:
+                self._reply(200, {'alarms': rows})
+        elif url.path == '/alarms/next':
+            try:
+                count = int(query.get('count', ['10'])[0])
+            except ValueError:
+                self._reply(400, {'error': 'count must be an integer'})
+                return
+            count = min(max(count, 1), MAX_NEXT)
+            self._reply(200, {'next': firings(self.store, self.localtime(), count)})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def _change(self, method):
+        if urlsplit(self.path).path != '/alarms':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            rows = self._body()
+            if method == 'PUT':
+                self.store.replace(rows)
+                result = {'alarms': len(self.store)}
+            elif method == 'POST':
+                added, _ = self.store.update(add=rows)
+                result = {'added': added, 'alarms': len(self.store)}
+            else:
+                _, removed = self.store.update(remove=rows)
+                result = {'removed': removed, 'alarms': len(self.store)}
+        except (ValueError, KeyError, TypeError, InvalidAlarm, RuleError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(200, result)
+
+    def do_POST(self):
+        self._change('POST')
+
+    def do_PUT(self):
+        self._change('PUT')
+
+    def do_DELETE(self):
+        self._change('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(store, port=8765, host='127.0.0.1', localtime=time.localtime):
+    """ Serve the alarm API from a daemon thread, returns the server.
+
+        Changes go straight to ``store``, the running lamp sees them on its
+        next alarm check.
+    """
+    handler = type('Handler', (_Handler,), {'store': store, 'localtime': staticmethod(localtime)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='alarm-api', daemon=True).start()
+    return server
+
+
+def load_test(alarms=5000, clients=8, requests_per_client=200):
+    """ Bulk import over HTTP, then concurrent next-firing queries """
+    import random
+    import tempfile
+    from http.client import HTTPConnection
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = AlarmStore(os.path.join(tmp, 'Alarms.csv'))
+        server = start_server(store, port=0)
+        port = server.server_address[1]
+        rows = [[random.randrange(24), random.randrange(60), random.randrange(7)]
+                for _ in range(alarms)]
+
+        conn = HTTPConnection('127.0.0.1', port)
+        start = time.perf_counter()
+        conn.request('POST', '/alarms', json.dumps({'alarms': rows}),
+                      {'Content-Type': 'application/json'})
+        added = json.loads(conn.getresponse().read())['added']
+        print('import   %d alarms (%d unique) in %.1f ms'
+              % (alarms, added, (time.perf_counter() - start) * 1000))
+
+        start = time.perf_counter()
+        conn.request('POST', '/alarms', json.dumps(
+            {'rules': [{'every': 5, 'start': '18:00', 'end': '22:00', 'days': 'weekdays'}]}))
+        conn.getresponse().read()
+        print('rule     one every-5-min rule in %.1f ms' % ((time.perf_counter() - start) * 1000))
+        conn.close()
+
+        latencies = []
+        lock = threading.Lock()
+
+        def client():
+            c = HTTPConnection('127.0.0.1', port)
+            mine = []
+            for i in range(requests_per_client):
+                t = time.perf_counter()
+                if i % 10 == 0:
+                    c.request('POST', '/alarms', json.dumps({'alarms': [random.choice(rows)]}))
+                else:
+                    c.request('GET', '/alarms/next?count=5')
+                c.getresponse().read()
+                mine.append(time.perf_counter() - t)
+            c.close()
+            with lock:
+                latencies.extend(mine)
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print('queries  %d requests from %d clients, %.0f req/s, p50 %.2f ms, p99 %.2f ms'
+              % (len(latencies), clients, len(latencies) / elapsed,
+                 latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+        server.shutdown()
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage smart lamp alarms without the prompts')
+    parser.add_argument('--file', default=os.path.join(os.getcwd(), 'Alarms.csv'),
+                        help='alarm snapshot, the running lamp reloads it on its own')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='print all alarms as csv')
+    add = sub.add_parser('add', help='add alarms HH:MM:DAY and rules')
+    remove = sub.add_parser('remove', help='remove alarms HH:MM:DAY and rules')
+    for p in (add, remove):
+        p.add_argument('alarms', nargs='*', help='e.g. 07:30:0 for Monday 7:30')
+        p.add_argument('--at', help='HH:MM, for the --days given')
+        p.add_argument('--every', type=int, help='minutes between alarms from --start to --end')
+        p.add_argument('--start', default='00:00')
+        p.add_argument('--end', default='23:59')
+        p.add_argument('--days', default='daily', help='daily, weekdays, weekends or mon,wed,...')
+    imp = sub.add_parser('import', help='add alarms from a csv or json file')
+    imp.add_argument('path')
+    imp.add_argument('--replace', action='store_true', help='drop the alarms not in the file')
+    sub.add_parser('export', help='write the alarms as csv to stdout')
+    nxt = sub.add_parser('next', help='next firings from now')
+    nxt.add_argument('--count', type=int, default=10)
+    load = sub.add_parser('load-test', help='benchmark the HTTP API on a temporary store')
+    load.add_argument('--alarms', type=int, default=5000)
+    load.add_argument('--clients', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.command == 'load-test':
+        load_test(args.alarms, args.clients)
+        return
+    store = AlarmStore(args.file)
+    if args.command in ('list', 'export'):
+        print(to_csv(store.rows()), end='')
+    elif args.command == 'next':
+        for firing in firings(store, time.localtime(), args.count):
+            print('in %(in_minutes)5d min  %(hour)02d:%(minute)02d  day %(week_day)d' % firing)
+    elif args.command == 'import':
+        with open(args.path, encoding='utf-8') as f:
+            text = f.read()
+        rows = expand(json.loads(text)) if args.path.endswith('.json') else from_csv(text)
+        if args.replace:
+            store.replace(rows)
+        else:
+            print('added', store.update(add=rows)[0])
+    else:
+        rows = [[int(v) for v in alarm.split(':')] for alarm in args.alarms]
+        if args.at or args.every:
+            rule = {'days': args.days}
+            rule.update({'every': args.every, 'start': args.start, 'end': args.end}
+                        if args.every else {'at': args.at})
+            rows.extend(expand_rule(rule))
+        if args.command == 'add':
+            print('added', store.update(add=rows)[0])
+        else:
+            print('removed', store.update(remove=rows)[1])
+
+
+if __name__ == '__main__':
+    main()
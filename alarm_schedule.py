@@ -0,0 +1,151 @@
+import bisect
+import time
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+class InvalidAlarm(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def minute_of_week(t):
+    """ Minutes since Monday 00:00 for a struct_time or an [hour, minute, week_day] row """
+    if isinstance(t, time.struct_time):
+        return t.tm_wday * MINUTES_PER_DAY + t.tm_hour * 60 + t.tm_min
+    hour, minute, day = t
+    return int(day) * MINUTES_PER_DAY + int(hour) * 60 + int(minute)
+
+
+def to_row(key):
+    """ Inverse of minute_of_week, returns [hour, minute, week_day] """
+    day, rest = divmod(key, MINUTES_PER_DAY)
+    return [rest // 60, rest % 60, day]
+
+
+class AlarmSchedule:
+    """ Weekly alarms compiled into a sorted minute-of-week index.
+
+        Rows use the Alarms.csv layout [Hour, Minute, Week_Day] with Monday
+        being 0. Lookups are bisects on the index and the active window
+        wraps across hour, day and week boundaries.
+
+        :param rows: iterable of [hour, minute, week_day]
+        :param duration: minutes an alarm keeps the lamp on
+    """
+
+    def __init__(self, rows=(), duration=10):
+        self.duration = duration
+        self._keys = sorted({minute_of_week(self._validate(row)) for row in rows})
+        self._members = set(self._keys)
+
+    @staticmethod
+    def _validate(row):
+        hour, minute, day = (int(v) for v in row)
+        if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= day < 7):
+            raise InvalidAlarm("Alarm %r is not a valid [hour, minute, week_day]" % (list(row),))
+        return hour, minute, day
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, row):
+        try:
+            row = self._validate(row)
+        except (InvalidAlarm, ValueError):
+            return False # [0, 90, 0] would otherwise be found as [1, 30, 0]
+        return minute_of_week(row) in self._members
+
+    def add(self, hour, minute, day):
+        """ Insert an alarm, returns False if it already exists """
+        key = minute_of_week(self._validate((hour, minute, day)))
+        if key in self._members:
+            return False
+        bisect.insort(self._keys, key)
+        self._members.add(key)
+        return True
+
+    def remove(self, hour, minute, day):
+        """ Delete an alarm, returns False if it did not exist """
+        key = minute_of_week(self._validate((hour, minute, day)))
+        if key not in self._members:
+            return False
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self._members.discard(key)
+        return True
+
+    def rows(self):
+        """ All alarms as [hour, minute, week_day] rows, ordered by week time """
+        return [to_row(key) for key in self._keys]
+
+    def day(self, week_day):
+        """ Alarms of one week day as [hour, minute, week_day] rows """
+        lo = bisect.bisect_left(self._keys, week_day * MINUTES_PER_DAY)
+        hi = bisect.bisect_left(self._keys, (week_day + 1) * MINUTES_PER_DAY)
+        return [to_row(key) for key in self._keys[lo:hi]]
+
+    def next_after(self, t):
+        """ First alarm strictly after ``t`` (struct_time or minute of week).
+
+            Returns (minutes_until, [hour, minute, week_day]) or None when
+            there are no alarms. Wraps around to next week.
+        """
+        if not self._keys:
+            return None
+        now = t if isinstance(t, int) else minute_of_week(t)
+        i = bisect.bisect_right(self._keys, now)
+        key = self._keys[i] if i < len(self._keys) else self._keys[0]
+        return (key - now) % MINUTES_PER_WEEK or MINUTES_PER_WEEK, to_row(key)
+
+    def upcoming(self, t, count=10):
+        """ Next ``count`` firings strictly after ``t``, as next_after() pairs.
+
+            Each alarm fires once a week, so at most len(self) are returned.
+        """
+        if not self._keys:
+            return []
+        now = t if isinstance(t, int) else minute_of_week(t)
+        i = bisect.bisect_right(self._keys, now)
+        keys = self._keys[i:i + count]
+        if len(keys) < count:
+            keys += self._keys[:min(i, count - len(keys))]
+        return [((key - now) % MINUTES_PER_WEEK or MINUTES_PER_WEEK, to_row(key)) for key in keys]
+
+    def active(self, t):
+        """ Alarm whose window contains ``t``, None if the lamp should not be on """
+        if not self._keys:
+            return None
+        now = t if isinstance(t, int) else minute_of_week(t)
+        # Latest alarm at or before now, the last one of the week wraps to Monday
+        key = self._keys[bisect.bisect_right(self._keys, now) - 1]
+        if (now - key) % MINUTES_PER_WEEK < self.duration:
+            return to_row(key)
+        return None
+
+
+if __name__ == '__main__':
+    # Benchmark with 10k alarms: compile, lookups and incremental edits
+    import random
+    import timeit
+
+    random.seed(0)
+    rows = [[random.randrange(24), random.randrange(60), random.randrange(7)] for _ in range(10000)]
+    print('compile  %.2f ms' % (timeit.timeit(lambda: AlarmSchedule(rows), number=10) * 100))
+    schedule = AlarmSchedule(rows)
+    print('alarms   %d unique' % len(schedule))
+    probes = [random.randrange(MINUTES_PER_WEEK) for _ in range(1000)]
+    n = 100
+    for name, func in (('active', schedule.active), ('next', schedule.next_after)):
+        total = timeit.timeit(lambda: [func(p) for p in probes], number=n)
+        print('%-8s %.2f us/call' % (name, total / (n * len(probes)) * 1e6))
+
+    def edit():
+        for row in rows[:1000]:
+            schedule.remove(*row)
+        for row in rows[:1000]:
+            schedule.add(*row)
+    print('add+rm   %.2f us/pair' % (timeit.timeit(edit, number=10) / 10000 * 1e6))
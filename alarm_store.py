@@ -0,0 +1,235 @@
+import contextlib
+import csv
+import fcntl
+import os
+import threading
+
+from alarm_schedule import AlarmSchedule, InvalidAlarm
+from lamp_logging import get_logger
+
+log = get_logger('alarms')
+
+ALARM_HEADERS = ['Hour', 'Minute', 'Week_Day']
+
+
+def read_snapshot(path):
+    """ [Hour, Minute, Week_Day] rows of an Alarms.csv, whatever its column order """
+    with open(path, newline='', encoding='utf-8') as f:
+        return [[int(row[h]) for h in ALARM_HEADERS] for row in csv.DictReader(f)]
+
+
+def write_snapshot(path, rows):
+    # Written to a temporary file first so a power cut never leaves half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(ALARM_HEADERS)
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class AlarmStore:
+    """ Alarms.csv plus an append-only change log.
+
+        Every add or remove is one line appended to the log ('+ 7 30 0' or
+        '- 7 30 0') instead of rewriting the csv. After ``compact_every``
+        log entries the current schedule is written as a new snapshot and
+        the log is truncated. Any process may edit the store, reload()
+        picks the changes up by reading only the log lines it has not seen,
+        the csv is parsed again only when it was replaced.
+
+        Replaying log entries already folded into a snapshot gives the same
+        schedule, so a reload racing a compaction is harmless.
+
+        :param path: the Alarms.csv snapshot
+        :param log: change log path, defaults to Alarms.log next to it
+        :param duration: minutes an alarm keeps the lamp on
+    """
+
+    def __init__(self, path, log=None, duration=10, compact_every=256):
+        self.path = path
+        self.log = log or os.path.splitext(path)[0] + '.log'
+        self.duration = duration
+        self.compact_every = compact_every
+        self.schedule = AlarmSchedule(duration=duration)
+        self.reloads = 0
+        self._lock = threading.RLock()
+        self._snapshot_stat = None
+        self._log_stat = None
+        self._offset = 0
+        self._entries = 0
+        self.load()
+
+    # Lookups go to the compiled schedule
+    def active(self, t):
+        return self.schedule.active(t)
+
+    def next_after(self, t):
+        return self.schedule.next_after(t)
+
+    def upcoming(self, t, count=10):
+        return self.schedule.upcoming(t, count)
+
+    def rows(self):
+        return self.schedule.rows()
+
+    def __len__(self):
+        return len(self.schedule)
+
+    def __contains__(self, row):
+        return row in self.schedule
+
+    def load(self):
+        """ Read the snapshot and replay the whole log """
+        with self._lock:
+            self._snapshot_stat = _stat(self.path)
+            rows = read_snapshot(self.path) if self._snapshot_stat else []
+            self.schedule = AlarmSchedule(rows, self.duration)
+            self._offset = 0
+            self._entries = 0
+            self._log_stat = None
+            self._replay()
+
+    def reload(self):
+        """ Apply changes made by other processes, True if there were any.
+
+            Costs two stat calls when nothing changed.
+        """
+        with self._lock:
+            if _stat(self.path) != self._snapshot_stat:
+                self.load()
+                self.reloads += 1
+                return True
+            log_stat = _stat(self.log)
+            if log_stat == self._log_stat:
+                return False
+            if log_stat is None or log_stat[0] != (self._log_stat or log_stat)[0] \
+                    or log_stat[2] < self._offset:
+                # Log was truncated or replaced without a new snapshot
+                self.load()
+            else:
+                self._replay()
+            self.reloads += 1
+            return True
+
+    def _replay(self):
+        try:
+            f = open(self.log, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            self._log_stat = _stat(self.log)
+            f.seek(self._offset)
+            data = f.read()
+        # A line still being written by another process is read next time
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            self._apply(line)
+        self._offset += end
+
+    def _apply(self, line):
+        try:
+            op, hour, minute, day = line.split()
+            if op == b'+':
+                self.schedule.add(int(hour), int(minute), int(day))
+            elif op == b'-':
+                self.schedule.remove(int(hour), int(minute), int(day))
+            else:
+                return
+        except (ValueError, InvalidAlarm):
+            log.warning('Skipping bad alarm log entry: %r', line)
+            return
+        self._entries += 1
+
+    @contextlib.contextmanager
+    def _locked_log(self):
+        """ The log opened for appending, locked against other writers,
+            with everything they wrote before the lock applied """
+        with open(self.log, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.reload()
+            yield f
+
+    def _write(self, f, entries):
+        f.write(b''.join(b'%s %d %d %d\n' % entry for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _snapshot(self, f, rows):
+        # Holding the log lock keeps writers out between snapshot and truncate
+        write_snapshot(self.path, rows)
+        f.truncate(0)
+
+    def _changes(self, add, remove):
+        """ Log entries taking the current schedule to the wanted one """
+        present = {tuple(row) for row in self.schedule.rows()}
+        entries = []
+        for row in remove:
+            if row in present:
+                present.discard(row)
+                entries.append((b'-',) + row)
+        removed = len(entries)
+        for row in add:
+            if row not in present:
+                present.add(row)
+                entries.append((b'+',) + row)
+        return entries, removed, present
+
+    def add(self, hour, minute, day):
+        """ Add an alarm, returns False if it already exists """
+        return self.update(add=[(hour, minute, day)])[0] == 1
+
+    def remove(self, hour, minute, day):
+        """ Remove an alarm, returns False if it did not exist """
+        return self.update(remove=[(hour, minute, day)])[1] == 1
+
+    def update(self, add=(), remove=()):
+        """ Add and remove many alarms with one log write.
+
+            Returns (added, removed) counts. A batch larger than
+            ``compact_every`` goes straight to a new snapshot.
+        """
+        add = [tuple(AlarmSchedule._validate(row)) for row in add]
+        remove = [tuple(AlarmSchedule._validate(row)) for row in remove]
+        with self._lock:
+            # Nothing to do is answered without touching the log
+            self.reload()
+            if not self._changes(add, remove)[0]:
+                return 0, 0
+            with self._locked_log() as f:
+                # Worked out again, another process may have written since
+                entries, removed, present = self._changes(add, remove)
+                if len(entries) > self.compact_every:
+                    self._snapshot(f, sorted(present))
+                elif entries:
+                    self._write(f, entries)
+            # Our own lines are consumed by the next reload like anyone else's
+            self.reload()
+            if self._entries >= self.compact_every:
+                self.compact()
+            return len(entries) - removed, removed
+
+    def replace(self, rows):
+        """ Replace all alarms at once with a fresh snapshot """
+        rows = AlarmSchedule(rows, self.duration).rows()
+        with self._lock:
+            with self._locked_log() as f:
+                self._snapshot(f, rows)
+            self.load()
+
+    def compact(self):
+        """ Fold the log into a new snapshot and truncate it """
+        with self._lock:
+            with self._locked_log() as f:
+                self._snapshot(f, self.schedule.rows())
+            self.load()
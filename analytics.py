@@ -0,0 +1,146 @@
+import json
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# What SmartLamp writes in each ThingSpeak field
+COLUMNS = {'field1': 'temperature', 'field2': 'clouds', 'field3': 'rain',
+           'field4': 'snow', 'field5': 'light'}
+
+# One feed row of a ThingSpeak export, fields are strings or null
+_FEED = re.compile(
+    r'\{"created_at":"([^"]*)","entry_id":(\d+)' +
+    ''.join(r',"field%d":(?:null|"([^"]*)")' % i for i in range(1, 6)) + r'\}')
+
+CHUNK_SIZE = 1 << 20
+
+
+def _scan(f):
+    """ Yield regex matches of feed rows from a file object, chunk by chunk """
+    tail = ''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        buf = tail + chunk
+        end = 0
+        for m in _FEED.finditer(buf):
+            yield m.groups()
+            end = m.end()
+        # Keep an unfinished row for the next chunk
+        tail = buf[end:] if end else buf[-4096:]
+
+
+def load_export(path, tz=None):
+    """ Load a ThingSpeak channel export into a typed DataFrame.
+
+        Rows are matched straight from the text and kept as per-column
+        tuples, so no dict is built per row. Columns are float64 (NaN for
+        null) named after COLUMNS, indexed by the parsed created_at.
+
+        :param tz: convert the index to this timezone (e.g. the lamp's)
+    """
+    with open(path, encoding='utf-8') as f:
+        rows = list(_scan(f))
+    if rows:
+        created, entry, *fields = zip(*rows)
+    else:
+        # Not the compact layout ThingSpeak writes, use the json parser
+        with open(path, encoding='utf-8') as f:
+            feeds = json.load(f)['feeds']
+        created = [row['created_at'] for row in feeds]
+        entry = [row['entry_id'] for row in feeds]
+        fields = [[row.get(name) for row in feeds] for name in COLUMNS]
+
+    # created_at is always 'YYYY-MM-DDTHH:MM:SSZ', numpy parses it without the Z
+    stamps = np.array(created).astype('U19').astype('datetime64[s]')
+    index = pd.DatetimeIndex(stamps, name='created_at').tz_localize('UTC')
+    if tz is not None:
+        index = index.tz_convert(tz)
+    data = {'entry_id': np.array(entry, dtype=np.int64)}
+    for name, values in zip(COLUMNS.values(), fields):
+        # null (None) and empty fields become NaN. An object array, a
+        # fixed width string one would cut 'nan' to the width of its values
+        column = np.array(values, dtype=object)
+        column[column == ''] = None
+        data[name] = column.astype(np.float64)
+    return pd.DataFrame(data, index=index)
+
+
+def light_histogram(df, bins=20, value_range=(0, 5)):
+    """ Histogram of the photoresistor voltage, returns (counts, edges) """
+    light = df['light'].to_numpy()
+    return np.histogram(light[~np.isnan(light)], bins=bins, range=value_range)
+
+
+def weather_join(df):
+    """ Photoresistor rows with the last known weather forward filled """
+    weather = ['temperature', 'clouds', 'rain', 'snow']
+    out = df.copy()
+    out[weather] = out[weather].ffill()
+    return out[out['light'].notna()]
+
+
+def duty_cycle(light, arduino_lb=0, arduino_ub=500):
+    """ Duty cycle SmartLamp picks for photoresistor voltages, vectorized
+        mapping() followed by photoresistor_Range() """
+    counts = np.asarray(light, dtype=np.float64) * 1023 / 5
+    mapped = (counts - arduino_lb) * 100 / (arduino_ub - arduino_lb)
+    return np.select([(0 <= mapped) & (mapped <= 33), (33 < mapped) & (mapped <= 66),
+                      (66 < mapped) & (mapped <= 100)], [100, 50, 0], default=np.nan)
+
+
+def hourly_duty_cycle(df, arduino_lb=0, arduino_ub=500):
+    """ Mean estimated duty cycle per hour of the day, lights off 23h-6h """
+    light = df['light'].dropna()
+    duty = duty_cycle(light.to_numpy(), arduino_lb, arduino_ub)
+    hours = light.index.hour.to_numpy()
+    duty[(hours == 23) | (hours < 6)] = 0
+    return pd.Series(duty, index=hours).groupby(level=0).mean().rename('duty_cycle')
+
+
+def synthetic_export(path, rows, start=1589377705):
+    """ Write a ThingSpeak-style export of ``rows`` feeds, weather every 10th """
+    rng = np.random.default_rng(0)
+    light = np.round(2.5 + 2 * np.sin(np.arange(rows) / 480) + rng.normal(0, 0.05, rows), 2)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"channel":{"id":1,"name":"synthetic","last_entry_id":%d},"feeds":[' % rows)
+        for i in range(rows):
+            created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start + 180 * i))
+            if i % 10 == 0:
+                weather = '"%.2f","%d","0","0"' % (15 + 10 * np.sin(i / 4800), i % 100)
+                weather = ','.join('"field%d":%s' % (n + 1, v) for n, v in enumerate(weather.split(',')))
+            else:
+                weather = '"field1":null,"field2":null,"field3":null,"field4":null'
+            f.write('%s{"created_at":"%s","entry_id":%d,%s,"field5":"%.2f"}'
+                    % (',' if i else '', created, i + 1, weather, light[i]))
+        f.write(']}')
+
+
+if __name__ == '__main__':
+    # python analytics.py [export.json]  or  python analytics.py --benchmark [rows]
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        import os
+        import tempfile
+        rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        path = os.path.join(tempfile.mkdtemp(), 'export.json')
+        synthetic_export(path, rows)
+        print('export   %d rows, %.1f MB' % (rows, os.path.getsize(path) / 1e6))
+        start = time.perf_counter()
+        df = load_export(path)
+        print('load     %.2f s' % (time.perf_counter() - start))
+        for name, func in (('histogram', light_histogram), ('join', weather_join),
+                           ('duty', hourly_duty_cycle)):
+            start = time.perf_counter()
+            func(df)
+            print('%-8s %.3f s' % (name, time.perf_counter() - start))
+        os.remove(path)
+    else:
+        df = load_export(sys.argv[1] if len(sys.argv) > 1 else 'ThingSpeak_Data.json')
+        print(df.describe())
+        print(light_histogram(df, bins=10))
+        print(hourly_duty_cycle(df))
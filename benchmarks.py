@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import lamp_control
+from simulate import load_traces, simulate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Light levels on both sides of the BrightnessControl thresholds
+DARK, BRIGHT = 50, 400
+
+WEATHER_JSON = {'weather': [{'description': 'scattered clouds'}],
+                'main': {'feels_like': 291.5}, 'clouds': {'all': 40},
+                'rain': {'1h': 0.2}, 'sys': {'sunrise': 1600000000, 'sunset': 1600040000}}
+
+
+def micro(number=20000, repeat=5):
+    """ ns per call of the per-reading helpers, best of ``repeat`` """
+    samples = [float(200 + i % 7) for i in range(20)]
+    alarms = [[h % 24, (h * 10) % 60, h % 7] for h in range(100)]
+    cases = {
+        'average': lambda: lamp_control.average(samples),
+        'mapping': lambda: lamp_control.mapping(0, 500, 0, 100, 321),
+        'photoresistor_Range': lambda: lamp_control.photoresistor_Range(50),
+        'checkDuplicates': lambda: lamp_control.checkDuplicates(list(alarms)),
+        'get_weather_data': lambda: lamp_control.get_weather_data(WEATHER_JSON),
+    }
+    results = {}
+    # Some of them print, the terminal is not what is being measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, func in cases.items():
+            n = number // 20 if name == 'checkDuplicates' else number
+            best = min(timeit.repeat(func, number=n, repeat=repeat))
+            results[name] = best / n * 1e9
+    return results
+
+
+def cpu_per_hour(hours=24):
+    """ CPU ms per simulated hour of the scheduled jobs, recorded traces """
+    traces = load_traces(os.path.join(HERE, 'ThingSpeak_Data.json'))
+    start = time.process_time()
+    simulate(traces, hours)
+    return (time.process_time() - start) * 1000 / hours
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """ Geolocation, OpenWeatherMap and ThingSpeak on localhost """
+
+    def _json(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/geo'):
+            self._json(200, {'lat': '43.65', 'lon': '-79.38'})
+        elif self.headers.get('If-None-Match') == '"w1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self._json(200, WEATHER_JSON, [('ETag', '"w1"')])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._json(202, {'success': True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _NoonClock:
+    """ Real clock moved to 12:00 local time, the lamp is dark at night """
+
+    def __init__(self):
+        now = time.time()
+        local = time.localtime(now)
+        self.offset = (12 - local.tm_hour) * 3600 - local.tm_min * 60
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time() + self.offset
+
+    def localtime(self):
+        return time.localtime(self.time())
+
+
+def _light_source(fd, steps, period, rate, stop):
+    """ Write sketch lines to the pty, the level flips every ``period``.
+        Appends perf_counter() of each flip to ``steps`` """
+    level = DARK
+    next_step = time.perf_counter() + period
+    i = 0
+    while not stop.is_set():
+        now = time.perf_counter()
+        if now >= next_step:
+            level = BRIGHT if level == DARK else DARK
+            steps.append((now, level))
+            next_step += period
+        # Serial.println(photoValue) of the sketch, a little noise on top
+        os.write(fd, b'%.2f\r\n' % (level + (i % 5) - 2))
+        i += 1
+        stop.wait(1 / rate)
+
+
+def end_to_end(seconds=10, rate=20, period=0.5):
+    """ Light step at the pty to PWM write, through the real SerialReader,
+        asyncio runtime and HTTP clients pointed at local stand-ins """
+    import pty
+    import requests
+    from alarm_schedule import AlarmSchedule
+    from hal import DigitalOutput, MockBackend, PWMOutput
+    from history import TelemetryStore
+    from runtime import AsyncLamp
+    from serial_reader import SerialReader
+    from uploader import ThingSpeakUploader
+    from weather import WeatherProvider
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    master, slave = pty.openpty()
+    steps = []
+    stop = threading.Event()
+    writer = threading.Thread(target=_light_source, args=(master, steps, period, rate, stop),
+                              daemon=True)
+    # Timestamps in perf_counter() so they compare with the light steps
+    gpio = MockBackend(SimpleNamespace(time=time.perf_counter))
+    with tempfile.TemporaryDirectory() as tmp:
+        session = requests.Session()
+        reader = SerialReader([os.ttyname(slave)], 9600)
+        lamp = lamp_control.new_lamp(
+            clock=_NoonClock(), reader=reader, ramp=0, adjust_interval=1,
+            pwm=PWMOutput(gpio, 12, 1000), leds=DigitalOutput(gpio, [38, 40]),
+            weather=WeatherProvider('key', tmp, session=session, ttl=1,
+                                    geo_url=base + '/geo', weather_url=base + '/weather'),
+            uploader=ThingSpeakUploader(1, 'key', url=base, session=session, queue_size=256),
+            alarms=AlarmSchedule([]), history=TelemetryStore(tmp))
+        # Network jobs far more often than on a lamp, to load the loop
+        runtime = AsyncLamp(lamp, periods={'weather': (2, 0), 'upload': (1, 0),
+                                           'photoresistor': (0.5, 0)})
+
+        async def timed():
+            try:
+                await asyncio.wait_for(runtime.run(), seconds)
+            except asyncio.TimeoutError:
+                pass
+
+        reader.start()
+        # The sketch lines are the first firmware's, readings start once
+        # its handshake has timed out, the light steps come after that
+        reader.identified.wait(reader.handshake + 5)
+        writer.start()
+        cpu = time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(timed())
+        cpu = time.process_time() - cpu
+        stop.set()
+        reader.stop(timeout=2)
+        lamp['uploader'].stop()
+        server.shutdown()
+        server.server_close()
+        os.close(master)
+        os.close(slave)
+
+    target = {DARK: 100, BRIGHT: 0}
+    writes = gpio.history[12]
+    latencies = []
+    for t, level in steps:
+        hit = next((wt for wt, duty in writes if wt >= t and duty == target[level]), None)
+        if hit is not None:
+            latencies.append(hit - t)
+    latencies.sort()
+    if not latencies:
+        return {'steps': len(steps), 'cpu_pct': cpu / seconds * 100}
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+    return {'steps': len(steps), 'actuated': len(latencies),
+            'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99),
+            'max_ms': latencies[-1] * 1000, 'mean_ms': statistics.mean(latencies) * 1000,
+            'cpu_pct': cpu / seconds * 100, 'uploads': lamp['uploader'].sent}
+
+
+def run(seconds):
+    results = {'micro_ns': micro(), 'cpu_ms_per_sim_hour': cpu_per_hour()}
+    results['end_to_end'] = end_to_end(seconds)
+    return results
+
+
+def report(results, baseline=None, tolerance=0.3):
+    """ Print the results, returns the names that got slower than baseline """
+    regressions = []
+
+    def line(name, value, unit, old):
+        note = ''
+        if old:
+            change = value / old - 1
+            note = '%+6.1f%%' % (change * 100)
+            if change > tolerance:
+                note += '  REGRESSION'
+                regressions.append(name)
+        print('%-28s %10.2f %-8s %s' % (name, value, unit, note))
+
+    old = baseline or {}
+    for name, value in results['micro_ns'].items():
+        line(name, value, 'ns/call', old.get('micro_ns', {}).get(name))
+    line('jobs cpu', results['cpu_ms_per_sim_hour'], 'ms/sim-h', old.get('cpu_ms_per_sim_hour'))
+    e2e = results['end_to_end']
+    print('light steps %d, actuated %d' % (e2e['steps'], e2e.get('actuated', 0)))
+    for key, unit in (('p50_ms', 'ms'), ('p90_ms', 'ms'), ('p99_ms', 'ms'),
+                      ('max_ms', 'ms'), ('cpu_pct', '% cpu')):
+        if key in e2e:
+            line('light -> pwm ' + key.split('_')[0], e2e[key], unit,
+                 old.get('end_to_end', {}).get(key))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Smart lamp benchmark suite')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the end-to-end run')
+    parser.add_argument('--save', help='write the results as json, e.g. a baseline')
+    parser.add_argument('--compare', help='baseline json, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='allowed slowdown against the baseline (0.3 is 30%%)')
+    args = parser.parse_args()
+
+    results = run(args.seconds)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print('Slower than baseline:', ', '.join(regressions))
+        sys.exit(1)
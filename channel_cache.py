@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from analytics import COLUMNS
+
+READ_URL = 'https://api.thingspeak.com'
+# Most entries the read API returns per request
+PAGE_SIZE = 8000
+
+# Column files of the cache, one fixed width value per entry
+DTYPES = {'created_at': np.int64, 'entry_id': np.int64}
+DTYPES.update((field, np.float64) for field in COLUMNS)
+
+
+class CacheError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+class ChannelCache:
+    """ Local columnar copy of a ThingSpeak channel.
+
+        Every column is a raw file of fixed width values in entry order,
+        created_at as epoch seconds and fields as float64 (NaN for null).
+        meta.json holds the row count and the last entry, it is replaced
+        after the columns are appended, so rows past its count are left
+        over from an interrupted append and cut off on open.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {'channel': None, 'rows': 0, 'last_entry_id': 0, 'last_created_at': None}
+        try:
+            with open(self._path('meta.json'), encoding='utf-8') as f:
+                self.meta.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            raise CacheError('Unreadable %s: %s' % (self._path('meta.json'), e))
+        for name, dtype in DTYPES.items():
+            path = self._path(name)
+            size = self.meta['rows'] * np.dtype(dtype).itemsize
+            length = os.path.getsize(path) if os.path.exists(path) else 0
+            if length < size:
+                raise CacheError('Column %s is shorter than %d rows' % (name, self.meta['rows']))
+            if length > size:
+                os.truncate(path, size)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @property
+    def last_entry_id(self):
+        return self.meta['last_entry_id']
+
+    def append(self, feeds, channel=None):
+        """ Append feed rows of the read API, entries already cached are skipped """
+        feeds = sorted((row for row in feeds if row['entry_id'] > self.last_entry_id),
+                       key=lambda row: row['entry_id'])
+        if not feeds:
+            return 0
+        created = [row['created_at'] for row in feeds]
+        columns = {'created_at': np.array(created).astype('U19').astype('datetime64[s]').astype(np.int64),
+                   'entry_id': np.array([row['entry_id'] for row in feeds], dtype=np.int64)}
+        for field in COLUMNS:
+            column = np.array([row.get(field) or 'nan' for row in feeds])
+            columns[field] = column.astype(np.float64)
+        for name, values in columns.items():
+            with open(self._path(name), 'ab') as f:
+                values.astype(DTYPES[name]).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        self.meta.update(rows=self.meta['rows'] + len(feeds), last_entry_id=feeds[-1]['entry_id'],
+                         last_created_at=created[-1])
+        if channel is not None:
+            self.meta['channel'] = channel
+        tmp = self._path('meta.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path('meta.json'))
+        return len(feeds)
+
+    def column(self, name):
+        """ Memory mapped column, read only """
+        if not self.meta['rows']:
+            return np.empty(0, dtype=DTYPES[name])
+        return np.memmap(self._path(name), dtype=DTYPES[name], mode='r', shape=(self.meta['rows'],))
+
+    def frame(self, tz=None):
+        """ The cache as the DataFrame load_export() builds from an export """
+        stamps = self.column('created_at').astype('datetime64[s]')
+        index = pd.DatetimeIndex(stamps, name='created_at').tz_localize('UTC')
+        if tz is not None:
+            index = index.tz_convert(tz)
+        data = {'entry_id': self.column('entry_id')}
+        for field, name in COLUMNS.items():
+            data[name] = self.column(field)
+        return pd.DataFrame(data, index=index, copy=False)
+
+
+def _session(pool=2):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _stamp(created_at):
+    # The read API takes 'YYYY-MM-DD HH:NN:SS' in UTC
+    return created_at[:19].replace('T', ' ')
+
+
+def fetch_new(channel_id, after_id, after_time=None, api_key=None, url=READ_URL,
+              session=None, page=PAGE_SIZE, timeout=30):
+    """ Feed rows with an entry_id above ``after_id``, and the channel info.
+
+        Requests are bounded by time, starting at the last cached entry.
+        A full page that leaves ids out is followed by one ending where it
+        started (the API returns the newest entries of a range) or
+        starting where it ended, until every id up to the channel's
+        last_entry_id is in.
+    """
+    session = session or _session()
+    endpoint = '%s/channels/%s/feeds.json' % (url.rstrip('/'), channel_id)
+    rows = {}
+    channel = None
+    start, end = after_time, None
+    while True:
+        params = {'results': page}
+        if api_key:
+            params['api_key'] = api_key
+        if start:
+            params['start'] = _stamp(start)
+        if end:
+            params['end'] = _stamp(end)
+        r = session.get(endpoint, params=params, timeout=timeout)
+        if r.status_code != 200:
+            raise CacheError('ThingSpeak read failed with %d: %s' % (r.status_code, r.text[:200]))
+        body = r.json()
+        if body == -1:
+            raise CacheError('Channel %s is private, an api key is needed' % channel_id)
+        channel = body['channel']
+        feeds = [row for row in body['feeds'] if row['entry_id'] > after_id]
+        fresh = [row for row in feeds if row['entry_id'] not in rows]
+        rows.update((row['entry_id'], row) for row in feeds)
+        target = channel.get('last_entry_id') or 0
+        if not fresh or len(rows) >= target - after_id or len(body['feeds']) < page:
+            break
+        lowest = min(feeds, key=lambda row: row['entry_id'])
+        highest = max(feeds, key=lambda row: row['entry_id'])
+        if lowest['entry_id'] > after_id + 1 and (lowest['entry_id'] - 1) not in rows:
+            end = lowest['created_at']
+        else:
+            start, end = highest['created_at'], None
+    return [rows[k] for k in sorted(rows)], channel
+
+
+def sync(cache, channel_id, api_key=None, url=READ_URL, session=None, page=PAGE_SIZE):
+    """ Append what the channel got since the last sync, returns the row count added """
+    feeds, channel = fetch_new(channel_id, cache.last_entry_id, cache.meta['last_created_at'],
+                               api_key, url, session, page)
+    return cache.append(feeds, channel)
+
+
+def _stand_in(feeds, page):
+    """ Local HTTP server answering /channels/<id>/feeds.json from ``feeds`` """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class ReadAPI(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            start = query.get('start', [''])[0].replace(' ', 'T')
+            end = query.get('end', ['~'])[0].replace(' ', 'T')
+            results = min(int(query.get('results', [page])[0]), page)
+            # The newest ``results`` entries of the range, as ThingSpeak
+            match = [row for row in feeds if start <= row['created_at'][:19] <= end][-results:]
+            last = feeds[-1]['entry_id'] if feeds else None
+            data = json.dumps({'channel': {'id': 1, 'last_entry_id': last},
+                               'feeds': match}).encode('utf-8')
+            self.server.queries.append(query)
+            self.server.requests += 1
+            self.server.bytes += len(data)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReadAPI)
+    server.daemon_threads = True
+    server.requests = server.bytes = 0
+    server.queries = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark(rows=100000, new=500, page=PAGE_SIZE):
+    """ Full first sync and an incremental one against a local stand-in """
+    import tempfile
+
+    start = 1589377705
+    feeds = [{'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start + 15 * i)),
+              'entry_id': i + 1, 'field1': '20.5' if i % 10 == 0 else None, 'field2': None,
+              'field3': None, 'field4': None, 'field5': '%.2f' % (1.5 + (i % 100) / 100)}
+             for i in range(rows + new)]
+    served = feeds[:rows]
+    server = _stand_in(served, page)
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    session = _session()
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ChannelCache(tmp)
+        for name in ('full', 'incremental', 'unchanged'):
+            if name == 'incremental':
+                served.extend(feeds[rows:])
+            server.requests = server.bytes = 0
+            started = time.perf_counter()
+            added = sync(cache, 1, url=url, session=session, page=page)
+            print('%-12s %7d rows  %3d requests  %8.1f kB  %.3f s' % (
+                name, added, server.requests, server.bytes / 1000, time.perf_counter() - started))
+        started = time.perf_counter()
+        df = ChannelCache(tmp).frame()
+        print('open         %7d rows  %.3f s' % (len(df), time.perf_counter() - started))
+        assert list(df['entry_id']) == list(range(1, rows + new + 1))
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync a ThingSpeak channel into a local columnar cache')
+    parser.add_argument('channel', nargs='?', default='1054814')
+    parser.add_argument('--cache', default='thingspeak_cache', help='cache directory')
+    parser.add_argument('--api-key', help='read key of a private channel')
+    parser.add_argument('--url', default=READ_URL)
+    parser.add_argument('--page', type=int, default=PAGE_SIZE, help='entries per request')
+    parser.add_argument('--benchmark', type=int, metavar='ROWS',
+                        help='sync ROWS synthetic entries from a local stand-in')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        cache = ChannelCache(args.cache)
+        added = sync(cache, args.channel, args.api_key, args.url, page=args.page)
+        print('%d new entries, %d cached up to entry %d' % (added, len(cache), cache.last_entry_id))
@@ -0,0 +1,132 @@
+import math
+import time
+from array import array
+
+from light_filter import BrightnessControl
+
+MINUTES_PER_DAY = 24 * 60
+# Photoresistor levels (sketch units) of a dark room and of full daylight,
+# used until the history holds a day of readings
+NIGHT_LEVEL = 20.0
+PEAK_LEVEL = 450.0
+TWILIGHT = 30 # minutes of dawn and dusk on each side of sunrise/sunset
+
+
+def cloud_factor(clouds):
+    """ Fraction of clear sky light left under ``clouds`` percent cover,
+        the Kasten-Czeplak fit 1 - 0.75 * (cover)^3.4 """
+    cover = min(max(clouds, 0), 100) / 100
+    return 1 - 0.75 * cover ** 3.4
+
+
+def daylight(minute, sunrise, sunset):
+    """ 0 at night to 1 at solar noon, minutes of the local day """
+    if sunset <= sunrise:
+        return 0.0
+    dawn, dusk = sunrise - TWILIGHT, sunset + TWILIGHT
+    if not dawn < minute < dusk:
+        return 0.0
+    return math.sin(math.pi * (minute - dawn) / (dusk - dawn))
+
+
+def learn_levels(history, days=7, now=None):
+    """ (night, peak) photoresistor levels from the last ``days`` of history.
+
+        The 5th and 95th percentiles of the logged readings, None when
+        there is less than a day of them (one every 3 minutes).
+    """
+    if history is None:
+        return None
+    if now is None:
+        now = time.time()
+    _, values = history.range('photoresistor', now - days * 86400, now)
+    if len(values) < 480:
+        return None
+    # Logged as volts, the plan works in the sketch units
+    levels = sorted(v * 1023 / 5 for v in values)
+    return levels[len(levels) // 20], levels[len(levels) * 19 // 20]
+
+
+class DaylightPlan:
+    """ Expected light level and duty cycle for every minute of one day.
+
+        Lookups are array indexing. Sensor readings taken now and then go
+        through correct(), which scales the whole plan towards what the
+        room really measures and recomputes the duty table.
+
+        :param levels: 1440 expected photoresistor levels, minute of day
+        :param brightness: BrightnessControl mapping levels to duty cycles
+    """
+
+    def __init__(self, levels, brightness=None, gain=1.0):
+        self.levels = array('d', levels)
+        self.brightness = brightness or BrightnessControl()
+        self.gain = gain
+        self.corrections = 0
+        self._tabulate()
+
+    @classmethod
+    def build(cls, sunrise, sunset, clouds, levels=None, brightness=None, gain=1.0):
+        """ Plan from sun times (minutes of the day) and cloud cover.
+
+            :param levels: (night, peak) from learn_levels(), defaults to
+                NIGHT_LEVEL and PEAK_LEVEL
+        """
+        night, peak = levels or (NIGHT_LEVEL, PEAK_LEVEL)
+        span = (peak - night) * cloud_factor(clouds)
+        return cls([night + span * daylight(m, sunrise, sunset) for m in range(MINUTES_PER_DAY)],
+                   brightness, gain)
+
+    def _tabulate(self):
+        # The sensor path's own mapping, so both give the same duty for a level
+        gain = self._tabulated = self.gain
+        self.duties = array('d', self.brightness.targets(self.levels, gain))
+
+    def level(self, minute):
+        return self.levels[minute % MINUTES_PER_DAY] * self.gain
+
+    def duty(self, minute):
+        return self.duties[minute % MINUTES_PER_DAY]
+
+    def correct(self, minute, measured, weight=0.3, limits=(0.2, 5.0), tolerance=0.02):
+        """ Move the plan gain towards ``measured`` / expected at ``minute``.
+
+            The duty table is only recomputed once the gain moved more than
+            ``tolerance`` from the one it was computed with.
+        """
+        expected = self.levels[minute % MINUTES_PER_DAY]
+        if expected < 1:
+            return self.gain
+        ratio = min(max(measured / expected, limits[0]), limits[1])
+        self.gain += weight * (ratio - self.gain)
+        self.corrections += 1
+        if abs(self.gain - self._tabulated) > tolerance * self._tabulated:
+            self._tabulate()
+        return self.gain
+
+
+def plan_day(weather_data, history=None, brightness=None, gain=1.0):
+    """ DaylightPlan from get_weather_data() output, None without sun times """
+    try:
+        sunrise = weather_data['sunrise'][0] * 60 + weather_data['sunrise'][1]
+        sunset = weather_data['sunset'][0] * 60 + weather_data['sunset'][1]
+    except (KeyError, TypeError, IndexError):
+        return None
+    clouds = weather_data.get('clouds')
+    if not isinstance(clouds, (int, float)):
+        clouds = 50 # 'No data', plan for an average sky
+    return DaylightPlan.build(sunrise, sunset, clouds, learn_levels(history), brightness, gain)
+
+
+if __name__ == '__main__':
+    # Build and lookup cost, and one day of the plan every hour
+    import timeit
+
+    plan = plan_day({'sunrise': [6, 40], 'sunset': [19, 55], 'clouds': 40})
+    print('build   %.2f ms' % (timeit.timeit(
+        lambda: plan_day({'sunrise': [6, 40], 'sunset': [19, 55], 'clouds': 40}), number=20) * 50))
+    print('correct %.2f ms' % (timeit.timeit(lambda: plan.correct(720, 300), number=20) * 50))
+    print('lookup  %.0f ns' % (timeit.timeit(lambda: plan.duty(720), number=100000) * 1e4))
+    plan = plan_day({'sunrise': [6, 40], 'sunset': [19, 55], 'clouds': 40})
+    for hour in range(0, 24, 2):
+        print('%02d:00  level %6.1f  duty %5.1f' % (hour, plan.level(hour * 60), plan.duty(hour * 60)))
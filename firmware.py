@@ -0,0 +1,290 @@
+import random
+import threading
+import time
+
+# Text commands photoresistor.ino reads from the Pi, one per line:
+#   O <count>  readings averaged per report     I <ms>  delay between readings
+#   M <mode>   MEAN, MINMAX ("mean min max" per sensor) or RAW (every reading)
+#   ?          report the settings
+# Every command is answered with a "#cfg" line, a bad one with "#err".
+MEAN, MINMAX, RAW = 0, 1, 2
+MODES = {'mean': MEAN, 'minmax': MINMAX, 'raw': RAW}
+LIMITS = {'oversample': (1, 1000), 'interval': (0, 1000), 'mode': (0, 2)}
+COMMANDS = {'oversample': b'O', 'interval': b'I', 'mode': b'M'}
+CONFIG_KEYS = {'v': 'firmware', 'o': 'oversample', 'i': 'interval', 'm': 'mode', 'c': 'channels'}
+# What the sketch does until told otherwise
+DEFAULTS = {'oversample': 250, 'interval': 4, 'mode': MEAN}
+
+
+def encode(**settings):
+    """ Command lines for ``settings`` (oversample, interval, mode) """
+    out = b''
+    for key, value in settings.items():
+        if value is None:
+            continue
+        lo, hi = LIMITS[key]
+        if not lo <= int(value) <= hi:
+            raise ValueError('%s must be %d to %d, not %r' % (key, lo, hi, value))
+        out += COMMANDS[key] + b'%d\n' % int(value)
+    return out
+
+
+def parse_config(line):
+    """ Settings from a '#cfg v=2 o=250 i=4 m=0 c=1' line, None for others """
+    fields = line.decode('ascii', 'replace').split()
+    if not fields or fields[0] != '#cfg':
+        return None
+    config = {}
+    for field in fields[1:]:
+        key, _, value = field.partition('=')
+        if key in CONFIG_KEYS and value.isdigit():
+            config[CONFIG_KEYS[key]] = int(value)
+    return config
+
+
+def parse_value(field):
+    """ (value, spread) of one sensor's text, 'mean' or 'mean min max' """
+    parts = field.split()
+    value = float(parts[0])
+    if len(parts) == 3:
+        return value, float(parts[2]) - float(parts[1])
+    return value, 0.0
+
+
+class AdaptiveSampling:
+    """ Fast, lightly averaged readings while the light changes, heavily
+        averaged sparse ones when it is steady.
+
+        A reading further than ``threshold`` (sketch units) from the slow
+        average, or a min/max spread that wide, switches to ``fast`` for
+        at least ``hold`` seconds.
+
+        :param fast: (oversample, interval ms), ~20 ms per reading
+        :param steady: (oversample, interval ms), ~2 s per reading
+    """
+
+    def __init__(self, fast=(16, 1), steady=(500, 4), threshold=20, hold=10, alpha=0.1,
+                 clock=time.monotonic):
+        self.fast = fast
+        self.steady = steady
+        self.threshold = threshold
+        self.hold = hold
+        self.alpha = alpha
+        self.clock = clock
+        self.level = None
+        self.until = 0
+        self.current = None
+        self.switches = 0
+
+    def update(self, value, spread=0.0):
+        """ Settings to send when they should change, else None """
+        now = self.clock()
+        if self.level is None:
+            self.level = value
+        if abs(value - self.level) > self.threshold or spread > self.threshold:
+            self.until = now + self.hold
+        self.level += self.alpha * (value - self.level)
+        wanted = self.fast if now < self.until else self.steady
+        if wanted == self.current:
+            return None
+        self.current = wanted
+        self.switches += 1
+        # Minimum and maximum show a change within one steady reading
+        return {'oversample': wanted[0], 'interval': wanted[1],
+                'mode': MINMAX if wanted == self.steady else MEAN}
+
+
+class FirmwareSimulator:
+    """ photoresistor.ino on the host, for tests and benchmarks.
+
+        Behaves like the serial.Serial the reader opens: readline() blocks
+        until the sketch would have finished its next report, write()
+        takes commands. Readings take ``interval`` ms plus the ADC time,
+        divided by ``speed``. A command aborts the report in progress, as
+        the sketch does.
+
+        :param light: callable(seconds since start) -> ADC counts, or a list
+            of them per sensor
+        :param firmware: 2 for the commanded sketch, 1 for the old one
+            that ignores commands and prints half the mean
+    """
+
+    ADC_MS = 0.11
+
+    def __init__(self, light, channels=1, noise=2.0, speed=1.0, firmware=2, seed=0):
+        self.light = light
+        self.channels = channels
+        self.noise = noise
+        self.speed = speed
+        self.firmware = firmware
+        self.settings = dict(DEFAULTS)
+        self.random = random.Random(seed)
+        self.reports = 0
+        self.commands = 0
+        self.timeout = 1
+        self._replies = []
+        self._lock = threading.Lock()
+        self._start = None
+        self._pending = bytearray()
+        self._due = None
+
+    def __call__(self, port, baudrate=9600, timeout=1):
+        """ serial_factory for SerialReader, opening resets the board """
+        self.timeout = timeout
+        self._start = time.monotonic()
+        self._due = None
+        with self._lock:
+            self.settings = dict(DEFAULTS)
+            self._replies = [self._config()] if self.firmware >= 2 else []
+        return self
+
+    def _elapsed(self):
+        return (time.monotonic() - self._start) * self.speed
+
+    def _config(self):
+        s = self.settings
+        return b'#cfg v=%d o=%d i=%d m=%d c=%d\r\n' % (
+            self.firmware, s['oversample'], s['interval'], s['mode'], self.channels)
+
+    def _levels(self, t):
+        levels = self.light(t)
+        return levels if isinstance(levels, (list, tuple)) else [levels] * self.channels
+
+    def _read_adc(self, t):
+        return [min(max(int(round(level + self.random.gauss(0, self.noise))), 0), 1023)
+                for level in self._levels(t)]
+
+    def _report(self, start, end):
+        """ The line the sketch prints for readings taken from start to end """
+        s = self.settings
+        count = s['oversample'] if self.firmware >= 2 else 250
+        if self.firmware >= 2 and s['mode'] == RAW:
+            count = 1
+        readings = [self._read_adc(start + (end - start) * i / count) for i in range(count)]
+        fields = []
+        for channel in zip(*readings):
+            if self.firmware < 2:
+                fields.append('%.2f' % (sum(channel) // 500)) # the old integer halving
+            elif s['mode'] == MINMAX:
+                fields.append('%.2f %d %d' % (sum(channel) / count, min(channel), max(channel)))
+            else:
+                fields.append('%.2f' % (sum(channel) / count))
+        return (','.join(fields) + '\r\n').encode('ascii')
+
+    def _duration(self):
+        s = self.settings
+        if self.firmware < 2:
+            return 250 * (4 + self.ADC_MS) / 1000
+        count = 1 if s['mode'] == RAW else s['oversample']
+        return count * (s['interval'] + self.ADC_MS * self.channels) / 1000
+
+    def write(self, data):
+        if self.firmware < 2:
+            return len(data)
+        with self._lock:
+            self._pending += data
+            while b'\n' in self._pending:
+                line, _, rest = bytes(self._pending).partition(b'\n')
+                self._pending = bytearray(rest)
+                self._command(line.strip())
+            self._due = None # the report in progress is dropped
+        return len(data)
+
+    def _command(self, line):
+        if not line:
+            return
+        self.commands += 1
+        key = {v: k for k, v in COMMANDS.items()}.get(line[:1])
+        if line == b'?':
+            self._replies.append(self._config())
+            return
+        try:
+            value = int(line[1:])
+        except ValueError:
+            value = None
+        if key is None or value is None or not LIMITS[key][0] <= value <= LIMITS[key][1]:
+            self._replies.append(b'#err ' + line + b'\r\n')
+            return
+        self.settings[key] = value
+        self._replies.append(self._config())
+
+    def readline(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                if self._replies:
+                    return self._replies.pop(0)
+                now = self._elapsed()
+                if self._due is None:
+                    self._due = (now, now + self._duration())
+                start, end = self._due
+                if now >= end:
+                    self._due = None
+                    self.reports += 1
+                    return self._report(start, end)
+            wait = min((end - now) / self.speed, deadline - time.monotonic())
+            if wait <= 0:
+                return b''
+            time.sleep(min(wait, 0.01))
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        return self.readline()
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def benchmark(seconds=30, speed=1.0, ramp=4.0):
+    """ A light ramp read with the sketch's default settings and with
+        AdaptiveSampling, through SerialReader and the simulator """
+    from serial_reader import SerialReader
+
+    ramp_at = seconds / 2
+
+    def light(t):
+        # ADC counts, a lamp switched on next door
+        return 200 + 500 * min(max((t - ramp_at) / ramp, 0), 1)
+
+    results = {}
+    for name, sampling in (('fixed', None), ('adaptive', AdaptiveSampling())):
+        device = FirmwareSimulator(light, speed=speed)
+        reader = SerialReader(['sim'], serial_factory=device, sampling=sampling, size=65536)
+        reader.start()
+        time.sleep(seconds / speed)
+        reader.stop(timeout=2)
+        count = len(reader.buffer)
+        # Simulated time each reading arrived, and how far it was from the light then
+        readings = [((t - device._start) * speed, v) for t, v in
+                    zip(reader.buffer.times[:count], reader.buffer.values[:count])]
+        steady = [t for t, _ in readings if t < ramp_at]
+        moving = [abs(v - light(t) * 0.5) for t, v in readings if ramp_at <= t <= ramp_at + ramp + 1]
+        final = light(seconds) * 0.5
+        settled = next((t for t, v in readings if t > ramp_at and abs(v - final) < 5), None)
+        results[name] = {'steady_per_min': len(steady) / (ramp_at / 60), 'ramp_readings': len(moving),
+                         'ramp_error': sum(moving) / len(moving) if moving else None,
+                         'settled_s': None if settled is None else settled - ramp_at - ramp,
+                         'commands': device.commands}
+    print('%d s simulated, light ramps 100 -> 350 over %.0f s at %.0f s' % (seconds, ramp, ramp_at))
+    for name, r in results.items():
+        print('%-9s steady %5.0f readings/min  ramp %4d readings, mean error %6.1f  '
+              'settled %+.2f s after the ramp  %d commands'
+              % (name, r['steady_per_min'], r['ramp_readings'], r['ramp_error'] or 0,
+                 r['settled_s'] if r['settled_s'] is not None else float('nan'), r['commands']))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Host-side photoresistor.ino simulator')
+    parser.add_argument('--seconds', type=float, default=30, help='simulated seconds')
+    parser.add_argument('--speed', type=float, default=1.0, help='simulated seconds per real second')
+    args = parser.parse_args()
+    benchmark(args.seconds, args.speed)
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from alarm_schedule import AlarmSchedule
+from alarm_store import read_snapshot
+from hal import DigitalOutput, LOW, PWMOutput, open_backend
+from history import TelemetryStore
+import lamp_control
+import lamp_logging
+from runtime import IO_TIMEOUTS, ticks
+from scheduler import SystemClock
+
+
+log = lamp_logging.get_logger('runtime')
+
+
+class FleetConfigError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def load_config(path):
+    """ Fleet config, JSON:
+
+        {"weather_key": "...", "cache_dir": "/var/lib/smartlamp",
+         "lamps": [{"name": "hall", "serial": "/dev/ttyUSB0", "pwm_pin": 12,
+                    "leds": [38, 40], "channel_id": "1054814",
+                    "write_key": "...", "alarms": "Alarms-hall.csv"}]}
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    names = set()
+    for lamp in config.get('lamps', []):
+        for key in ('name', 'serial', 'pwm_pin', 'channel_id', 'write_key'):
+            if key not in lamp:
+                raise FleetConfigError("Lamp %r has no %r" % (lamp.get('name'), key))
+        if lamp['name'] in names:
+            raise FleetConfigError("Lamp name %r is used twice" % lamp['name'])
+        names.add(lamp['name'])
+    return config
+
+
+class Fleet:
+    """ Many lamps driven from one asyncio event loop.
+
+        Every job runs once per period for all lamps. The weather is fetched
+        once for the fleet and ThingSpeak uploads of all channels go
+        through one pooled requests.Session on a small thread pool, so the
+        loop itself never waits on the network.
+
+        :param make_parts: callable(lamp_config) -> dict of reader, uploader,
+            history and alarms, replaced by fakes in benchmarks
+    """
+
+    def __init__(self, config, backend=None, clock=None, weather=None,
+                 make_parts=None, workers=4, upload_timeout=30):
+        self.config = config
+        self.clock = clock if clock is not None else SystemClock()
+        self.cache_dir = config.get('cache_dir', os.getcwd())
+        self.workers = workers
+        self.upload_timeout = upload_timeout
+        # Names of the lamps whose flush is still running on the pool
+        self._flushing = set()
+        # A backend name (or None to detect one), or an already opened backend
+        self.gpio = open_backend(backend) if backend is None or isinstance(backend, str) else backend
+        self.session = None
+        self.weather = weather if weather is not None else self._weather()
+        make_parts = make_parts or self._parts
+        self.lamps = []
+        for cfg in config['lamps']:
+            lamp = lamp_control.new_lamp(
+                name=cfg['name'], clock=self.clock, weather=self.weather,
+                pwm=PWMOutput(self.gpio, cfg['pwm_pin'], cfg.get('frequency', 1000)),
+                leds=DigitalOutput(self.gpio, cfg.get('leds', []), initial=LOW),
+                **make_parts(cfg))
+            self.lamps.append(lamp)
+
+    def _session(self):
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def _weather(self):
+        from weather import WeatherProvider
+        return WeatherProvider(self.config['weather_key'], self.cache_dir, session=self._session())
+
+    def _parts(self, cfg):
+        from serial_reader import SerialReader
+        from uploader import ThingSpeakUploader
+        name = cfg['name']
+        reader = SerialReader([cfg['serial']], cfg.get('baudrate', 9600))
+        reader.start()
+        alarms = cfg.get('alarms')
+        rows = read_snapshot(alarms) if alarms and os.path.exists(alarms) else []
+        return {'reader': reader, 'alarms': AlarmSchedule(rows),
+                'uploader': ThingSpeakUploader(
+                    cfg['channel_id'], cfg['write_key'], session=self._session(),
+                    journal=os.path.join(self.cache_dir, 'ThingSpeak_Journal-%s.jsonl' % name)),
+                'history': TelemetryStore(os.path.join(self.cache_dir, 'history', name))}
+
+    def _each(self, func):
+        for lamp in self.lamps:
+            try:
+                func(lamp)
+            except Exception as e:
+                # One broken lamp must not stop the others
+                log.warning('Lamp %s %s failed: %s', lamp['name'], func.__name__, e)
+
+    def check_alarms(self):
+        self._each(lamp_control.check_alarms)
+
+    def adjust_brightness(self):
+        self._each(lamp_control.adjust_brightness)
+
+    def read_photoresistors(self):
+        if self.clock.localtime().tm_min==30:
+            return
+        self._each(lamp_control.read_photoresistor)
+
+    def apply_weather(self, json_data):
+        # One answer for every lamp, the provider is not asked again on the loop
+        def apply_weather(lamp):
+            lamp_control.apply_weather(lamp, json_data)
+        self._each(apply_weather)
+
+    async def read_weather(self):
+        json_data = await asyncio.get_running_loop().run_in_executor(self.executor, self.weather.get)
+        self.apply_weather(json_data)
+
+    def _flush(self, lamp):
+        # On the pool, cleared even when _upload() stopped waiting for it
+        try:
+            return lamp['uploader'].flush()
+        finally:
+            self._flushing.discard(lamp['name'])
+
+    async def _upload(self, lamp):
+        if lamp['name'] in self._flushing:
+            # As in AsyncLamp.upload, a hung flush is neither drained into
+            # nor overlapped by a second one
+            log.debug('Lamp %s previous upload still running, skipping this period', lamp['name'])
+            return
+        if not lamp['uploader'].drain():
+            return
+        self._flushing.add(lamp['name'])
+        flush = asyncio.get_running_loop().run_in_executor(self.executor, self._flush, lamp)
+        try:
+            await asyncio.wait_for(flush, self.upload_timeout)
+        except asyncio.TimeoutError:
+            IO_TIMEOUTS.labels('thingspeak').inc()
+            log.warning('Lamp %s thingspeak did not answer within %s s', lamp['name'], self.upload_timeout)
+        except Exception as e:
+            log.warning('Lamp %s upload failed: %s', lamp['name'], e)
+
+    async def upload(self):
+        await asyncio.gather(*(self._upload(lamp) for lamp in self.lamps))
+
+    async def every(self, period, offset, func):
+        async for _ in ticks(self.clock, period, offset):
+            try:
+                result = func()
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A failing job is retried next period, the other jobs keep running
+                log.warning('Job %s failed: %s', func.__name__, e)
+
+    async def run(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fleet-io')
+        log.info('Start Fleet Control, %d lamps', len(self.lamps))
+        try:
+            await asyncio.gather(
+                self.every(60, 1, self.check_alarms),
+                self.every(5, 0, self.adjust_brightness),
+                self.every(180, 0, self.read_photoresistors),
+                self.every(1800, 18*60, self.read_weather),
+                # ThingSpeak rate limit is per channel, one bulk update each
+                self.every(15, 0, self.upload))
+        finally:
+            self.close()
+            self.executor.shutdown(wait=False)
+
+    def close(self):
+        for lamp in self.lamps:
+            lamp['reader'].stop(timeout=2)
+            lamp['uploader'].stop()
+            lamp['history'].flush()
+        self.gpio.cleanup()
+
+
+def benchmark(sizes, hours=1):
+    """ CPU time and memory per lamp for fleets of mock lamps """
+    import contextlib
+    import io
+    import tempfile
+    import tracemalloc
+    from hal import MockBackend
+    from scheduler import FakeClock
+    from simulate import TraceReader, TraceWeather, load_traces
+    from uploader import ThingSpeakUploader
+
+    traces = load_traces(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ThingSpeak_Data.json'))
+    start = traces['light'].times[0]
+    print('%6s %14s %14s' % ('lamps', 'cpu ms/lamp/h', 'kB/lamp'))
+    for n in sizes:
+        tmp = tempfile.mkdtemp()
+        clock = FakeClock(wall=start)
+        tracemalloc.start()
+        config = {'lamps': [{'name': 'lamp%d' % i, 'serial': None, 'pwm_pin': 12,
+                             'leds': [38, 40], 'channel_id': i, 'write_key': 'key'}
+                            for i in range(n)]}
+
+        def parts(cfg):
+            return {'reader': TraceReader(traces['light'], clock, start),
+                    'alarms': AlarmSchedule([[8, 0, d] for d in range(7)]),
+                    'uploader': ThingSpeakUploader(cfg['channel_id'], 'key', session=object()),
+                    'history': TelemetryStore(os.path.join(tmp, cfg['name']))}
+
+        fleet = Fleet(config, backend=MockBackend(clock), clock=clock,
+                      weather=TraceWeather(traces, clock, start), make_parts=parts)
+        for lamp in fleet.lamps:
+            lamp['ramp'] = 0
+        cpu = time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for minute in range(int(hours * 60)):
+                clock.advance(60)
+                fleet.check_alarms()
+                fleet.adjust_brightness()
+                if minute % 3 == 0:
+                    fleet.read_photoresistors()
+                if minute % 30 == 18:
+                    fleet.apply_weather(fleet.weather.get())
+                if minute % 15 == 0:
+                    for lamp in fleet.lamps:
+                        lamp['uploader'].drain()
+        cpu = time.process_time() - cpu
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('%6d %14.3f %14.1f' % (n, cpu * 1000 / n / hours, memory / 1024 / n))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many smart lamps from one process')
+    parser.add_argument('config', nargs='?', help='fleet config json')
+    parser.add_argument('--backend', choices=['rpi', 'lgpio', 'mock'])
+    parser.add_argument('--benchmark', action='store_true',
+                        help='per-lamp cost with 1 to 100 mock lamps')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark([1, 10, 25, 50, 100])
+    elif args.config is None:
+        parser.error('a config file is needed')
+    else:
+        lamp_logging.configure()
+        try:
+            asyncio.run(Fleet(load_config(args.config), backend=args.backend).run())
+        except KeyboardInterrupt:
+            print('Exit Program')
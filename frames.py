@@ -0,0 +1,167 @@
+import binascii
+import struct
+
+# Binary frame sent by photoresistor.ino when BINARY_FRAMES is 1:
+#   sync 0xA5 | sequence u8 | samples u16 | ADC sum u32 | CRC-16 of bytes 1..7
+# Multi-byte fields are little endian, as the AVR stores them.
+SYNC = 0xA5
+FRAME = struct.Struct('<BBHIH')
+FRAME_SIZE = FRAME.size
+# The first sketch printed half of the mean ADC value. Readings keep that
+# scale, binary frames and the text of firmware 2 (the real mean) are
+# multiplied by it so every protocol feeds the same thresholds
+ASCII_SCALE = 0.5
+
+
+def crc16(data):
+    """ CRC-16/XMODEM (poly 0x1021, init 0), binascii computes it in C """
+    return binascii.crc_hqx(data, 0)
+
+
+def encode(seq, samples, total):
+    """ Build one frame, as the sketch does """
+    body = struct.pack('<BHI', seq & 0xFF, samples, total)
+    return bytes([SYNC]) + body + struct.pack('<H', crc16(body))
+
+
+class FrameDecoder:
+    """ Incremental decoder for the photoresistor byte stream.
+
+        Bytes are appended to one bytearray and frames are unpacked in
+        place through a memoryview. Frames with a bad CRC are skipped one
+        byte at a time until the stream is in sync again. With ``ascii``
+        enabled, text before a sync byte is parsed as the legacy
+        Serial.println() lines; 0xA5 never appears in that text.
+
+        feed() returns the readings decoded so far, lost counts frames
+        missing from the sequence numbers. Text lines starting with '#'
+        are replies to commands, they are collected in ``replies`` and
+        text readings are multiplied by ``text_scale``.
+    """
+
+    def __init__(self, ascii=True, max_line=64):
+        self.ascii = ascii
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.frames = 0
+        self.lines = 0
+        self.errors = 0
+        self.lost = 0
+        self.replies = []
+        self.text_scale = 1.0
+        self._seq = None
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        out = []
+        append = out.append
+        unpack_from = FRAME.unpack_from
+        crc16 = binascii.crc_hqx
+        view = memoryview(buf)
+        pos = 0
+        size = len(buf)
+        try:
+            while pos < size:
+                sync = buf.find(SYNC, pos)
+                if sync < 0:
+                    if self.ascii:
+                        pos = self._ascii(view, pos, size, out)
+                    else:
+                        pos = size
+                    break
+                if sync > pos:
+                    if self.ascii:
+                        pos = self._ascii(view, pos, sync, out)
+                        if pos < sync:
+                            # Unterminated text right before a frame is noise
+                            self.errors += 1
+                    pos = sync
+                if size - pos < FRAME_SIZE:
+                    break
+                _, seq, samples, total, crc = unpack_from(buf, pos)
+                if crc16(view[pos + 1:pos + FRAME_SIZE - 2], 0) != crc or samples == 0:
+                    self.errors += 1
+                    pos += 1
+                    continue
+                if self._seq is not None:
+                    self.lost += (seq - self._seq - 1) & 0xFF
+                self._seq = seq
+                self.frames += 1
+                append(total / samples * ASCII_SCALE)
+                pos += FRAME_SIZE
+        finally:
+            view.release()
+        del buf[:pos]
+        return out
+
+    def _ascii(self, view, start, end, out):
+        """ Parse complete text lines in view[start:end], returns the
+            position after the last one """
+        pos = start
+        while pos < end:
+            nl = self.buffer.find(b'\n', pos, end)
+            if nl < 0:
+                break
+            line = bytes(view[pos:nl])
+            if line.startswith(b'#'):
+                self.replies.append(line)
+                pos = nl + 1
+                continue
+            try:
+                out.append(float(line.split(None, 1)[0]) * self.text_scale)
+                self.lines += 1
+            except (ValueError, IndexError):
+                if line.strip():
+                    self.errors += 1
+            pos = nl + 1
+        if end - pos > self.max_line:
+            self.errors += 1
+            pos = end
+        return pos
+
+
+def decode_ascii(data):
+    """ The legacy decoder, one float per line, for comparison """
+    out = []
+    for line in data.split(b'\n'):
+        try:
+            out.append(float(line.decode('utf-8').rstrip()))
+        except ValueError:
+            pass
+    return out
+
+
+if __name__ == '__main__':
+    # Throughput of both decoders on the same readings, fed in 64 byte reads
+    import random
+    import time
+
+    random.seed(0)
+    readings = [random.randrange(200, 250 * 1023) for _ in range(200000)]
+    ascii_stream = b''.join(b'%.2f\r\n' % (r / 500) for r in readings)
+    binary_stream = b''.join(encode(i, 250, r) for i, r in enumerate(readings))
+
+    def run(stream, decode):
+        start = time.perf_counter()
+        n = 0
+        for i in range(0, len(stream), 64):
+            n += len(decode(stream[i:i + 64]))
+        return n, time.perf_counter() - start
+
+    line_buffer = bytearray()
+
+    def legacy(chunk):
+        global line_buffer
+        line_buffer += chunk
+        end = line_buffer.rfind(b'\n') + 1
+        out = decode_ascii(bytes(line_buffer[:end]))
+        del line_buffer[:end]
+        return out
+
+    for name, stream, decode in (('ascii readline', ascii_stream, legacy),
+                                 ('ascii decoder', ascii_stream, FrameDecoder().feed),
+                                 ('binary decoder', binary_stream, FrameDecoder(ascii=False).feed)):
+        n, elapsed = run(stream, decode)
+        print('%-15s %7d readings %8.1f kB %9.0f readings/s'
+              % (name, n, len(stream) / 1024, n / elapsed))
@@ -0,0 +1,281 @@
+import threading
+import time
+
+import metrics
+from lamp_logging import get_logger
+
+LOW = 0
+HIGH = 1
+
+# Physical header pin -> BCM gpio number, for backends that only speak BCM
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22,
+                16: 23, 18: 24, 19: 10, 21: 9, 22: 25, 23: 11, 24: 8, 26: 7,
+                27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16,
+                37: 26, 38: 20, 40: 21}
+
+
+log = get_logger('control')
+
+PWM_CHANGES = metrics.counter('lamp_pwm_changes_total', 'PWM duty cycle writes', ('pin',))
+
+
+class BackendError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+class RPiGPIOBackend:
+    """ RPi.GPIO with BOARD pin numbering, as the lamp always used """
+
+    name = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as IO
+        self.IO = IO
+        IO.setwarnings(False)
+        IO.setmode(IO.BOARD)
+        self.pwms = {}
+
+    def setup_output(self, pin, initial=LOW):
+        self.IO.setup(pin, self.IO.OUT, initial=initial)
+
+    def write(self, pin, level):
+        self.IO.output(pin, level)
+
+    def pwm_start(self, pin, frequency, duty):
+        self.IO.setup(pin, self.IO.OUT)
+        pwm = self.pwms[pin] = self.IO.PWM(pin, frequency)
+        pwm.start(duty)
+
+    def pwm_duty(self, pin, duty):
+        self.pwms[pin].ChangeDutyCycle(duty)
+
+    def cleanup(self):
+        for pwm in self.pwms.values():
+            pwm.stop()
+        self.IO.cleanup()
+
+
+class LgpioBackend:
+    """ lgpio (Pi 5 and newer kernels), pins are given in BOARD numbering """
+
+    name = 'lgpio'
+
+    def __init__(self, chip=0):
+        import lgpio
+        self.lgpio = lgpio
+        try:
+            self.handle = lgpio.gpiochip_open(chip)
+        except lgpio.error as e:
+            raise RuntimeError("Cannot open gpiochip%d: %s" % (chip, e))
+        self.frequency = {}
+
+    def _gpio(self, pin):
+        try:
+            return BOARD_TO_BCM[pin]
+        except KeyError:
+            raise BackendError("Pin %s is not a gpio header pin" % pin)
+
+    def setup_output(self, pin, initial=LOW):
+        self.lgpio.gpio_claim_output(self.handle, self._gpio(pin), initial)
+
+    def write(self, pin, level):
+        self.lgpio.gpio_write(self.handle, self._gpio(pin), level)
+
+    def pwm_start(self, pin, frequency, duty):
+        self.setup_output(pin)
+        self.frequency[pin] = frequency
+        self.pwm_duty(pin, duty)
+
+    def pwm_duty(self, pin, duty):
+        self.lgpio.tx_pwm(self.handle, self._gpio(pin), self.frequency[pin], duty)
+
+    def cleanup(self):
+        for pin in self.frequency:
+            self.lgpio.tx_pwm(self.handle, self._gpio(pin), 0, 0)
+        self.lgpio.gpiochip_close(self.handle)
+
+
+class MockBackend:
+    """ In-memory backend recording every write.
+
+        history maps pin -> [(time, value)], writes counts writes per pin.
+
+        :param clock: object with a time() method (e.g. scheduler.FakeClock),
+            defaults to the real clock
+    """
+
+    name = 'mock'
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.history = {}
+        self.writes = {}
+        self.frequency = {}
+
+    def _record(self, pin, value):
+        t = self.clock.time() if self.clock is not None else time.time()
+        self.history.setdefault(pin, []).append((t, value))
+        self.writes[pin] = self.writes.get(pin, 0) + 1
+
+    def setup_output(self, pin, initial=LOW):
+        self._record(pin, initial)
+
+    def write(self, pin, level):
+        self._record(pin, level)
+
+    def pwm_start(self, pin, frequency, duty):
+        self.frequency[pin] = frequency
+        self._record(pin, duty)
+
+    def pwm_duty(self, pin, duty):
+        self._record(pin, duty)
+
+    def value(self, pin):
+        history = self.history.get(pin)
+        return history[-1][1] if history else None
+
+    def cleanup(self):
+        pass
+
+
+BACKENDS = {'rpi': RPiGPIOBackend, 'lgpio': LgpioBackend, 'mock': MockBackend}
+
+
+def open_backend(name=None, **options):
+    """ Open the named backend, or the first one importable on this machine
+        (RPi.GPIO, then lgpio, then mock) """
+    if name is not None:
+        try:
+            backend = BACKENDS[name]
+        except KeyError:
+            raise BackendError("Unknown GPIO backend %r" % name)
+        return backend(**options)
+    for backend in (RPiGPIOBackend, LgpioBackend):
+        try:
+            return backend(**options)
+        except (ImportError, RuntimeError):
+            continue
+    log.warning('No GPIO library found, using mock outputs')
+    return MockBackend(**options)
+
+
+class DigitalOutput:
+    """ Group of output pins written together, unchanged levels are not written """
+
+    def __init__(self, backend, pins, initial=LOW):
+        self.backend = backend
+        self.pins = list(pins)
+        self.levels = [initial] * len(self.pins)
+        for pin in self.pins:
+            backend.setup_output(pin, initial)
+
+    def set(self, levels):
+        """ One level per pin, or a single level for all of them """
+        if not isinstance(levels, (list, tuple)):
+            levels = [levels] * len(self.pins)
+        for i, (pin, level) in enumerate(zip(self.pins, levels)):
+            if self.levels[i] != level:
+                self.backend.write(pin, level)
+                self.levels[i] = level
+
+
+class PWMOutput:
+    """ PWM pin whose duty cycle is only written when it changes.
+
+        ramp() moves to a new duty cycle in small steps on a background
+        thread; a later set() or ramp() cancels a ramp in progress.
+    """
+
+    def __init__(self, backend, pin, frequency=1000, duty=0):
+        self.backend = backend
+        self.pin = pin
+        self.duty = duty
+        self._lock = threading.RLock()
+        self._ramp = None
+        self._changes = PWM_CHANGES.labels(pin)
+        backend.pwm_start(pin, frequency, duty)
+
+    def _write(self, duty, cancel=None):
+        """ Write ``duty`` unless ``cancel`` (a ramp's) is set, checked under
+            the lock so a set() between the check and the write wins """
+        with self._lock:
+            if cancel is not None and cancel.is_set():
+                return False
+            if duty != self.duty:
+                self.backend.pwm_duty(self.pin, duty)
+                self.duty = duty
+                self._changes.inc()
+            return True
+
+    def _cancel_ramp(self):
+        ramp = self._ramp
+        if ramp is not None:
+            ramp[0].set()
+            self._ramp = None
+
+    def set(self, duty):
+        with self._lock:
+            self._cancel_ramp()
+            self._write(duty)
+
+    def ramp(self, duty, duration=1.0, step=0.05):
+        """ Fade to ``duty`` over ``duration`` seconds, one write per ``step`` """
+        with self._lock:
+            self._cancel_ramp()
+            start = self.duty
+            if duration <= 0:
+                self._write(duty)
+                return
+            if start == duty:
+                return
+            steps = max(int(duration / step), 1)
+            cancel = threading.Event()
+
+            def fade():
+                for i in range(1, steps + 1):
+                    if cancel.wait(step):
+                        return
+                    if not self._write(round(start + (duty - start) * i / steps, 1), cancel):
+                        return
+
+            thread = threading.Thread(target=fade, name='pwm-ramp-%s' % self.pin, daemon=True)
+            self._ramp = (cancel, thread)
+            thread.start()
+
+    def wait(self, timeout=None):
+        """ Block until a running ramp has finished, for tests """
+        ramp = self._ramp
+        if ramp is not None:
+            ramp[1].join(timeout)
+            return not ramp[1].is_alive()
+        return True
+
+
+class PWMGroup:
+    """ PWM outputs of several zones driven as one, for alarms and night.
+
+        duty is the brightest output's, each PWMOutput is still reachable
+        in ``outputs`` to be set on its own.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+
+    @property
+    def duty(self):
+        return max(output.duty for output in self.outputs)
+
+    def set(self, duty):
+        for output in self.outputs:
+            output.set(duty)
+
+    def ramp(self, duty, duration=1.0, step=0.05):
+        for output in self.outputs:
+            output.ramp(duty, duration, step)
+
+    def wait(self, timeout=None):
+        return all([output.wait(timeout) for output in self.outputs])
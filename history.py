@@ -0,0 +1,237 @@
+import bisect
+import mmap
+import os
+import time
+from array import array
+
+
+class HistoryError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+class _Segment:
+    """ Read-only view of one segment file of interleaved (time, value) doubles """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.count = os.fstat(f.fileno()).st_size // 16
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m).cast('d')
+                self.first = view[0]
+                self.last = view[2 * self.count - 2]
+                view.release()
+
+    def query(self, start, end):
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m).cast('d')
+            times = view[0::2]
+            lo = bisect.bisect_left(times, start)
+            hi = bisect.bisect_left(times, end)
+            result = view[2 * lo:2 * hi].tolist()
+            times.release()
+            view.release()
+        return result[0::2], result[1::2]
+
+
+class Series:
+    """ One numeric time series.
+
+        Samples go to a fixed size in-memory chunk of typed arrays. A full
+        chunk is written as a segment file (read back through mmap) and
+        folded into min/max/mean rollups. Raw segments older than
+        ``retention`` seconds are deleted, rollups are kept.
+
+        A chunk takes days to fill at the lamp's sample rates, so every
+        ``flush_interval`` seconds the samples added since are appended to
+        an open chunk file, loaded again after a restart or crash.
+    """
+
+    def __init__(self, directory, name, chunk_size=4096, rollup=3600,
+                 retention=7 * 24 * 3600, flush_interval=300):
+        self.directory = directory
+        self.name = name
+        self.chunk_size = chunk_size
+        self.rollup = rollup
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.times = array('d')
+        self.values = array('d')
+        self.segments = []
+        # Rollup rows: bucket start, min, max, sum, count
+        self.rollups = array('d')
+        self.rollup_file = os.path.join(directory, '%s.rollup' % name)
+        self.open_file = os.path.join(directory, '%s.open' % name)
+        self._flushed = 0 # samples of the chunk already in open_file
+        self._flushed_at = time.monotonic()
+        self._load()
+
+    def _load(self):
+        prefix = self.name + '-'
+        for fname in os.listdir(self.directory):
+            if fname.startswith(prefix) and fname.endswith('.seg'):
+                path = os.path.join(self.directory, fname)
+                if os.path.getsize(path) >= 16:
+                    self.segments.append(_Segment(path))
+        self.segments.sort(key=lambda s: s.first)
+        if os.path.exists(self.rollup_file):
+            with open(self.rollup_file, 'rb') as f:
+                data = f.read()
+            self.rollups.frombytes(data[:len(data) // 40 * 40])
+        if os.path.exists(self.open_file):
+            with open(self.open_file, 'rb') as f:
+                data = f.read()
+            pairs = array('d', data[:len(data) // 16 * 16])
+            # A crash between writing a segment and removing the open file
+            # leaves samples that are in both
+            last = self.segments[-1].last if self.segments else float('-inf')
+            for t, v in zip(pairs[0::2], pairs[1::2]):
+                if t > last:
+                    self.times.append(t)
+                    self.values.append(v)
+            if 2 * len(self.times) == len(pairs):
+                self._flushed = len(self.times)
+            else:
+                os.remove(self.open_file) # written again in full by the next flush
+
+    def append(self, value, t=None):
+        if t is None:
+            t = time.time()
+        self.times.append(t)
+        self.values.append(value)
+        if len(self.times) >= self.chunk_size:
+            self.roll()
+        elif time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Append the samples added since the last flush to the open chunk file """
+        self._flushed_at = time.monotonic()
+        n = len(self.times) - self._flushed
+        if n <= 0:
+            return
+        pairs = array('d', bytes(16 * n))
+        pairs[0::2] = self.times[self._flushed:]
+        pairs[1::2] = self.values[self._flushed:]
+        with open(self.open_file, 'ab') as f:
+            if f.tell() != 16 * self._flushed:
+                f.truncate(16 * self._flushed) # torn write of a previous flush
+            pairs.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._flushed = len(self.times)
+
+    def __len__(self):
+        return sum(s.count for s in self.segments) + len(self.times)
+
+    def roll(self):
+        """ Write the in-memory chunk to a segment file and update rollups """
+        if not self.times:
+            return
+        pairs = array('d', bytes(16 * len(self.times)))
+        pairs[0::2] = self.times
+        pairs[1::2] = self.values
+        path = os.path.join(self.directory, '%s-%.6f.seg' % (self.name, self.times[0]))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pairs.tofile(f)
+        os.replace(tmp, path)
+        self.segments.append(_Segment(path))
+        if os.path.exists(self.open_file):
+            os.remove(self.open_file)
+        self._fold(self.times, self.values)
+        self.times = array('d')
+        self.values = array('d')
+        self._flushed = 0
+        self._expire()
+
+    def _fold(self, times, values):
+        rows = self.rollups
+        rewrite_from = len(rows) // 5
+        for t, v in zip(times, values):
+            bucket = t - t % self.rollup
+            if rows and rows[-5] == bucket:
+                rows[-4] = min(rows[-4], v)
+                rows[-3] = max(rows[-3], v)
+                rows[-2] += v
+                rows[-1] += 1
+            else:
+                rows.extend((bucket, v, v, v, 1))
+        # The last bucket may have been updated in place, rewrite from there
+        rewrite_from = max(rewrite_from - 1, 0)
+        with open(self.rollup_file, 'r+b' if os.path.exists(self.rollup_file) else 'wb') as f:
+            f.seek(rewrite_from * 40)
+            rows[rewrite_from * 5:].tofile(f)
+            f.truncate()
+
+    def _expire(self, now=None):
+        if now is None:
+            now = time.time()
+        while self.segments and self.segments[0].last < now - self.retention:
+            os.remove(self.segments.pop(0).path)
+
+    def range(self, start, end):
+        """ Raw samples with start <= t < end as (times, values) lists """
+        times, values = [], []
+        for seg in self.segments:
+            if seg.last < start or seg.first >= end:
+                continue
+            t, v = seg.query(start, end)
+            times.extend(t)
+            values.extend(v)
+        lo = bisect.bisect_left(self.times, start)
+        hi = bisect.bisect_left(self.times, end)
+        times.extend(self.times[lo:hi])
+        values.extend(self.values[lo:hi])
+        return times, values
+
+    def summary(self, start, end):
+        """ Rolled up buckets in [start, end) as (bucket, min, max, mean) rows.
+            Samples still in memory are not rolled up yet """
+        rows = self.rollups
+        starts = rows[0::5]
+        lo = bisect.bisect_left(starts, start - start % self.rollup)
+        hi = bisect.bisect_left(starts, end)
+        return [(rows[5 * i], rows[5 * i + 1], rows[5 * i + 2], rows[5 * i + 3] / rows[5 * i + 4])
+                for i in range(lo, hi)]
+
+    def latest(self):
+        if self.values:
+            return self.times[-1], self.values[-1]
+        if self.segments:
+            t, v = self.segments[-1].query(self.segments[-1].last, float('inf'))
+            return t[-1], v[-1]
+        return None
+
+
+class TelemetryStore:
+    """ Bounded history of the lamp's numeric readings, one Series per name """
+
+    def __init__(self, directory, **options):
+        self.directory = directory
+        self.options = options
+        self.series = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __getitem__(self, name):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = Series(self.directory, name, **self.options)
+        return series
+
+    def append(self, name, value, t=None):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise HistoryError("%s value %r is not a number" % (name, value))
+        self[name].append(float(value), t)
+
+    def range(self, name, start, end):
+        return self[name].range(start, end)
+
+    def flush(self):
+        """ Persist the open chunk of every series, on shutdown """
+        for series in self.series.values():
+            series.flush()
@@ -0,0 +1,363 @@
+import itertools
+import logging
+import time
+from datetime import datetime
+
+from daylight import plan_day
+from hal import HIGH, LOW
+from lamp_logging import get_logger
+from light_filter import BrightnessControl, LightFilter
+import metrics
+from scheduler import Scheduler
+from supervisor import WorkerThread
+
+
+class NoDataRead(Exception):
+    def __init__(self, data):
+        self.data = data
+        
+    def __str__(self):
+        return repr(self.data)
+    
+class MappingError(Exception):
+    def __init__(self, data):
+        self.data = data
+        
+    def __str__(self):
+        return repr(self.data)
+
+
+# Photoresistor samples averaged per reading and how old they may be (seconds)
+SAMPLE_WINDOW = 20
+SAMPLE_MAX_AGE = 60
+
+log = get_logger('control')
+alarm_log = get_logger('alarms')
+weather_log = get_logger('weather')
+upload_log = get_logger('upload')
+
+SAMPLES_PER_READ = metrics.histogram('lamp_samples_per_read', 'Photoresistor samples in one reading',
+                                     buckets=(0, 1, 2, 5, 10, 15, 20))
+
+
+def average(voltage_values):
+    try:
+        if len(voltage_values)==0:
+            raise NoDataRead("No data was read from the SPI")
+    except NoDataRead as e:
+        log.warning('Received error: %s. Check connection to SPI device', e.data)
+        return
+    return int(sum(voltage_values)/len(voltage_values))
+
+
+def mapping(input_start, input_end, output_start, output_end, voltage):
+    output =  output_start + ((output_end - output_start) / (input_end - input_start)) * (voltage - input_start)
+    try:
+        if not (output_start<=output<=output_end):
+            raise MappingError("Mapped value is not within the desired range")
+    except NoDataRead as e:
+        log.warning('Received error: %s', e.data)
+        # Try again
+        output = mapping(input_start, input_end, output_start, output_end, voltage)
+        if not output_start<=output<=output_end:
+            log.warning('Error in bounds')
+            return
+    return output
+
+def photoresistor_Range(value):
+    # Room Light is Minimum
+    if 0<=value<=33:
+        value = 100
+        log.debug("Set Led to High")
+        
+    # Room Light is Medium
+    elif 33<value<=66:
+        value = 50
+        log.debug("Set Led to Medium")
+        
+    # Room Light is Medium/High
+    elif 66<value<=100:
+        value = 0
+        log.debug("Set Led to Off")
+        
+    return value
+
+def checkDuplicates(list1):
+    flag = 0
+    list1.sort()
+    new_list = list(i for i,_ in itertools.groupby(list1))
+    if len(new_list) != len(list1):
+        flag=1
+        return new_list, flag
+    else:   
+        return new_list, flag
+
+def setup_weatherAPI(provider):
+    # Cached, only hits the network when the last answer is older than its ttl
+    json_data = provider.get()
+    if json_data is None:
+        weather_log.warning('Invalid API Key. Please try again!')
+    return json_data
+
+def get_weather_data(data):
+    if not data:
+        weather_log.warning('No weather data. Please try again later')
+        return None
+    try:
+        if data['weather']:
+            weather_data = {}
+            try:
+                temperature = round(data['main']['feels_like']-273.15, 2)
+                weather_data['temperature'] = temperature
+            except KeyError as e:
+                weather_data['temperature'] = 'No data'
+                weather_log.warning('No data found for: %r', e.args[0])
+                pass
+                
+            try:
+                clouds = data['clouds']['all']
+                weather_data['clouds'] = clouds
+            except KeyError as e:
+                weather_data['clouds'] = "No data"
+                weather_log.warning('No data found for: %r', e.args[0])
+                pass
+            
+            try: 
+                description = data['weather'][0]['description']
+                weather_data['description'] = description
+            except KeyError as e:
+                weather_data['description'] = 'No data'
+                weather_log.warning('No data found for: %r', e.args[0])
+                pass
+            
+            try: 
+                rain= data['rain']['1h']
+                weather_data['rain'] = rain                
+            except KeyError as e:
+                weather_data['rain'] = 0
+                weather_log.debug('No data found for: %r', e.args[0]) 
+                pass
+            
+            try: 
+                snow= data['snow']['1h']
+                weather_data['snow'] = snow                
+            except KeyError as e:
+                weather_data['snow'] = 0
+                weather_log.debug('No data found for: %r', e.args[0])                    
+                pass
+            
+            try: 
+                sunrise_time = [time.localtime(data['sys']['sunrise']).tm_hour,
+                                                   time.localtime(data['sys']['sunrise']).tm_min]
+                weather_data['sunrise'] = sunrise_time
+                                               
+            except KeyError as e:
+                weather_log.warning('No data found for: %r', e.args[0])
+                pass
+                
+            try: 
+                sunset_time = [time.localtime(data['sys']['sunset']).tm_hour,
+                                               time.localtime(data['sys']['sunset']).tm_min]
+                weather_data['sunset'] = sunset_time
+            
+            except KeyError as e:
+                weather_log.warning('No data found for: %r', e.args[0])
+                
+            return weather_data
+            
+    except KeyError:
+        weather_log.warning('No data found. Please try again later')
+
+def sendData(uploader, flag, val_int, *data):
+    # Readings are queued, the uploader thread handles rate limit and retries
+    if upload_log.isEnabledFor(logging.DEBUG):
+        upload_log.debug('Current Time = %s', datetime.now().strftime("%H:%M:%S"))
+
+    fields = {'field5': round(val_int*5/1023, 2)}
+    if flag !=0:
+        data = data[0]
+        upload_log.debug('Weather fields %s', data)
+        for field, key in (('field1', 'temperature'), ('field2', 'clouds'),
+                           ('field3', 'rain'), ('field4', 'snow')):
+            # 'No data' strings are left out of the update
+            if not isinstance(data[key], str):
+                fields[field] = data[key]
+    uploader.submit(fields)
+
+def check_alarms(lamp):
+    now = lamp['clock'].localtime()
+    alarm = lamp['alarms'].active(now)
+
+    if alarm is not None and lamp['active_flag']==0:
+        lamp['active_flag']=1
+        lamp['light_flag'] = 1
+        alarm_log.info('Lights On! Activate Alarm Hour: %d Min: %d Stay Active for 10 Min %s',
+                       now.tm_hour, now.tm_min, alarm)
+        lamp['pwm'].set(100)
+
+    elif alarm is None and lamp['active_flag']==1:
+        alarm_log.info('Alarm Deactivated At Hour: %d Min: %d', now.tm_hour, now.tm_min)
+        lamp['light_flag']=0
+        lamp['active_flag']=0
+
+def read_photoresistor(lamp):
+    if lamp['clock'].localtime().tm_min==30:
+        return
+
+    log.debug('Reading Photoresistor')
+    # Latest samples from the background serial reader, at most one read window old
+    ph_voltage = lamp['reader'].window(SAMPLE_WINDOW, max_age=SAMPLE_MAX_AGE)
+    SAMPLES_PER_READ.observe(len(ph_voltage))
+
+    if len(ph_voltage) > 0:
+        average_voltage = average(ph_voltage) # Average the read values
+        lamp['average_voltage'] = average_voltage
+        sendData(lamp['uploader'], 0, average_voltage)
+        lamp['history'].append('photoresistor', round(average_voltage*5/1023,2))
+
+
+def adjust_brightness(lamp):
+    lamp['heartbeat'] = time.monotonic() # Watched by the supervisor
+    if lamp['plan'] is not None:
+        return follow_plan(lamp)
+    if lamp['zones'] is not None:
+        return adjust_zones(lamp)
+    # Every new sample goes through the filter, the PWM follows within seconds
+    values, lamp['samples_seen'] = lamp['reader'].since(lamp['samples_seen'])
+    light_filter = lamp['light_filter']
+    for value in values:
+        light_filter.update(value)
+    if light_filter.estimate is None:
+        return
+
+    # PWM Of LED
+    hour = lamp['clock'].localtime().tm_hour
+    if lamp['light_flag']==0 and (not hour==23 and not 0<=hour<6):
+        dc_value = lamp['brightness'].update(light_filter.estimate)
+        lamp['pwm'].ramp(dc_value, lamp['ramp']) # Fade instead of jumping between levels
+
+    elif lamp['light_flag']==0: # Night, unless an alarm holds the light on
+        lamp['pwm'].set(0)
+
+def adjust_zones(lamp):
+    # New sample rows are fused into one level per zone, each zone dims its own output
+    rows, lamp['samples_seen'] = lamp['reader'].since_rows(lamp['samples_seen'])
+    zones = lamp['zones']
+    zones.update(rows)
+
+    hour = lamp['clock'].localtime().tm_hour
+    if lamp['light_flag']==0 and (not hour==23 and not 0<=hour<6):
+        for zone in zones:
+            if zone.light_filter.estimate is not None:
+                zone.pwm.ramp(zone.brightness.update(zone.light_filter.estimate), lamp['ramp'])
+
+    elif lamp['light_flag']==0: # Night, unless an alarm holds the light on
+        lamp['pwm'].set(0)
+
+def follow_plan(lamp):
+    # Duty cycle from the daylight plan, the sensor only corrects it every plan_check seconds
+    clock = lamp['clock']
+    now = clock.localtime()
+    minute = now.tm_hour*60 + now.tm_min
+    plan = lamp['plan']
+
+    checked = lamp['plan_checked']
+    if checked is None or clock.monotonic() - checked >= lamp['plan_check']:
+        ph_voltage = lamp['reader'].window(SAMPLE_WINDOW, max_age=SAMPLE_MAX_AGE)
+        if len(ph_voltage) > 0:
+            plan.correct(minute, sum(ph_voltage)/len(ph_voltage))
+            lamp['plan_checked'] = clock.monotonic()
+
+    hour = now.tm_hour
+    if lamp['light_flag']!=0: # An alarm holds the light on
+        return
+    if hour==23 or 0<=hour<6:
+        lamp['pwm'].set(0)
+    elif plan.duty(minute) != lamp['pwm'].duty:
+        lamp['pwm'].ramp(plan.duty(minute), lamp['ramp'])
+
+def update_plan(lamp, weather_data):
+    # Rebuilt with every weather reading, the drift correction learned so far is kept
+    gain = lamp['plan'].gain if lamp['plan'] is not None else 1.0
+    plan = plan_day(weather_data, lamp['history'], lamp['brightness'], gain)
+    if plan is not None:
+        lamp['plan'] = plan
+
+def read_weather(lamp):
+    weather_log.debug('Get Weather Data')
+    apply_weather(lamp, setup_weatherAPI(lamp['weather']))
+
+def apply_weather(lamp, json_data):
+    # LEDs, upload, plan and history from an answer fetched elsewhere, e.g. off the event loop
+    weather_data = get_weather_data(json_data)
+    if weather_data is None:
+        return # Nothing cached yet and the API is down, retried next period
+    leds = lamp['leds']
+
+    if isinstance(weather_data['temperature'], str):
+        weather_log.info('Temperature not available')
+
+    elif weather_data['temperature']<=10:
+        weather_log.info('Temperature Very Cold')
+        leds.set([LOW, HIGH])
+
+    elif 10<weather_data['temperature']<=20:
+        weather_log.info('Temperature Cold')
+        leds.set([HIGH, LOW])
+
+    elif 20<weather_data['temperature']<=30:
+        weather_log.info('Temperature Mild')
+        leds.set([LOW, HIGH])
+
+    elif weather_data['temperature']>30:
+        weather_log.info('Temperature Hot')
+        leds.set(HIGH)
+
+    sendData(lamp['uploader'], 1, lamp['average_voltage'], weather_data)
+    if lamp['planning']:
+        update_plan(lamp, weather_data)
+
+    for key, value in weather_data.items():
+        if key in ('sunrise', 'sunset'):
+            value = value[0]*60 + value[1] # Minute of the day
+        if isinstance(value, (int, float)):
+            lamp['history'].append(key, value)
+
+def new_lamp(**parts):
+    # State shared by the jobs of one lamp, parts are its outputs and clients
+    lamp = {'average_voltage': 0, 'light_flag': 0, 'active_flag': 0, 'ramp': 1.0,
+            'arduino_lb': 0, 'arduino_ub': 500, 'dc_lb': 0, 'dc_up': 100,
+            'samples_seen': 0, 'adjust_interval': 5, 'light_filter': LightFilter(),
+            'planning': False, 'plan': None, 'plan_check': 300, 'plan_checked': None,
+            'heartbeat': None, 'zones': None}
+    lamp.update(parts)
+    if 'brightness' not in lamp:
+        lamp['brightness'] = BrightnessControl(lamp['arduino_lb'], lamp['arduino_ub'])
+    return lamp
+
+def schedule_jobs(scheduler, lamp):
+    # Alarms are checked at second 1 of every minute, brightness every few
+    # seconds, photoresistor logging every 3 min and the weather at :18 and :48
+    scheduler.every(lamp['adjust_interval'], lambda: adjust_brightness(lamp), name='brightness')
+    if hasattr(lamp['alarms'], 'reload'):
+        # Alarm edits from other processes, two stat calls when nothing changed
+        scheduler.every(5, lamp['alarms'].reload, name='alarm-reload')
+    scheduler.every(60, lambda: check_alarms(lamp), name='alarms',
+                    delay=scheduler.seconds_until(60, 1))
+    scheduler.every(180, lambda: read_photoresistor(lamp), name='photoresistor',
+                    delay=scheduler.seconds_until(180))
+    scheduler.every(1800, lambda: read_weather(lamp), name='weather',
+                    delay=scheduler.seconds_until(1800, 18*60))
+
+def start_control(lamp, runtime='async'):
+    # The jobs on a thread of their own, so the supervisor can restart them
+    if runtime == 'async':
+        from runtime import AsyncLamp
+        control = AsyncLamp(lamp)
+        worker = WorkerThread(control.serve, 'control', stop=control.stop)
+    else:
+        control = Scheduler()
+        schedule_jobs(control, lamp)
+        worker = WorkerThread(control.run, 'control', stop=control.stop)
+    worker.start()
+    return worker
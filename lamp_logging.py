@@ -0,0 +1,267 @@
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+from collections import deque
+
+# Subsystems log to 'lamp.<name>', their levels are set with configure()
+SUBSYSTEMS = ('control', 'alarms', 'weather', 'upload', 'serial', 'runtime', 'supervisor')
+CONSOLE_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+
+def get_logger(subsystem):
+    return logging.getLogger('lamp.' + subsystem)
+
+
+class RateLimit(logging.Filter):
+    """ Lets ``burst`` copies of a message through per ``interval`` seconds.
+
+        Messages are the same when logger, format and arguments are. The
+        first one passing after a quiet spell carries the number dropped
+        in between as ``record.suppressed``.
+    """
+
+    def __init__(self, burst=5, interval=60, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        self._seen = {}
+        # Every logging thread runs the filter, counts must not be lost
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        try:
+            key = (record.name, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            key = (record.name, record.msg)
+        with self._lock:
+            now = self.clock()
+            window, count, dropped = self._seen.get(key, (now, 0, 0))
+            if now - window >= self.interval:
+                window, count = now, 0
+            if count >= self.burst:
+                self._seen[key] = (window, count, dropped + 1)
+                return False
+            if dropped:
+                record.suppressed = dropped
+            self._seen[key] = (window, count + 1, 0)
+            if len(self._seen) > 4096:
+                # Keys of one-off messages, forget the stale ones
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+                if len(self._seen) > 2048:
+                    self._seen.clear() # All fresh, start counting over
+        return True
+
+
+class _QueueHandler(logging.Handler):
+    """ Appends records to a deque for the Writer, nothing is formatted or
+        written on the caller's thread and no thread is woken up.
+        Arguments are read later, log values and not objects that change """
+
+    def __init__(self, records, limit):
+        super().__init__()
+        self.records = records
+        self.limit = limit
+        self.dropped = 0
+
+    def handle(self, record):
+        # deque.append is atomic, no handler lock needed
+        if not self.filter(record):
+            return False
+        if len(self.records) < self.limit:
+            self.records.append(record)
+        else:
+            self.dropped += 1
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+class Writer(threading.Thread):
+    """ Drains the queue every ``interval`` seconds into the handlers """
+
+    def __init__(self, records, handlers, interval=0.1):
+        super().__init__(name='log-writer', daemon=True)
+        self.records = records
+        self.handlers = handlers
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def drain(self):
+        records = self.records
+        while records:
+            record = records.popleft()
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.drain()
+        self.drain()
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        self.drain() # Anything logged after the last pass
+
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            text += ' (%d repeats suppressed)' % record.suppressed
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, ``extra={'fields': {...}}`` adds keys """
+
+    def format(self, record):
+        entry = {'t': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage()}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        fields = getattr(record, 'fields', None)
+        if isinstance(fields, dict):
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_levels(spec):
+    """ 'info,weather=debug,serial=warning' -> {'': 'INFO', 'weather': 'DEBUG', ...} """
+    levels = {}
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        name, _, level = part.rpartition('=')
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError('Unknown log level %r' % level)
+        if name and name not in SUBSYSTEMS:
+            raise ValueError('Unknown subsystem %r, one of %s' % (name, ', '.join(SUBSYSTEMS)))
+        levels[name] = level
+    return levels
+
+
+_writer = None
+
+
+def configure(path=None, levels=None, console=True, max_bytes=1 << 20, backups=3,
+              burst=5, interval=60, queue_size=10000, stream=None):
+    """ Route the 'lamp' loggers through a queue to a background writer.
+
+        Callers pay for a record and an append to a deque, the writer
+        thread formats the records a few times a second and writes the
+        console and, with ``path``, a size rotated JSON-lines file. A full
+        queue drops records rather than blocking the control loop.
+
+        :param levels: parse_levels() output or its string, default INFO
+    """
+    global _writer
+    shutdown()
+    if isinstance(levels, str) or levels is None:
+        levels = parse_levels(levels or 'info')
+    root = logging.getLogger('lamp')
+    root.setLevel(levels.get('', 'INFO'))
+    for name in SUBSYSTEMS:
+        get_logger(name).setLevel(levels.get(name, logging.NOTSET))
+    handlers = []
+    if console:
+        console = logging.StreamHandler(stream or sys.stdout)
+        console.setFormatter(ConsoleFormatter(CONSOLE_FORMAT))
+        handlers.append(console)
+    if path:
+        rotating = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                        backupCount=backups, encoding='utf-8')
+        rotating.setFormatter(JsonFormatter())
+        handlers.append(rotating)
+    records = deque()
+    handler = _QueueHandler(records, queue_size)
+    handler.addFilter(RateLimit(burst, interval))
+    root.handlers[:] = [handler]
+    root.propagate = False
+    _writer = Writer(records, handlers)
+    _writer.start()
+    atexit.register(shutdown)
+    return _writer
+
+
+def shutdown():
+    """ Write what is queued and stop the writer thread """
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        for handler in _writer.handlers:
+            handler.close()
+        _writer = None
+
+
+class _SlowStream:
+    """ stdout of a unit whose journal or SD card is busy, a flush takes ``delay`` s """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.written = 0
+
+    def write(self, text):
+        self.written += len(text)
+
+    def flush(self):
+        time.sleep(self.delay)
+
+
+def benchmark(number=2000, pace=0.001, delay=0.0005):
+    """ Time the control loop spends per log call, one call every ``pace``
+        seconds while every write to stdout stalls for ``delay`` seconds """
+
+    def timed(func):
+        times = []
+        for i in range(number):
+            start = time.perf_counter()
+            func(i)
+            times.append(time.perf_counter() - start)
+            time.sleep(pace)
+        times.sort()
+        return [times[len(times) // 2] * 1e6, times[len(times) * 99 // 100] * 1e6]
+
+    results = {}
+    out = _SlowStream(delay)
+    results['print'] = timed(lambda i: print('Reading Photoresistor', i, file=out, flush=True))
+    sync = logging.getLogger('benchmark.sync')
+    sync.propagate = False
+    sync.addHandler(logging.StreamHandler(out))
+    sync.setLevel(logging.INFO)
+    results['logging, sync handler'] = timed(lambda i: sync.info('Reading Photoresistor %d', i))
+
+    configure(levels='info', stream=out, burst=number)
+    log = get_logger('control')
+    results['queued, new message'] = timed(lambda i: log.info('Reading Photoresistor %d', i))
+    configure(levels='info', stream=out)
+    results['queued, repeat dropped'] = timed(lambda i: log.info('No data found for: %s', 'rain'))
+    results['queued, below level'] = timed(lambda i: log.debug('Reading Photoresistor %d', i))
+    shutdown()
+    print('%d calls, one per %.1f ms, stdout stalls %.1f ms per write' % (number, pace * 1000, delay * 1000))
+    for name, (p50, p99) in results.items():
+        print('%-24s p50 %8.2f us  p99 %8.2f us' % (name, p50, p99))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Smart lamp logging')
+    parser.add_argument('--benchmark', action='store_true', help='cost per log call')
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--delay', type=float, default=0.0005, help='seconds a stdout write stalls')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.number, delay=args.delay)
+    else:
+        parser.print_help()
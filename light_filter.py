@@ -0,0 +1,115 @@
+import json
+import math
+
+from lamp_logging import get_logger
+
+
+class LightFilter:
+    """ One dimensional Kalman filter over photoresistor samples.
+
+        Each update is O(1). Samples further than ``gate`` standard
+        deviations from the estimate are dropped as outliers, unless
+        ``max_rejects`` of them arrive in a row, which means the room light
+        really changed and the filter restarts from the new level.
+
+        :param process_var: how much the real light level drifts per sample
+        :param measurement_var: noise of one sample (ADC counts squared)
+    """
+
+    def __init__(self, process_var=4.0, measurement_var=25.0, gate=4.0, max_rejects=3):
+        self.process_var = process_var
+        self.measurement_var = measurement_var
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.estimate = None
+        self.variance = measurement_var
+        self.samples = 0
+        self.rejected = 0
+        self._rejects = 0
+
+    def reset(self, value):
+        self.estimate = float(value)
+        self.variance = self.measurement_var
+        self._rejects = 0
+
+    def update(self, value):
+        """ Feed one sample, returns the new estimate """
+        self.samples += 1
+        if self.estimate is None:
+            self.reset(value)
+            return self.estimate
+
+        variance = self.variance + self.process_var
+        innovation = value - self.estimate
+        if abs(innovation) > self.gate * math.sqrt(variance + self.measurement_var):
+            self.rejected += 1
+            self._rejects += 1
+            if self._rejects >= self.max_rejects:
+                self.reset(value)
+            else:
+                self.variance = variance
+            return self.estimate
+
+        self._rejects = 0
+        gain = variance / (variance + self.measurement_var)
+        self.estimate += gain * innovation
+        self.variance = (1 - gain) * variance
+        return self.estimate
+
+
+# Keys of a tuning.py config the controller uses
+TUNING_KEYS = ('arduino_lb', 'arduino_ub', 'low', 'high', 'deadband')
+
+
+def load_tuning(path):
+    """ Controller parameters from a tuning.py config, {} without a usable one """
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    tuning = {key: config[key] for key in TUNING_KEYS if isinstance(config.get(key), (int, float))}
+    if (tuning.get('arduino_lb', 0) >= tuning.get('arduino_ub', 500)
+            or tuning.get('low', 33) >= tuning.get('high', 66)):
+        get_logger('control').warning('Ignoring inconsistent tuning in %s', path)
+        return {}
+    return tuning
+
+
+class BrightnessControl:
+    """ Continuous duty cycle from the filtered light level.
+
+        The light level is mapped to 0-100 between ``arduino_lb`` and
+        ``arduino_ub``. Below ``low`` the lamp is fully on, above ``high`` it
+        is off and it fades linearly in between. The output only moves when
+        the target differs by at least ``deadband`` percent, so noise around
+        a level does not make the lamp flicker.
+    """
+
+    def __init__(self, arduino_lb=0, arduino_ub=500, low=33, high=66, deadband=5):
+        self.arduino_lb = arduino_lb
+        self.arduino_ub = arduino_ub
+        self.low = low
+        self.high = high
+        self.deadband = deadband
+        self.duty = None
+
+    def target(self, level):
+        return self.targets((level,))[0]
+
+    def targets(self, levels, gain=1.0):
+        """ target() of every level times ``gain``, one pass for whole tables """
+        lb, span = self.arduino_lb, self.arduino_ub - self.arduino_lb
+        low, high = self.low, self.high
+        return [100 if mapped <= low else 0 if mapped >= high
+                else round(100 * (high - mapped) / (high - low), 1)
+                for mapped in [(level * gain - lb) * 100 / span for level in levels]]
+
+    def update(self, level):
+        """ Duty cycle for ``level``, held while within the deadband """
+        target = self.target(level)
+        # Full on and off are always reached so the ends are not clipped
+        if (self.duty is None or abs(target - self.duty) >= self.deadband
+                or (target in (0, 100) and target != self.duty)):
+            self.duty = target
+        return self.duty
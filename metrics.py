@@ -0,0 +1,216 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a fast serial line to a slow HTTP round trip
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(text):
+    # Backslash and newline are escaped in HELP text and label values
+    return str(text).replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, _escape(v).replace('"', '\\"')) for n, v in zip(names, values))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """ Child metric for one set of label values, keep it around on hot paths """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _samples(self):
+        if self.labelnames:
+            for values, child in sorted(self._children.items()):
+                yield from child._samples(self.name, _labels(self.labelnames, values))
+        else:
+            yield from self._samples_of(self.name, '')
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, _escape(self.documentation)),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        # A plain add, a lost increment under contention is an acceptable price
+        self.value += amount
+
+    def _samples(self, name, labels):
+        yield '%s%s %s' % (name, labels, self.value)
+
+
+class Counter(_Metric, _CounterValue):
+    kind = 'counter'
+    _child = _CounterValue
+
+    def __init__(self, name, documentation, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        _CounterValue.__init__(self)
+
+    def _samples_of(self, name, labels):
+        return _CounterValue._samples(self, name, labels)
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(_Metric, _GaugeValue):
+    kind = 'gauge'
+    _child = _GaugeValue
+
+    def __init__(self, name, documentation, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        _GaugeValue.__init__(self)
+
+    def _samples_of(self, name, labels):
+        return _GaugeValue._samples(self, name, labels)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """ Context manager observing the seconds spent in its block """
+        return _Timer(self)
+
+    def _samples(self, name, labels):
+        inner = labels[1:-1] + ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield '%s_bucket{%sle="%s"} %d' % (name, inner, le, cumulative)
+        yield '%s_sum%s %r' % (name, labels, self.sum)
+        yield '%s_count%s %d' % (name, labels, self.count)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric, _HistogramValue):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        _HistogramValue.__init__(self, tuple(buckets))
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def _samples_of(self, name, labels):
+        return _HistogramValue._samples(self, name, labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        return '\n'.join(m.render() for _, m in sorted(self.metrics.items())) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the journal
+        pass
+
+
+def start_server(port=9108, host='127.0.0.1', registry=REGISTRY):
+    """ Serve /metrics from a daemon thread, returns the server """
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -1,26 +1,174 @@
+
 const int photoPin = A0;
 float photoValue = 0;
-void setup() {
-  Serial.begin(9600);
 
+// Photoresistors on A0, A1, ... reported per line as comma separated
+// values, up to 6 (start the Pi side with a --zones config to match)
+#define CHANNELS 1
+const int photoPins[6] = {A0, A1, A2, A3, A4, A5};
+
+// Set to 1 to send binary frames instead of text lines:
+// sync 0xA5, sequence, sample count, ADC sum, CRC-16/XMODEM (little endian)
+#define BINARY_FRAMES 0
+#if BINARY_FRAMES
+#define BAUD_RATE 115200
+#else
+#define BAUD_RATE 9600
+#endif
+#define SAMPLES 250
+
+#if BINARY_FRAMES && CHANNELS > 1
+#error "Binary frames carry one sensor, use text lines for CHANNELS > 1"
+#endif
+
+// The Pi changes how readings are taken with text commands, one per line:
+//   O <count>  readings averaged per report (1-1000)
+//   I <ms>     delay between readings (0-1000)
+//   M <mode>   0 mean, 1 "mean min max" per sensor, 2 every reading (raw)
+//   ?          report the settings
+// Each command is answered with a "#cfg" line, also sent at start up, a
+// bad one with "#err". Text reports are the mean ADC value, binary frames
+// carry the sum and count of the readings.
+#define FIRMWARE 2
+#define MEAN 0
+#define MINMAX 1
+#define RAW 2
+
+unsigned int oversample = SAMPLES;
+unsigned int sampleDelay = 4;
+byte mode = MEAN;
+char command[16];
+byte commandLength = 0;
+
+const byte frameSync = 0xA5;
+byte sequence = 0;
+
+void setup() {
+  Serial.begin(BAUD_RATE);
+  reportConfig();
 }
 
 void loop() {
-  photoValue = photoResistorRead(photoPin);
-  Serial.println(photoValue);
-}
-
-int photoResistorRead(char analogPin){ 
-  // Function to read 500 values from photoresistor and return average volatge value in milivolts.
-  unsigned long sumVoltage = 0;
-  float voltage = 0.0;
-  
-  for(int i =1; i<=250; i++){
-    // Read values from analog pin connected to photoresistor
-    sumVoltage+=analogRead(analogPin);
-    delay(4);
+  readCommands();
+  unsigned long sums[CHANNELS];
+  int lows[CHANNELS];
+  int highs[CHANNELS];
+  unsigned int count = mode == RAW ? 1 : oversample;
+  if (!takeReadings(sums, lows, highs, count)) {
+    return; // A command came in, this report is dropped for the new settings
+  }
+#if BINARY_FRAMES
+  sendFrame(sums[0], count);
+#else
+  for (int c = 0; c < CHANNELS; c++) {
+    if (c) Serial.print(',');
+    photoValue = (float)sums[c] / count;
+    Serial.print(photoValue);
+    if (mode == MINMAX) {
+      Serial.print(' ');
+      Serial.print(lows[c]);
+      Serial.print(' ');
+      Serial.print(highs[c]);
+    }
+  }
+  Serial.println();
+#endif
+}
+
+bool takeReadings(unsigned long *sums, int *lows, int *highs, unsigned int count){
+  // count readings of every sensor, interleaved so a report takes the same
+  // time whatever the number of sensors. false when a command arrives
+  for (int c = 0; c < CHANNELS; c++) {
+    sums[c] = 0;
+    lows[c] = 1023;
+    highs[c] = 0;
   }
+  for (unsigned int i = 0; i < count; i++) {
+    for (int c = 0; c < CHANNELS; c++) {
+      int reading = analogRead(photoPins[c]);
+      sums[c] += reading;
+      if (reading < lows[c]) lows[c] = reading;
+      if (reading > highs[c]) highs[c] = reading;
+    }
+    if (Serial.available()) return false;
+    delay(sampleDelay);
+  }
+  return true;
+}
+
+void reportConfig(){
+  Serial.print("#cfg v=");
+  Serial.print(FIRMWARE);
+  Serial.print(" o=");
+  Serial.print(oversample);
+  Serial.print(" i=");
+  Serial.print(sampleDelay);
+  Serial.print(" m=");
+  Serial.print(mode);
+  Serial.print(" c=");
+  Serial.println(CHANNELS);
+}
+
+void readCommands(){
+  while (Serial.available()) {
+    char c = Serial.read();
+    if (c == '\n' || c == '\r') {
+      if (commandLength) {
+        command[commandLength] = 0;
+        runCommand();
+        commandLength = 0;
+      }
+    } else if (commandLength < sizeof(command) - 1) {
+      command[commandLength++] = c;
+    }
+  }
+}
+
+void runCommand(){
+  long value = atol(command + 1);
+  switch (command[0]) {
+    case 'O':
+      if (value < 1 || value > 1000) break;
+      oversample = value;
+      reportConfig();
+      return;
+    case 'I':
+      if (value < 0 || value > 1000) break;
+      sampleDelay = value;
+      reportConfig();
+      return;
+    case 'M':
+      if (value < MEAN || value > RAW) break;
+      mode = value;
+      reportConfig();
+      return;
+    case '?':
+      reportConfig();
+      return;
+  }
+  Serial.print("#err ");
+  Serial.println(command);
+}
+
+unsigned int crc16(const byte *data, byte len){
+  // CRC-16/XMODEM, same as binascii.crc_hqx(data, 0) on the Pi
+  unsigned int crc = 0;
+  while (len--) {
+    crc ^= (unsigned int)(*data++) << 8;
+    for (byte i = 0; i < 8; i++) {
+      crc = crc & 0x8000 ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
 
-  voltage = (sumVoltage / 500);
-  return voltage;
+void sendFrame(unsigned long sum, unsigned int samples){
+  byte frame[10];
+  frame[0] = frameSync;
+  frame[1] = sequence++;
+  memcpy(frame + 2, &samples, 2);
+  memcpy(frame + 4, &sum, 4);
+  unsigned int crc = crc16(frame + 1, 7);
+  memcpy(frame + 8, &crc, 2);
+  Serial.write(frame, sizeof(frame));
 }
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lamp_control
+import metrics
+from lamp_logging import get_logger
+from scheduler import LOOP_ITERATIONS, seconds_until
+
+CONTROL_LATENCY = metrics.histogram(
+    'lamp_control_latency_seconds', 'From a serial sample arriving to the PWM decision',
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+LOOP_LAG = metrics.histogram(
+    'lamp_loop_lag_seconds', 'How late the event loop wakes up a sleeping task',
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+SAMPLES_DROPPED = metrics.counter('lamp_samples_dropped_total', 'Samples dropped from a full queue')
+IO_TIMEOUTS = metrics.counter('lamp_io_timeouts_total', 'Network calls given up on', ('client',))
+
+log = get_logger('runtime')
+
+# (period, offset) in seconds of local time, as in schedule_jobs()
+PERIODS = {'alarms': (60, 1), 'alarm-reload': (5, 0), 'photoresistor': (180, 0), 'weather': (1800, 18*60), 'upload': (15, 0)}
+
+
+async def ticks(clock, period, offset=0):
+    """ Yield every ``period`` seconds, at ``offset`` within it in local time.
+
+        Only the first tick is aligned on ``clock``'s wall time, the next
+        ones are loop.time() deadlines whole periods after it, so sleeps
+        do not drift and a wall clock step does not move them. Ticks missed
+        while the caller was busy are skipped, not run back to back.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds_until(clock, period, offset)
+    while True:
+        await asyncio.sleep(deadline - loop.time())
+        yield
+        deadline += period
+        late = loop.time() - deadline
+        if late >= 0:
+            deadline += (late // period + 1) * period
+
+
+class AsyncLamp:
+    """ One lamp as asyncio tasks.
+
+        The serial thread hands every sample to a bounded queue and the
+        control task adjusts the PWM as soon as one arrives, or every
+        adjust_interval without samples. Weather and ThingSpeak requests
+        run on a small thread pool under a timeout, the control task never
+        waits for them. The uploader thread is not started, its queue is
+        drained and flushed by the upload task.
+
+        :param lamp: dict from new_lamp(), uploader built with a queue_size
+        :param periods: overrides of PERIODS, for benchmarks
+    """
+
+    def __init__(self, lamp, queue_size=64, weather_timeout=15, upload_timeout=30,
+                 workers=2, periods=None):
+        self.lamp = lamp
+        self.queue_size = queue_size
+        self.weather_timeout = weather_timeout
+        self.upload_timeout = upload_timeout
+        self.workers = workers
+        self.periods = dict(PERIODS, **(periods or {}))
+        self.samples = None
+        self.dropped = 0
+        self.decisions = 0
+        self.latencies = []
+        self.loop = None
+        self._flushing = False
+        self._tasks = []
+        self._main = None
+
+    def _offer(self, value, received):
+        # Runs on the loop, called from the serial thread
+        try:
+            self.samples.put_nowait(received)
+        except asyncio.QueueFull:
+            # Only the newest samples matter to the controller
+            self.samples.get_nowait()
+            self.samples.put_nowait(received)
+            self.dropped += 1
+            SAMPLES_DROPPED.inc()
+
+    def _listener(self, value):
+        self.loop.call_soon_threadsafe(self._offer, value, time.perf_counter())
+
+    async def control(self):
+        interval = self.lamp['adjust_interval']
+        while True:
+            try:
+                received = await asyncio.wait_for(self.samples.get(), interval)
+            except asyncio.TimeoutError:
+                received = None
+            while not self.samples.empty():
+                self.samples.get_nowait()
+            LOOP_ITERATIONS.inc()
+            lamp_control.adjust_brightness(self.lamp)
+            self.decisions += 1
+            if received is not None:
+                latency = time.perf_counter() - received
+                CONTROL_LATENCY.observe(latency)
+                self.latencies.append(latency)
+
+    async def _io(self, client, func, timeout):
+        """ func() on the pool, None when it takes longer than ``timeout`` """
+        try:
+            return await asyncio.wait_for(self.loop.run_in_executor(self.executor, func), timeout)
+        except asyncio.TimeoutError:
+            IO_TIMEOUTS.labels(client).inc()
+            log.warning('%s did not answer within %s s', client, timeout)
+            return None
+
+    async def read_weather(self):
+        weather = self.lamp['weather']
+        json_data = await self._io('weather', weather.get, self.weather_timeout)
+        if json_data is None:
+            # The fetch timed out, use the last answer. get() on the loop
+            # could start a fetch of its own and block every other task
+            json_data = weather.cached()
+        lamp_control.apply_weather(self.lamp, json_data)
+
+    def _flush(self):
+        # On the pool, cleared even when upload() stopped waiting for it
+        try:
+            return self.lamp['uploader'].flush()
+        finally:
+            self._flushing = False
+
+    async def upload(self):
+        if self._flushing:
+            # A flush that timed out is still sending. Draining now could
+            # merge into the batch it sends, a second flush would resend it
+            log.debug('Previous upload still running, skipping this period')
+            return
+        if self.lamp['uploader'].drain():
+            self._flushing = True
+            await self._io('thingspeak', self._flush, self.upload_timeout)
+
+    async def every(self, name, func):
+        period, offset = self.periods[name]
+        async for _ in ticks(self.lamp['clock'], period, offset):
+            LOOP_ITERATIONS.inc()
+            try:
+                result = func()
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A failing job is retried next period, the others keep running
+                log.warning('Job %s failed: %s', name, e)
+
+    async def lag_monitor(self, interval=0.1):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            LOOP_LAG.observe(max(time.perf_counter() - start - interval, 0))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._main = asyncio.current_task()
+        self.samples = asyncio.Queue(self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='lamp-io')
+        reader = self.lamp['reader']
+        if hasattr(reader, 'listener'):
+            reader.listener = self._listener
+        lamp = self.lamp
+        self._tasks = [
+            asyncio.create_task(self.control(), name='control'),
+            asyncio.create_task(self.lag_monitor(), name='lag'),
+            asyncio.create_task(self.every('alarms', lambda: lamp_control.check_alarms(lamp)), name='alarms'),
+            asyncio.create_task(self.every('photoresistor', lambda: lamp_control.read_photoresistor(lamp)),
+                                name='photoresistor'),
+            asyncio.create_task(self.every('weather', self.read_weather), name='weather'),
+            asyncio.create_task(self.every('upload', self.upload), name='upload')]
+        if hasattr(lamp['alarms'], 'reload'):
+            self._tasks.append(asyncio.create_task(
+                self.every('alarm-reload', lamp['alarms'].reload), name='alarm-reload'))
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            await self.cancel()
+
+    def serve(self):
+        """ Run on a loop of its own until stop(), for a worker thread """
+        try:
+            asyncio.run(self.run())
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """ Cancel run() from any thread """
+        if self.loop is not None and self._main is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._main.cancel)
+
+    async def cancel(self):
+        """ Cancel every task and wait for them to finish """
+        if hasattr(self.lamp['reader'], 'listener'):
+            self.lamp['reader'].listener = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # A request stuck in a worker thread ends on its own timeout
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def benchmark(seconds=10, rate=20, network_delay=3.0):
+    """ Sample to PWM decision latency while the network clients hang.
+
+        Samples arrive ``rate`` times a second, weather and ThingSpeak
+        calls take ``network_delay`` seconds. The asyncio runtime is
+        compared with the job scheduler, where the weather job blocks the
+        brightness job behind it.
+    """
+    import contextlib
+    import io
+    import tempfile
+    import threading
+    from alarm_schedule import AlarmSchedule
+    from hal import DigitalOutput, MockBackend, PWMOutput
+    from history import TelemetryStore
+    from scheduler import Scheduler, SystemClock
+    from serial_reader import RingBuffer
+    from uploader import ThingSpeakUploader
+
+    class SlowWeather:
+        """ WeatherProvider stand-in, a fetch is slow and then cached for a second """
+        fetched = 0
+
+        def get(self, max_age=None):
+            if time.monotonic() - self.fetched > 1:
+                time.sleep(network_delay)
+                self.fetched = time.monotonic()
+            return {'main': {'feels_like': 290.0}, 'clouds': {'all': 40}, 'weather': [{'description': 'x'}],
+                    'sys': {'sunrise': 0, 'sunset': 0}}
+
+    class SlowSession:
+        def post(self, *args, **kwargs):
+            time.sleep(network_delay)
+            return type('Response', (), {'status_code': 202})()
+
+    class FakeReader:
+        """ Pushes samples from a thread like SerialReader """
+        def __init__(self):
+            self.buffer = RingBuffer(256)
+            self.listener = None
+            self.received = []
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+
+        def _run(self):
+            i = 0
+            while not self._stop.wait(1 / rate):
+                self.buffer.append(200 + (i % 50))
+                self.received.append(time.perf_counter())
+                if self.listener is not None:
+                    self.listener(self.buffer.latest())
+                i += 1
+
+        def window(self, n=None, max_age=None):
+            return self.buffer.window(n, max_age)
+
+        def since(self, seen):
+            return self.buffer.since(seen)
+
+        def start(self):
+            self._thread.start()
+
+        def stop(self, timeout=None):
+            self._stop.set()
+
+    def make_lamp(tmp):
+        clock = SystemClock()
+        gpio = MockBackend(clock)
+        reader = FakeReader()
+        return lamp_control.new_lamp(
+            clock=clock, reader=reader, weather=SlowWeather(), ramp=0, adjust_interval=1 / rate,
+            pwm=PWMOutput(gpio, 12, 1000), leds=DigitalOutput(gpio, [38, 40]),
+            uploader=ThingSpeakUploader(1, 'key', session=SlowSession(), queue_size=64, coalesce=0),
+            alarms=AlarmSchedule([]), history=TelemetryStore(tmp))
+
+    def report(name, latencies):
+        latencies = sorted(latencies)
+        if not latencies:
+            print('%-10s no decisions' % name)
+            return
+        pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+        print('%-10s %6d decisions  p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms'
+              % (name, len(latencies), pick(0.5), pick(0.99), latencies[-1] * 1000))
+
+    # Network jobs every 2 s instead of every 15 and 1800 s
+    periods = {'weather': (2, 0), 'upload': (2, 1), 'photoresistor': (0.5, 0)}
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        lamp = make_lamp(tmp)
+        runtime = AsyncLamp(lamp, periods=periods, weather_timeout=network_delay * 2,
+                            upload_timeout=network_delay * 2)
+        lamp['reader'].start()
+
+        async def timed():
+            try:
+                await asyncio.wait_for(runtime.run(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        asyncio.run(timed())
+        lamp['reader'].stop()
+        async_latencies = runtime.latencies
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        lamp = make_lamp(tmp)
+        scheduler = Scheduler()
+        thread_latencies = []
+
+        def adjust():
+            # Age of the oldest sample this run picks up
+            seen = lamp['samples_seen']
+            received = lamp['reader'].received
+            if len(received) > seen:
+                thread_latencies.append(time.perf_counter() - received[seen])
+            lamp_control.adjust_brightness(lamp)
+
+        scheduler.every(1 / rate, adjust, name='brightness')
+        scheduler.every(2, lambda: lamp_control.read_weather(lamp), name='weather')
+        scheduler.every(2, lambda: lamp['uploader'].drain() and lamp['uploader'].flush(),
+                        name='upload', delay=1)
+        lamp['reader'].start()
+        threading.Timer(seconds, scheduler.stop).start()
+        scheduler.run()
+        lamp['reader'].stop()
+
+    print('%d s, %d samples/s, network calls take %.1f s' % (seconds, rate, network_delay))
+    report('asyncio', async_latencies)
+    report('scheduler', thread_latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Smart lamp asyncio runtime')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare control latency with hanging network clients')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--delay', type=float, default=3.0, help='simulated network delay')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.seconds, network_delay=args.delay)
+    else:
+        parser.print_help()
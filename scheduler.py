@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+LOOP_ITERATIONS = metrics.counter('lamp_loop_iterations_total',
+                                  'Passes of the scheduler loop or of the asyncio runtime tasks')
+JOB_RUNS = metrics.counter('lamp_job_runs_total', 'Scheduled job runs', ('job',))
+JOB_SECONDS = metrics.histogram('lamp_job_seconds', 'Time spent in one job run', ('job',))
+
+
+class SchedulerError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def seconds_until(clock, period, offset=0):
+    """ Seconds until local wall time on ``clock`` is next ``offset`` within ``period``.
+
+        e.g. seconds_until(clock, 180) is the next minute multiple of 3 and
+        seconds_until(clock, 1800, 18*60) is the next :18 or :48.
+    """
+    local = clock.time() + clock.localtime().tm_gmtoff
+    return (offset - local) % period
+
+
+class SystemClock:
+    """ Real clock: monotonic deadlines, wall time for calendar decisions """
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def localtime(self):
+        return time.localtime(self.time())
+
+    def wait(self, event, timeout):
+        # Returns early when the scheduler is woken up (new job, stop)
+        event.wait(timeout)
+
+
+class FakeClock:
+    """ Deterministic clock for tests and simulations.
+
+        Waiting never blocks, it just moves the clock forward, so a whole
+        day of jobs can be run in milliseconds.
+
+        :param start: initial monotonic value in seconds
+        :param wall: wall time (epoch seconds) matching ``start``
+    """
+
+    def __init__(self, start=0.0, wall=None):
+        self.now = float(start)
+        if wall is None:
+            wall = time.time()
+        self.wall_offset = wall - self.now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now + self.wall_offset
+
+    def localtime(self):
+        return time.localtime(self.time())
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def wait(self, event, timeout):
+        self.advance(timeout)
+
+
+class Job:
+    __slots__ = ('name', 'func', 'interval', 'deadline', 'cancelled', 'runs', 'seconds')
+
+    def __init__(self, name, func, interval, deadline):
+        self.runs = JOB_RUNS.labels(name)
+        self.seconds = JOB_SECONDS.labels(name)
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        return 'Job(%r, interval=%r, deadline=%.3f)' % (self.name, self.interval, self.deadline)
+
+
+class Scheduler:
+    """ Heap based scheduler with monotonic deadlines.
+
+        Jobs are kept in a min-heap ordered by deadline and the loop sleeps
+        until the earliest one is due instead of polling the clock.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else SystemClock()
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = False
+
+    def _push(self, job, wake=True):
+        with self._lock:
+            heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+        if wake:
+            self._wakeup.set()
+        return job
+
+    def every(self, interval, func, name=None, delay=None):
+        """ Register a periodic job, first run after ``delay`` seconds
+            (defaults to one interval) """
+        if interval <= 0:
+            raise SchedulerError("Interval must be positive")
+        if delay is None:
+            delay = interval
+        deadline = self.clock.monotonic() + delay
+        return self._push(Job(name or func.__name__, func, interval, deadline))
+
+    def once(self, delay, func, name=None):
+        """ Register a one-shot job that runs after ``delay`` seconds """
+        deadline = self.clock.monotonic() + max(delay, 0)
+        return self._push(Job(name or func.__name__, func, None, deadline))
+
+    def seconds_until(self, period, offset=0):
+        return seconds_until(self.clock, period, offset)
+
+    def jobs(self):
+        with self._lock:
+            return [job for _, _, job in sorted(self._heap) if not job.cancelled]
+
+    def next_delay(self):
+        """ Seconds until the next job is due, None if nothing is scheduled """
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            deadline = self._heap[0][0]
+        return max(deadline - self.clock.monotonic(), 0)
+
+    def run_pending(self):
+        """ Run every job that is due now. Returns the number of jobs run """
+        ran = 0
+        now = self.clock.monotonic()
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                job = self._heap[0][2]
+                if job.cancelled or job.interval is None:
+                    heapq.heappop(self._heap)
+                    if job.cancelled:
+                        continue
+                else:
+                    # Keep the original phase, skip runs missed while busy
+                    job.deadline += job.interval
+                    if job.deadline <= now:
+                        job.deadline += job.interval * ((now - job.deadline) // job.interval + 1)
+                    # Rescheduled in place, one sift and nothing to wake up
+                    heapq.heapreplace(self._heap, (job.deadline, next(self._counter), job))
+            started = time.perf_counter()
+            job.func()
+            job.seconds.observe(time.perf_counter() - started)
+            job.runs.inc()
+            ran += 1
+        return ran
+
+    def run(self, until=None):
+        """ Run jobs until stop() is called, no job is left, or the monotonic
+            clock reaches ``until`` """
+        self._running = True
+        while self._running:
+            LOOP_ITERATIONS.inc()
+            self.run_pending()
+            if not self._running:
+                break # stop() from a job, don't wait for the next one
+            if self._wakeup.is_set():
+                self._wakeup.clear()
+            delay = self.next_delay()
+            if delay is None:
+                break
+            if until is not None:
+                remaining = until - self.clock.monotonic()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            if delay > 0:
+                self.clock.wait(self._wakeup, delay)
+        self._running = False
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
@@ -0,0 +1,342 @@
+import threading
+import time
+from array import array
+from collections import deque
+
+import serial
+
+import metrics
+from firmware import encode, parse_config, parse_value
+from frames import ASCII_SCALE, FrameDecoder
+from lamp_logging import get_logger
+
+log = get_logger('serial')
+
+SERIAL_READ = metrics.histogram('lamp_serial_read_seconds', 'Time blocked in one serial read')
+SERIAL_SAMPLES = metrics.counter('lamp_serial_samples_total', 'Photoresistor samples received')
+SERIAL_ERRORS = metrics.counter('lamp_serial_errors_total', 'Garbled serial lines')
+SERIAL_RECONNECTS = metrics.counter('lamp_serial_reconnects_total', 'Serial port (re)connections')
+
+
+class RingBuffer:
+    """ Fixed size, array backed ring buffer of (timestamp, value) samples.
+
+        Appending is O(1) and never allocates; old samples are overwritten.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.values = array('d', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            self.values[self.index] = value
+            self.times[self.index] = timestamp
+            self.index = (self.index + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+            self.total += 1
+
+    def __len__(self):
+        return self.count
+
+    def window(self, n=None, max_age=None, now=None):
+        """ Latest ``n`` values, oldest first. With ``max_age`` only samples
+            newer than ``max_age`` seconds are returned """
+        with self._lock:
+            if n is None or n > self.count:
+                n = self.count
+            start = (self.index - n) % self.size
+            if start + n <= self.size:
+                values = self.values[start:start + n].tolist()
+                times = self.times[start:start + n]
+            else:
+                values = (self.values[start:] + self.values[:self.index]).tolist()
+                times = self.times[start:] + self.times[:self.index]
+        if max_age is not None:
+            if now is None:
+                now = time.monotonic()
+            values = [v for v, t in zip(values, times) if now - t <= max_age]
+        return values
+
+    def since(self, seen):
+        """ Values appended after the first ``seen`` ones, oldest first, and
+            the new total. Samples already overwritten are skipped """
+        with self._lock:
+            total = self.total
+            n = min(total - seen, self.count)
+            if n <= 0:
+                return [], total
+            start = (self.index - n) % self.size
+            if start + n <= self.size:
+                values = self.values[start:start + n].tolist()
+            else:
+                values = (self.values[start:] + self.values[:self.index]).tolist()
+        return values, total
+
+    def latest(self):
+        with self._lock:
+            if self.count == 0:
+                return None
+            return self.values[self.index - 1]
+
+    def clear(self):
+        with self._lock:
+            self.index = 0
+            self.count = 0
+
+
+class SerialReader(threading.Thread):
+    """ Long lived reader holding one serial port open.
+
+        Lines sent by the arduino are parsed into a RingBuffer so the
+        control loop can take the latest window without blocking. The port
+        is reopened when the device goes away.
+
+        :param ports: list of port names, or a callable returning one
+            (e.g. serial_ports) that is called on every reconnect
+        :param serial_factory: callable with the serial.Serial signature,
+            used to plug in a fake device in tests
+        :param protocol: 'ascii' for the Serial.println() sketch, 'binary'
+            for BINARY_FRAMES, 'auto' decodes whichever arrives
+        :param listener: optional callable(value) run on the reader thread
+            after each sample is buffered, it must not block
+        :param channels: sensors per line of a CHANNELS > 1 sketch, the
+            samples go to a zones.SampleBuffer of rows
+        :param sampling: firmware.AdaptiveSampling, or None to leave the
+            sketch's settings alone. Needs the text replies of firmware 2,
+            so the 'ascii' or 'auto' protocol
+        :param handshake: seconds text readings are held back after
+            connecting until the sketch says which firmware it runs
+
+        Firmware 2 prints the real mean ADC value and answers commands
+        with '#cfg' lines, its readings are scaled to the half-mean units
+        of the first sketch. Without a '#cfg' line within ``handshake``
+        the port is taken to run the first sketch. Lines held back are
+        parsed with the right scale as soon as it is known and buffered
+        with the time they arrived, ``identified`` is set from then on.
+    """
+
+    def __init__(self, ports, baudrate=9600, size=64, timeout=1,
+                 retry_delay=2.0, serial_factory=None, protocol='ascii', listener=None,
+                 channels=1, sampling=None, handshake=2.0):
+        super().__init__(name='serial-reader', daemon=True)
+        self.ports = ports
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.serial_factory = serial_factory or serial.Serial
+        self.channels = channels
+        if channels > 1:
+            if protocol != 'ascii':
+                raise ValueError('Binary frames carry one sensor, use ascii with %d channels' % channels)
+            # numpy is only loaded for several sensors
+            from zones import SampleBuffer, parse_row
+            self.buffer = SampleBuffer(channels, size)
+            self._parse_row = parse_row
+        else:
+            self.buffer = RingBuffer(size)
+        if sampling is not None and protocol == 'binary':
+            raise ValueError('Adaptive sampling needs the text replies of firmware 2, not binary frames')
+        self.protocol = protocol
+        self.listener = listener
+        self.decoder = None if protocol == 'ascii' else FrameDecoder(ascii=protocol == 'auto')
+        self.sampling = sampling
+        self.handshake = handshake
+        self.settings = {} # what the Pi asked the sketch for, sent again on reconnect
+        self.firmware = None
+        self.scale = 1.0
+        self.spread = 0.0
+        self.port = None
+        self.errors = 0
+        self.reconnects = 0
+        self.heartbeat = time.monotonic()
+        self.connected = threading.Event()
+        self.identified = threading.Event()
+        self._stop_event = threading.Event()
+        self._ser = None
+        self._write_lock = threading.Lock()
+        self._handshake_until = 0
+        self._held = deque(maxlen=size) # (line, arrival) during the handshake
+
+    def _candidates(self):
+        return self.ports() if callable(self.ports) else list(self.ports)
+
+    def _connect(self):
+        for port in self._candidates():
+            try:
+                ser = self.serial_factory(port, self.baudrate, timeout=self.timeout)
+                ser.reset_input_buffer()
+            except (OSError, serial.SerialException):
+                log.warning('No serial connection with port = %s', port)
+                continue
+            self._ser = ser
+            self.port = port
+            self.firmware = None
+            self.scale = 1.0
+            self._handshake_until = time.monotonic() + self.handshake
+            self._held.clear()
+            if self.decoder is None:
+                self.identified.clear()
+            else:
+                self.identified.set() # Frames carry their own scale, nothing is held back
+            # A freshly reset board announces itself, one that was running answers '?'
+            self._send(b'?\n' + encode(**self.settings))
+            self.connected.set()
+            return True
+        return False
+
+    def _close(self):
+        self.connected.clear()
+        self.identified.clear()
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except (OSError, serial.SerialException):
+                pass
+        self._ser = None
+
+    def _send(self, data):
+        with self._write_lock:
+            ser = self._ser
+            if ser is None or not data:
+                return False
+            try:
+                ser.write(data)
+            except (OSError, serial.SerialException) as e:
+                log.warning('Serial write failed on %s: %s', self.port, e)
+                return False
+        return True
+
+    def configure(self, oversample=None, interval=None, mode=None):
+        """ Change how the sketch takes readings, kept across reconnects.
+
+            :param oversample: ADC readings averaged per report
+            :param interval: ms between ADC readings
+            :param mode: firmware.MEAN, MINMAX or RAW
+        """
+        settings = {key: value for key, value in (('oversample', oversample), ('interval', interval),
+                                                  ('mode', mode)) if value is not None}
+        data = encode(**settings)
+        self.settings.update(settings)
+        return self._send(data)
+
+    def _reply(self, line):
+        config = parse_config(line)
+        if config is None:
+            log.warning('Sketch answered %r', line.strip())
+            return
+        if self.firmware is None:
+            log.info('Sketch firmware %d on %s', config.get('firmware', 1), self.port)
+        self.firmware = config
+        self.scale = ASCII_SCALE if config.get('firmware', 1) >= 2 else 1.0
+        if self.decoder is not None:
+            self.decoder.text_scale = self.scale
+        else:
+            self._release()
+
+    def _release(self):
+        """ End the handshake, the held back lines are parsed with the scale now known """
+        self._handshake_until = 0
+        held = list(self._held)
+        self._held.clear()
+        for line, arrival in held:
+            self._take(line, arrival)
+        self.identified.set()
+
+    def parse(self, line):
+        """ Parse one line from the sketch, None if it is garbled """
+        if self.channels > 1:
+            row = self._parse_row(line, self.channels)
+            return row if row is None or self.scale == 1 else [v * self.scale for v in row]
+        try:
+            value, spread = parse_value(line.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError, IndexError):
+            return None
+        self.spread = spread * self.scale
+        return value * self.scale
+
+    def run(self):
+        while not self._stop_event.is_set():
+            # Reads time out every second, a stale heartbeat means a hung port
+            self.heartbeat = time.monotonic()
+            if self._ser is None:
+                if not self._connect():
+                    self._stop_event.wait(self.retry_delay)
+                    continue
+                self.reconnects += 1
+                SERIAL_RECONNECTS.inc()
+            try:
+                started = time.perf_counter()
+                if self.decoder is None:
+                    line = self._ser.readline()
+                else:
+                    data = self._ser.read(self._ser.in_waiting or 1)
+                SERIAL_READ.observe(time.perf_counter() - started)
+            except (OSError, serial.SerialException) as e:
+                log.warning('Serial read failed on %s: %s', self.port, e)
+                self._close()
+                self._stop_event.wait(self.retry_delay)
+                continue
+            if self.decoder is not None:
+                values = self.decoder.feed(data)
+                for reply in self.decoder.replies:
+                    self._reply(reply)
+                self.decoder.replies.clear()
+                for value in values:
+                    self._received(value)
+                continue
+            if self._handshake_until and time.monotonic() >= self._handshake_until:
+                self._release() # No '#cfg' answer, the first sketch
+            if not line:
+                continue
+            if line.startswith(b'#'):
+                self._reply(line)
+                continue
+            if self._handshake_until:
+                # Which firmware, and so which scale, is not known yet
+                self._held.append((line, time.monotonic()))
+                continue
+            self._take(line)
+        self._close()
+
+    def _take(self, line, arrival=None):
+        value = self.parse(line)
+        if value is None:
+            self.errors += 1
+            SERIAL_ERRORS.inc()
+            return
+        self._received(value, arrival)
+
+    def _received(self, value, arrival=None):
+        self.buffer.append(value, arrival)
+        SERIAL_SAMPLES.inc()
+        if self.listener is not None:
+            self.listener(value)
+        if self.sampling is not None and self.firmware and self.firmware.get('firmware', 1) >= 2:
+            level = value if self.channels == 1 else self.buffer.latest()
+            if level is not None:
+                change = self.sampling.update(level, self.spread)
+                if change:
+                    self.configure(**change)
+
+    def window(self, n=None, max_age=None):
+        return self.buffer.window(n, max_age)
+
+    def since(self, seen):
+        return self.buffer.since(seen)
+
+    def since_rows(self, seen):
+        return self.buffer.since_rows(seen)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,149 @@
+import argparse
+import bisect
+import calendar
+import contextlib
+import io
+import json
+import sys
+import time
+
+from alarm_schedule import AlarmSchedule
+from hal import DigitalOutput, MockBackend, PWMOutput
+import lamp_control
+from scheduler import FakeClock, Scheduler
+
+class Trace:
+    """ Step function over recorded (epoch, value) samples, replayed from
+        ``start`` and looped when the simulation outlasts it """
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+        self.span = times[-1] - times[0] + (times[-1] - times[-2] if len(times) > 1 else 1)
+
+    def at(self, t, start):
+        offset = (t - start) % self.span
+        i = bisect.bisect_right(self.times, self.times[0] + offset) - 1
+        return self.values[max(i, 0)]
+
+
+def load_traces(path):
+    """ Photoresistor (field5, volts) and weather (field1, field2) traces
+        from a ThingSpeak export """
+    with open(path, encoding='utf-8') as f:
+        feeds = json.load(f)['feeds']
+    traces = {}
+    for name, field in (('light', 'field5'), ('temperature', 'field1'), ('clouds', 'field2')):
+        times, values = [], []
+        for row in feeds:
+            if row.get(field) is not None:
+                times.append(calendar.timegm(time.strptime(row['created_at'], '%Y-%m-%dT%H:%M:%SZ')))
+                values.append(float(row[field]))
+        if times:
+            traces[name] = Trace(times, values)
+    return traces
+
+
+class TraceReader:
+    """ SerialReader stand-in returning the traced photoresistor ADC value """
+
+    def __init__(self, trace, clock, start):
+        self.trace = trace
+        self.clock = clock
+        self.start = start
+
+    def window(self, n=None, max_age=None):
+        volts = self.trace.at(self.clock.time(), self.start)
+        return [volts * 1023 / 5] * (n or 1)
+
+    def since(self, seen):
+        # One fresh sample per call
+        return self.window(1), seen + 1
+
+    def stop(self, timeout=None):
+        pass
+
+
+class TraceWeather:
+    """ WeatherProvider stand-in building OpenWeatherMap json from traces """
+
+    def __init__(self, traces, clock, start):
+        self.traces = traces
+        self.clock = clock
+        self.start = start
+
+    def get(self, max_age=None):
+        now = self.clock.time()
+        temperature = self.traces['temperature'].at(now, self.start) if 'temperature' in self.traces else 20
+        clouds = self.traces['clouds'].at(now, self.start) if 'clouds' in self.traces else 0
+        return {'weather': [{'description': 'replay'}],
+                'main': {'feels_like': temperature + 273.15},
+                'clouds': {'all': clouds},
+                'sys': {'sunrise': now - now % 86400 + 6 * 3600, 'sunset': now - now % 86400 + 20 * 3600}}
+
+
+class Recorder:
+    """ Uploader and history stand-in that only counts what it is given """
+
+    def __init__(self):
+        self.count = 0
+
+    def submit(self, fields, created_at=None):
+        self.count += 1
+
+    def append(self, name, value, t=None):
+        self.count += 1
+
+    def range(self, name, start, end):
+        return [], []
+
+    def flush(self):
+        pass
+
+
+def simulate(traces, hours, alarms=(), start=None, quiet=True, planning=False):
+    """ Run the lamp jobs over ``hours`` simulated hours.
+
+        Returns the MockBackend, its history[12] is the PWM duty cycle
+        timeline and history[38] / history[40] the temperature LEDs.
+    """
+    if start is None:
+        start = traces['light'].times[0]
+    clock = FakeClock(wall=start)
+    gpio = MockBackend(clock)
+    scheduler = Scheduler(clock)
+    lamp = lamp_control.new_lamp(
+        reader=TraceReader(traces['light'], clock, start), clock=clock,
+        pwm=PWMOutput(gpio, 12, 1000), leds=DigitalOutput(gpio, [38, 40]), ramp=0,
+        uploader=Recorder(), weather=TraceWeather(traces, clock, start),
+        alarms=AlarmSchedule(alarms), history=Recorder(), adjust_interval=60, planning=planning)
+    lamp_control.schedule_jobs(scheduler, lamp)
+    out = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(out):
+        scheduler.run(until=clock.monotonic() + hours * 3600)
+    return gpio
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded traces through the lamp logic')
+    parser.add_argument('export', nargs='?', default='ThingSpeak_Data.json')
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--alarms', help='Alarms.csv style file (Hour,Minute,Week_Day)')
+    parser.add_argument('--timeline', action='store_true', help='print every duty cycle change')
+    parser.add_argument('--plan', action='store_true', help='follow a daylight plan instead of the sensor')
+    args = parser.parse_args()
+
+    alarms = []
+    if args.alarms:
+        with open(args.alarms) as f:
+            next(f)
+            alarms = [[int(v) for v in line.split(',')] for line in f if line.strip()]
+
+    started = time.perf_counter()
+    gpio = simulate(load_traces(args.export), args.hours, alarms, planning=args.plan)
+    elapsed = time.perf_counter() - started
+    if args.timeline:
+        for t, duty in gpio.history[12]:
+            print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)), duty)
+    print('%.0f simulated hours in %.2f s (%.0f h/s), %d PWM writes'
+          % (args.hours, elapsed, args.hours / elapsed, gpio.writes[12]))
@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import lamp_logging
+import metrics
+
+log = lamp_logging.get_logger('supervisor')
+
+RESTARTS = metrics.counter('lamp_worker_restarts_total', 'Supervised worker restarts', ('worker',))
+
+# State older than this is from another day, the controller starts fresh
+STATE_MAX_AGE = 3600
+
+
+class StateFile:
+    """ Last known lamp state as a small json file.
+
+        save() only writes when the state changed and otherwise touches
+        the file at most every ``touch_every`` seconds, its mtime doubles
+        as the heartbeat of the process and is what load() checks the age
+        of, so a lamp in a steady state keeps it valid.
+    """
+
+    def __init__(self, path, touch_every=5):
+        self.path = path
+        self.touch_every = touch_every
+        self._last = None
+        self._touched = None
+
+    def load(self, max_age=STATE_MAX_AGE):
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if age > max_age:
+            return {}
+        return state
+
+    def save(self, state):
+        now = time.monotonic()
+        if state == self._last and os.path.exists(self.path):
+            # Every touch is an inode write on the SD card
+            if now - self._touched >= self.touch_every:
+                os.utime(self.path)
+                self._touched = now
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(state, saved=time.time()), f)
+        os.replace(tmp, self.path)
+        self._last = state
+        self._touched = now
+
+
+def snapshot(lamp):
+    """ What a restarted lamp needs to carry on where it was """
+    state = {'duty': lamp['pwm'].duty, 'light_flag': lamp['light_flag'],
+             'active_flag': lamp['active_flag'], 'average_voltage': lamp['average_voltage'],
+             'estimate': lamp['light_filter'].estimate, 'brightness': lamp['brightness'].duty}
+    if lamp.get('plan') is not None:
+        state['plan_gain'] = lamp['plan'].gain
+    return state
+
+
+def restore(lamp, state):
+    for key in ('light_flag', 'active_flag', 'average_voltage'):
+        if key in state:
+            lamp[key] = state[key]
+    if state.get('estimate') is not None:
+        lamp['light_filter'].reset(state['estimate'])
+    if state.get('brightness') is not None:
+        lamp['brightness'].duty = state['brightness']
+    if state.get('plan_gain') is not None and lamp.get('plan') is not None:
+        lamp['plan'].gain = state['plan_gain']
+
+
+class WorkerThread(threading.Thread):
+    """ Runs ``target`` until it returns or raises, the traceback is logged
+        and the supervisor sees a dead worker """
+
+    def __init__(self, target, name, stop=None):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.stop_func = stop
+
+    def run(self):
+        try:
+            self.target()
+        except Exception:
+            log.exception('Worker %s crashed', self.name)
+
+    def stop(self, timeout=None):
+        if self.stop_func is not None:
+            self.stop_func()
+        if self.is_alive():
+            self.join(timeout)
+
+
+class _Worker:
+    __slots__ = ('name', 'start', 'heartbeat', 'timeout', 'handle', 'started',
+                 'failures', 'restart_at')
+
+    def __init__(self, name, start, heartbeat, timeout, handle):
+        self.name = name
+        self.start = start
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.handle = handle
+        self.started = time.monotonic()
+        self.failures = 0
+        self.restart_at = None
+
+
+class Supervisor:
+    """ Restarts lamp components that die or stop sending heartbeats.
+
+        Each worker is started by a callable returning a handle with
+        is_alive() and stop(timeout). A worker is restarted after
+        ``backoff[0]`` seconds, doubling per failure in a row up to
+        ``backoff[1]``, and the count resets once it stays up for
+        ``stable`` seconds. Every ``interval`` the lamp state is saved so a
+        restarted process resumes with the same brightness.
+
+        A hung thread can't be killed, it is stopped as far as it listens
+        and left behind while a new one takes over.
+    """
+
+    def __init__(self, lamp=None, state=None, interval=1.0, backoff=(0.5, 30), stable=60):
+        self.lamp = lamp
+        self.state = state
+        self.interval = interval
+        self.backoff = backoff
+        self.stable = stable
+        self.workers = {}
+        self._stop_event = threading.Event()
+
+    def add(self, name, start, heartbeat=None, timeout=30, handle=None):
+        """ Supervise a component, started now unless ``handle`` is given.
+
+            :param heartbeat: callable returning the time.monotonic() of the
+                worker's last sign of life, None to only check is_alive()
+        """
+        if handle is None:
+            handle = start()
+        self.workers[name] = _Worker(name, start, heartbeat, timeout, handle)
+
+    def check(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start(worker, now)
+                continue
+            reason = self._failure(worker, now)
+            if reason is None:
+                if worker.failures and now - worker.started > self.stable:
+                    worker.failures = 0
+                continue
+            delay = min(self.backoff[0] * 2 ** worker.failures, self.backoff[1])
+            worker.failures += 1
+            log.warning('Worker %s %s, restarting in %.1f s', worker.name, reason, delay)
+            try:
+                worker.handle.stop(timeout=1)
+            except Exception as e:
+                log.warning('Worker %s did not stop cleanly: %s', worker.name, e)
+            worker.restart_at = now + delay
+
+    def _failure(self, worker, now):
+        if not worker.handle.is_alive():
+            return 'stopped'
+        if worker.heartbeat is None:
+            return None
+        beat = max(worker.heartbeat() or 0, worker.started)
+        if now - beat > worker.timeout:
+            return 'sent no heartbeat for %.0f s' % (now - beat)
+        return None
+
+    def _start(self, worker, now):
+        try:
+            worker.handle = worker.start()
+        except Exception as e:
+            log.warning('Worker %s failed to start: %s', worker.name, e)
+            worker.restart_at = now + min(self.backoff[0] * 2 ** worker.failures, self.backoff[1])
+            worker.failures += 1
+            return
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        RESTARTS.labels(worker.name).inc()
+
+    def save(self):
+        if self.state is not None and self.lamp is not None:
+            self.state.save(snapshot(self.lamp))
+
+    def run(self):
+        """ Check the workers and save the state until stop() """
+        self.save()
+        while not self._stop_event.wait(self.interval):
+            self.check()
+            self.save()
+
+    def stop(self, timeout=2):
+        self._stop_event.set()
+        for worker in self.workers.values():
+            worker.handle.stop(timeout=timeout)
+        self.save()
+
+
+def supervise_process(command, state_path, timeout=30, backoff=(0.5, 30), stable=60):
+    """ Run the lamp in a child process and restart it when it exits with
+        an error or its state file stops being updated for ``timeout`` s """
+    failures = 0
+    child = None
+
+    def terminate(signum, frame):
+        if child is not None and child.poll() is None:
+            child.send_signal(signal.SIGINT)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            started = time.monotonic()
+            child = subprocess.Popen(command)
+            reason = None
+            while reason is None:
+                try:
+                    code = child.wait(timeout=1)
+                    if code == 0:
+                        return 0
+                    reason = 'exited with %d' % code
+                except subprocess.TimeoutExpired:
+                    try:
+                        age = time.time() - os.path.getmtime(state_path)
+                    except OSError:
+                        age = time.monotonic() - started
+                    if age > timeout and time.monotonic() - started > timeout:
+                        reason = 'sent no heartbeat for %.0f s' % age
+                        child.kill()
+                        child.wait()
+            if time.monotonic() - started > stable:
+                failures = 0
+            delay = min(backoff[0] * 2 ** failures, backoff[1])
+            failures += 1
+            log.warning('Lamp process %s, restarting in %.1f s', reason, delay)
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        if child is not None and child.poll() is None:
+            child.send_signal(signal.SIGINT)
+            try:
+                child.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keep the smart lamp running, e.g. supervisor.py -- --backend rpi --plan')
+    parser.add_argument('--state', default=os.path.join(os.getcwd(), 'lamp_state.json'),
+                        help='state file the lamp keeps updating')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds without a state update before the lamp is killed')
+    parser.add_argument('lamp_args', nargs=argparse.REMAINDER,
+                        help='arguments of SmartLamp_ver.Final.py, after --')
+    args = parser.parse_args()
+    lamp_logging.configure()
+    lamp_args = [a for a in args.lamp_args if a != '--']
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SmartLamp_ver.Final.py')
+    # Restarts can't answer alarm prompts
+    sys.exit(supervise_process([sys.executable, script, '--no-prompt', '--state', args.state] + lamp_args,
+                               args.state, args.timeout))
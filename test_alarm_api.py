@@ -0,0 +1,62 @@
+import json
+import time
+from http.client import HTTPConnection
+
+import pytest
+
+from alarm_api import MAX_NEXT, RuleError, expand_rule, start_server
+from alarm_store import AlarmStore
+
+
+@pytest.fixture
+def api(tmp_path):
+    store = AlarmStore(str(tmp_path / 'Alarms.csv'))
+    # Monday 12:00
+    server = start_server(store, port=0, localtime=lambda: time.struct_time((2024, 3, 4, 12, 0, 0, 0, 64, 0)))
+    conn = HTTPConnection('127.0.0.1', server.server_address[1])
+
+    def request(method, path, body=None):
+        conn.request(method, path, json.dumps(body) if body is not None else None)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    yield request
+    conn.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_add_list_and_remove(api):
+    assert api('POST', '/alarms', {'alarms': [[7, 30, 0]], 'rules': [{'at': '08:00', 'days': 'weekends'}]}) \
+        == (200, {'added': 3, 'alarms': 3})
+    assert api('GET', '/alarms') == (200, {'alarms': [[7, 30, 0], [8, 0, 5], [8, 0, 6]]})
+    assert api('DELETE', '/alarms', {'alarms': [[7, 30, 0], [9, 0, 0]]}) == (200, {'removed': 1, 'alarms': 2})
+    assert api('POST', '/alarms', {'alarms': [[24, 0, 0]]})[0] == 400
+
+
+def test_next_count_is_checked_and_clamped(api):
+    api('POST', '/alarms', {'rules': [{'every': 1, 'start': '13:00', 'end': '23:59', 'days': 'daily'}]})
+    status, body = api('GET', '/alarms/next?count=2')
+    assert status == 200
+    assert [(f['hour'], f['minute'], f['in_minutes']) for f in body['next']] == [(13, 0, 60), (13, 1, 61)]
+    assert len(api('GET', '/alarms/next?count=0')[1]['next']) == 1
+    assert len(api('GET', '/alarms/next?count=-5')[1]['next']) == 1
+    assert len(api('GET', '/alarms/next?count=99999999')[1]['next']) == MAX_NEXT
+    assert api('GET', '/alarms/next?count=ten')[0] == 400
+    assert api('GET', '/alarms/next')[0] == 200 # the connection is still usable
+
+
+@pytest.mark.parametrize('body', [[[7, 0, 0]], 'x', 7, {'rules': ['08:00']}])
+def test_body_that_is_not_an_object(api, body):
+    for method in ('POST', 'PUT', 'DELETE'):
+        status, reply = api(method, '/alarms', body)
+        assert status == 400
+        assert 'object' in reply['error']
+    assert api('GET', '/alarms') == (200, {'alarms': []})
+
+
+def test_rules():
+    assert expand_rule({'every': 20, 'start': '18:00', 'end': '19:00', 'days': [0]}) \
+        == [[18, 0, 0], [18, 20, 0], [18, 40, 0], [19, 0, 0]]
+    with pytest.raises(RuleError):
+        expand_rule({'at': '25:00'})
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from alarm_schedule import MINUTES_PER_WEEK, AlarmSchedule, InvalidAlarm, minute_of_week, to_row
+
+
+def test_minute_of_week_round_trip():
+    assert minute_of_week([7, 30, 2]) == 2 * 1440 + 7 * 60 + 30
+    assert to_row(minute_of_week([23, 59, 6])) == [23, 59, 6]
+    t = time.struct_time((2024, 3, 5, 7, 30, 0, 1, 65, 0)) # Tuesday
+    assert minute_of_week(t) == minute_of_week([7, 30, 1])
+
+
+def test_rows_are_sorted_and_unique():
+    schedule = AlarmSchedule([[8, 0, 1], [7, 30, 0], [8, 0, 1]])
+    assert schedule.rows() == [[7, 30, 0], [8, 0, 1]]
+    assert len(schedule) == 2
+    assert [8, 0, 1] in schedule
+    assert schedule.day(1) == [[8, 0, 1]]
+
+
+def test_active_window():
+    schedule = AlarmSchedule([[7, 30, 0]], duration=10)
+    assert schedule.active(minute_of_week([7, 29, 0])) is None
+    assert schedule.active(minute_of_week([7, 30, 0])) == [7, 30, 0]
+    assert schedule.active(minute_of_week([7, 39, 0])) == [7, 30, 0]
+    assert schedule.active(minute_of_week([7, 40, 0])) is None
+
+
+def test_active_window_wraps_into_next_week():
+    schedule = AlarmSchedule([[23, 55, 6]], duration=10)
+    assert schedule.active(minute_of_week([0, 4, 0])) == [23, 55, 6]
+    assert schedule.active(minute_of_week([0, 5, 0])) is None
+
+
+def test_next_after_wraps_around_the_week():
+    schedule = AlarmSchedule([[7, 0, 0], [18, 0, 4]])
+    assert schedule.next_after(minute_of_week([8, 0, 0])) == (4 * 1440 + 10 * 60, [18, 0, 4])
+    assert schedule.next_after(minute_of_week([19, 0, 4])) == (2 * 1440 + 12 * 60, [7, 0, 0])
+    # Strictly after, an alarm at now is a week away
+    assert schedule.next_after(minute_of_week([7, 0, 0]))[0] == 4 * 1440 + 11 * 60
+    assert AlarmSchedule([[7, 0, 0]]).next_after(minute_of_week([7, 0, 0])) == (MINUTES_PER_WEEK, [7, 0, 0])
+    assert AlarmSchedule().next_after(0) is None
+
+
+def test_upcoming_returns_each_alarm_once():
+    schedule = AlarmSchedule([[7, 0, d] for d in range(7)])
+    firings = schedule.upcoming(minute_of_week([12, 0, 5]), count=10)
+    assert [row for _, row in firings] == [[7, 0, 6]] + [[7, 0, d] for d in range(6)]
+    assert [minutes for minutes, _ in firings] == [19 * 60 + 1440 * i for i in range(7)]
+
+
+def test_add_and_remove():
+    schedule = AlarmSchedule()
+    assert schedule.add(7, 30, 0)
+    assert not schedule.add(7, 30, 0)
+    assert schedule.remove(7, 30, 0)
+    assert not schedule.remove(7, 30, 0)
+    assert len(schedule) == 0
+
+
+def test_remove_validates_the_row():
+    schedule = AlarmSchedule([[1, 30, 0]])
+    with pytest.raises(InvalidAlarm):
+        schedule.remove(0, 90, 0) # the same minute of week as 1:30
+    assert [0, 90, 0] not in schedule
+    assert not schedule.remove(8, 0, 0)
+    assert schedule.remove('1', '30', '0')
+    assert len(schedule) == 0
+
+
+@pytest.mark.parametrize('row', [[24, 0, 0], [7, 60, 0], [7, 0, 7], [-1, 0, 0], ['x', 0, 0]])
+def test_invalid_rows_are_rejected(row):
+    with pytest.raises((InvalidAlarm, ValueError)):
+        AlarmSchedule([row])
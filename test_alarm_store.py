@@ -0,0 +1,94 @@
+import pytest
+
+from alarm_schedule import InvalidAlarm
+from alarm_store import AlarmStore, read_snapshot, write_snapshot
+
+
+def store(tmp_path, rows=(), **options):
+    path = str(tmp_path / 'Alarms.csv')
+    write_snapshot(path, rows)
+    return AlarmStore(path, **options)
+
+
+def log_lines(alarms):
+    with open(alarms.log) as f:
+        return f.read().splitlines()
+
+
+def test_edits_go_to_the_log(tmp_path):
+    alarms = store(tmp_path, [[7, 30, 0]])
+    assert alarms.add(8, 0, 1)
+    assert not alarms.add(8, 0, 1)
+    assert alarms.remove(7, 30, 0)
+    assert log_lines(alarms) == ['+ 8 0 1', '- 7 30 0']
+    assert read_snapshot(alarms.path) == [[7, 30, 0]]
+    assert alarms.rows() == [[8, 0, 1]]
+
+
+def test_removing_a_missing_row_writes_nothing(tmp_path):
+    alarms = store(tmp_path, [[7, 30, 0]])
+    assert not alarms.remove(8, 0, 1)
+    assert alarms.update(remove=[[8, 0, 1]]) == (0, 0)
+    assert alarms.rows() == [[7, 30, 0]]
+    assert not (tmp_path / 'Alarms.log').exists()
+
+
+def test_remove_validates_and_normalizes_the_row(tmp_path):
+    alarms = store(tmp_path, [[1, 30, 0]])
+    with pytest.raises(InvalidAlarm):
+        alarms.remove(0, 90, 0)
+    with pytest.raises(InvalidAlarm):
+        alarms.update(remove=[[0, 90, 0]])
+    assert alarms.remove('1', '30', '0')
+    assert log_lines(alarms) == ['- 1 30 0']
+    assert len(alarms) == 0
+
+
+def test_compaction_folds_the_log_into_the_snapshot(tmp_path):
+    alarms = store(tmp_path, compact_every=4)
+    for minute in range(5):
+        alarms.add(7, minute, 0)
+    # The fourth entry triggered a compaction, the fifth is in a fresh log
+    assert read_snapshot(alarms.path) == [[7, m, 0] for m in range(4)]
+    assert log_lines(alarms) == ['+ 7 4 0']
+    assert AlarmStore(alarms.path).rows() == [[7, m, 0] for m in range(5)]
+
+
+def test_large_batch_goes_straight_to_a_snapshot(tmp_path):
+    alarms = store(tmp_path, compact_every=4)
+    assert alarms.update(add=[[7, m, 0] for m in range(10)]) == (10, 0)
+    assert len(read_snapshot(alarms.path)) == 10
+    assert log_lines(alarms) == []
+
+
+def test_other_stores_pick_up_changes(tmp_path):
+    one = store(tmp_path)
+    other = AlarmStore(one.path)
+    one.add(7, 0, 0)
+    assert other.reload()
+    assert other.rows() == [[7, 0, 0]]
+    assert not other.reload()
+    one.compact()
+    one.remove(7, 0, 0)
+    assert other.reload()
+    assert len(other) == 0
+
+
+def test_a_batch_keeps_alarms_written_before_it_took_the_lock(tmp_path, monkeypatch):
+    one = store(tmp_path, compact_every=1)
+    other = AlarmStore(one.path)
+    reload = one.reload
+
+    def reload_then_race():
+        changed = reload()
+        # The other store slips an alarm in right after the first reload
+        if not other.rows():
+            other.add(6, 0, 0)
+        return changed
+
+    monkeypatch.setattr(one, 'reload', reload_then_race)
+    assert one.update(add=[[7, 0, 0], [8, 0, 0]]) == (2, 0)
+    expected = [[6, 0, 0], [7, 0, 0], [8, 0, 0]]
+    assert one.rows() == expected
+    assert read_snapshot(one.path) == expected
+    assert AlarmStore(one.path).rows() == expected
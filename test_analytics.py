@@ -0,0 +1,36 @@
+import json
+
+import numpy as np
+
+from analytics import duty_cycle, load_export, synthetic_export
+
+
+def test_compact_export(tmp_path):
+    path = tmp_path / 'export.json'
+    synthetic_export(str(path), 20)
+    df = load_export(str(path))
+    assert len(df) == 20
+    assert df['entry_id'].tolist() == list(range(1, 21))
+    assert df['temperature'].notna().sum() == 2 # weather every 10th row
+    assert df['light'].notna().all()
+
+
+def test_null_and_empty_fields_are_nan(tmp_path):
+    # Indented, so the json parser reads it. field1 is empty in every row
+    # and field2 to field4 are missing
+    path = tmp_path / 'export.json'
+    feeds = [{'created_at': '2020-05-13T13:48:25Z', 'entry_id': 1, 'field1': '', 'field5': '1.56'},
+             {'created_at': '2020-05-13T13:49:01Z', 'entry_id': 2, 'field1': '', 'field5': None}]
+    path.write_text(json.dumps({'feeds': feeds}, indent=1))
+    df = load_export(str(path))
+    assert df['temperature'].isna().all()
+    assert df['clouds'].isna().all()
+    assert df['light'].tolist()[0] == 1.56
+    assert np.isnan(df['light'].tolist()[1])
+
+
+def test_duty_cycle_thresholds():
+    # 1 V maps to about 41 % of the 0-500 count range
+    duty = duty_cycle([0.5, 1.5, 2.4, 3.0])
+    assert duty[:3].tolist() == [100, 50, 0]
+    assert np.isnan(duty[3]) # above arduino_ub
@@ -0,0 +1,112 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from channel_cache import PAGE_SIZE, CacheError, ChannelCache, _session, _stand_in, sync
+
+START = 1589377705
+
+
+def feeds(count, first=1):
+    return [{'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(START + 15 * i)),
+             'entry_id': i + 1, 'field1': '20.5' if i % 10 == 0 else None, 'field2': None,
+             'field3': None, 'field4': None, 'field5': '%.2f' % (1.5 + (i % 100) / 100)}
+            for i in range(first - 1, first - 1 + count)]
+
+
+@pytest.fixture
+def channel():
+    """ Local read API serving a list of feed rows, and a sync against it """
+    served = []
+    server = _stand_in(served, PAGE_SIZE)
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    session = _session()
+
+    def pull(cache, page=PAGE_SIZE):
+        server.queries.clear()
+        return sync(cache, 1, url=url, session=session, page=page)
+
+    yield served, server, pull
+    session.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_first_sync_copies_the_channel(tmp_path, channel):
+    served, server, pull = channel
+    served.extend(feeds(50))
+    cache = ChannelCache(str(tmp_path))
+    assert pull(cache) == 50
+    assert len(server.queries) == 1
+    assert 'start' not in server.queries[0]
+    df = ChannelCache(str(tmp_path)).frame()
+    assert list(df['entry_id']) == list(range(1, 51))
+    assert df['temperature'].iloc[0] == 20.5
+    assert np.isnan(df['temperature'].iloc[1])
+    assert str(df.index[0]) == '2020-05-13 13:48:25+00:00'
+
+
+def test_incremental_sync_asks_only_for_new_entries(tmp_path, channel):
+    served, server, pull = channel
+    served.extend(feeds(50))
+    cache = ChannelCache(str(tmp_path))
+    pull(cache)
+    served.extend(feeds(20, first=51))
+    assert pull(cache) == 20
+    # Bounded by the time of the last cached entry, not the whole channel again
+    assert [q['start'] for q in server.queries] == [['2020-05-13 14:00:40']]
+    assert cache.last_entry_id == 70
+    assert list(cache.column('entry_id')) == list(range(1, 71))
+    assert pull(cache) == 0
+    assert len(server.queries) == 1
+
+
+def test_sync_pages_through_a_large_channel(tmp_path, channel):
+    served, server, pull = channel
+    served.extend(feeds(2 * PAGE_SIZE + 500))
+    cache = ChannelCache(str(tmp_path))
+    assert pull(cache) == 2 * PAGE_SIZE + 500
+    assert len(server.queries) == 3
+    assert all(q['results'] == [str(PAGE_SIZE)] for q in server.queries)
+    assert list(cache.column('entry_id')) == list(range(1, 2 * PAGE_SIZE + 501))
+
+
+def test_empty_channel(tmp_path, channel):
+    served, server, pull = channel
+    cache = ChannelCache(str(tmp_path))
+    assert pull(cache) == 0
+    assert len(cache) == 0
+    assert cache.frame().empty
+    served.extend(feeds(5))
+    assert pull(cache) == 5
+
+
+def test_torn_append_is_cut_off_and_synced_again(tmp_path, channel):
+    served, server, pull = channel
+    served.extend(feeds(30))
+    cache = ChannelCache(str(tmp_path))
+    pull(cache)
+    # Power cut after some columns got the next rows but before meta.json did
+    for name in ('created_at', 'entry_id', 'field1'):
+        with open(os.path.join(str(tmp_path), name), 'ab') as f:
+            np.arange(10, dtype=np.int64).tofile(f)
+    cache = ChannelCache(str(tmp_path))
+    assert len(cache) == 30
+    assert {os.path.getsize(os.path.join(str(tmp_path), name))
+            for name in ('created_at', 'entry_id', 'field1', 'field5')} == {30 * 8}
+    served.extend(feeds(10, first=31))
+    assert pull(cache) == 10
+    df = ChannelCache(str(tmp_path)).frame()
+    assert list(df['entry_id']) == list(range(1, 41))
+    assert df['temperature'].iloc[30] == 20.5
+
+
+def test_missing_rows_are_an_error(tmp_path, channel):
+    served, server, pull = channel
+    served.extend(feeds(30))
+    pull(ChannelCache(str(tmp_path)))
+    os.truncate(os.path.join(str(tmp_path), 'field2'), 8 * 10)
+    with pytest.raises(CacheError):
+        ChannelCache(str(tmp_path))
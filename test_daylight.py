@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from daylight import DaylightPlan, MINUTES_PER_DAY, cloud_factor, daylight, plan_day
+from hal import MockBackend, PWMOutput
+import lamp_control
+from light_filter import BrightnessControl
+from scheduler import FakeClock
+
+SUNRISE, SUNSET = 6 * 60 + 40, 19 * 60 + 55
+WEATHER = {'sunrise': [6, 40], 'sunset': [19, 55], 'clouds': 0}
+
+
+def test_daylight_rises_from_dawn_to_noon_and_sets_at_dusk():
+    assert daylight(SUNRISE - 31, SUNRISE, SUNSET) == 0
+    assert daylight(SUNSET + 31, SUNRISE, SUNSET) == 0
+    assert 0 < daylight(SUNRISE, SUNRISE, SUNSET) < 0.2 # twilight before sunrise
+    noon = (SUNRISE + SUNSET) // 2
+    morning = [daylight(m, SUNRISE, SUNSET) for m in range(SUNRISE - 30, noon)]
+    assert morning == sorted(morning)
+    assert daylight(noon, SUNRISE, SUNSET) == pytest.approx(1, abs=1e-4)
+    assert daylight(SUNRISE + 60, SUNRISE, SUNSET) == pytest.approx(daylight(SUNSET - 60, SUNRISE, SUNSET))
+    assert daylight(noon, SUNSET, SUNRISE) == 0 # no sun times that make sense
+
+
+def test_clouds_dim_the_plan():
+    assert cloud_factor(0) == 1
+    assert cloud_factor(100) == pytest.approx(0.25)
+    assert cloud_factor(-10) == 1 and cloud_factor(150) == cloud_factor(100)
+    factors = [cloud_factor(c) for c in range(0, 101, 10)]
+    assert factors == sorted(factors, reverse=True)
+    clear = plan_day(WEATHER)
+    overcast = plan_day(dict(WEATHER, clouds=100))
+    assert overcast.level(12 * 60) < clear.level(12 * 60)
+    assert overcast.duty(12 * 60) > clear.duty(12 * 60)
+    assert clear.level(2 * 60) == overcast.level(2 * 60) # night is night either way
+    assert plan_day(dict(WEATHER, clouds='No data')).level(12 * 60) == \
+        plan_day(dict(WEATHER, clouds=50)).level(12 * 60)
+
+
+def test_plan_duties_are_the_sensor_mapping():
+    brightness = BrightnessControl(arduino_lb=10, arduino_ub=480)
+    plan = DaylightPlan.build(SUNRISE, SUNSET, 30, brightness=brightness, gain=0.8)
+    assert list(plan.duties) == [brightness.target(plan.level(m)) for m in range(MINUTES_PER_DAY)]
+
+
+def test_gain_retabulates_only_past_the_tolerance():
+    plan = plan_day(WEATHER)
+    minute = 9 * 60
+    duties = list(plan.duties)
+    expected = plan.levels[minute]
+    # Within 2 % of the gain the table was computed with, only the gain moves
+    plan.correct(minute, expected * 1.05)
+    assert plan.gain == pytest.approx(1.015)
+    assert list(plan.duties) == duties
+    plan.correct(minute, expected * 1.05)
+    assert plan.gain > 1.02
+    assert list(plan.duties) != duties
+    assert list(plan.duties) == plan.brightness.targets(plan.levels, plan.gain)
+
+
+def plan_lamp(hour, light_flag=0):
+    clock = FakeClock(wall=time.mktime((2024, 3, 4, hour, 0, 0, 0, 0, -1)))
+    plan = plan_day(WEATHER)
+    lamp = lamp_control.new_lamp(clock=clock, pwm=PWMOutput(MockBackend(), 12), ramp=0, plan=plan,
+                                 light_flag=light_flag, plan_checked=clock.monotonic())
+    lamp['pwm'].set(100)
+    return lamp
+
+
+def test_plan_switches_off_at_night_unless_an_alarm_holds_the_light():
+    lamp = plan_lamp(2)
+    lamp_control.adjust_brightness(lamp)
+    assert lamp['pwm'].duty == 0
+    lamp = plan_lamp(2, light_flag=1)
+    lamp_control.adjust_brightness(lamp)
+    assert lamp['pwm'].duty == 100
+    lamp = plan_lamp(9)
+    lamp_control.adjust_brightness(lamp)
+    assert lamp['pwm'].duty == lamp['plan'].duty(9 * 60)
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from alarm_schedule import AlarmSchedule
+from fleet import Fleet
+from hal import MockBackend
+from scheduler import SystemClock
+from serial_reader import RingBuffer
+
+SUNNY = {'main': {'feels_like': 290.0}, 'clouds': {'all': 40}, 'weather': [{'description': 'x'}],
+         'sys': {'sunrise': 0, 'sunset': 0}}
+
+
+class Weather:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = 0
+
+    def get(self, max_age=None):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError('no network')
+        return SUNNY
+
+    def cached(self):
+        return SUNNY
+
+
+class Uploader:
+    """ ThingSpeakUploader stand-in, flush takes ``delay`` or raises """
+
+    def __init__(self, delay=0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.drains = 0
+        self.flushes = 0
+        self.running = 0
+        self.overlaps = 0
+        self._lock = threading.Lock()
+
+    def drain(self):
+        self.drains += 1
+        return 1
+
+    def flush(self):
+        with self._lock:
+            self.flushes += 1
+            self.running += 1
+            self.overlaps += self.running > 1
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+        if self.fail:
+            raise ConnectionError('thingspeak is down')
+        return True
+
+    def stop(self):
+        pass
+
+
+class History:
+    def append(self, name, value, t=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_fleet(uploaders, weather=None, **options):
+    config = {'lamps': [{'name': name, 'serial': None, 'pwm_pin': 12 + i, 'leds': [38, 40],
+                         'channel_id': i, 'write_key': 'key'}
+                        for i, name in enumerate(uploaders)]}
+
+    def parts(cfg):
+        return {'reader': RingBuffer(), 'alarms': AlarmSchedule([]),
+                'uploader': uploaders[cfg['name']], 'history': History()}
+
+    fleet = Fleet(config, backend=MockBackend(), clock=SystemClock(), weather=weather or Weather(),
+                  make_parts=parts, **options)
+    fleet.executor = ThreadPoolExecutor(max_workers=4)
+    return fleet
+
+
+def run_for(seconds, *jobs):
+    async def timed():
+        try:
+            await asyncio.wait_for(asyncio.gather(*jobs), seconds)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(timed())
+
+
+def test_a_failing_job_does_not_stop_the_fleet(caplog):
+    uploaders = {'hall': Uploader(), 'desk': Uploader()}
+    weather = Weather(fail=True)
+    fleet = make_fleet(uploaders, weather)
+    with caplog.at_level(logging.WARNING, logger='lamp.runtime'):
+        run_for(0.35, fleet.every(0.05, 0, fleet.read_weather), fleet.every(0.05, 0, fleet.upload))
+    assert weather.calls >= 3 # retried every period
+    assert all(uploader.flushes >= 3 for uploader in uploaders.values())
+    assert 'Job read_weather failed' in caplog.text
+
+
+def test_one_lamp_failing_to_upload_leaves_the_others(caplog):
+    uploaders = {'hall': Uploader(fail=True), 'desk': Uploader()}
+    fleet = make_fleet(uploaders)
+    with caplog.at_level(logging.WARNING, logger='lamp.runtime'):
+        asyncio.run(fleet.upload())
+        asyncio.run(fleet.upload())
+    assert uploaders['hall'].flushes == uploaders['desk'].flushes == 2
+    assert 'Lamp hall upload failed' in caplog.text
+    assert not fleet._flushing
+
+
+def test_a_hung_flush_is_not_overlapped():
+    uploaders = {'hall': Uploader(delay=0.25), 'desk': Uploader()}
+    fleet = make_fleet(uploaders, upload_timeout=0.05)
+    run_for(0.6, fleet.every(0.05, 0, fleet.upload))
+    hall = uploaders['hall']
+    assert hall.flushes >= 2
+    assert hall.overlaps == 0
+    assert hall.drains == hall.flushes # no drain while one is sending
+    assert uploaders['desk'].flushes > hall.flushes
@@ -0,0 +1,55 @@
+from frames import ASCII_SCALE, FRAME_SIZE, FrameDecoder, crc16, decode_ascii, encode
+
+
+def test_frame_round_trip():
+    frame = encode(7, 250, 250 * 400)
+    assert len(frame) == FRAME_SIZE
+    assert crc16(b'123456789') == 0x31C3 # CRC-16/XMODEM check value
+    decoder = FrameDecoder(ascii=False)
+    assert decoder.feed(frame) == [400 * ASCII_SCALE]
+    assert decoder.frames == 1
+
+
+def test_frames_split_across_reads():
+    stream = b''.join(encode(i, 10, 10 * i) for i in range(1, 6))
+    decoder = FrameDecoder(ascii=False)
+    out = []
+    for i in range(0, len(stream), 3):
+        out += decoder.feed(stream[i:i + 3])
+    assert out == [i * ASCII_SCALE for i in range(1, 6)]
+    assert decoder.errors == 0
+
+
+def test_bad_crc_resyncs_on_the_next_frame():
+    bad = bytearray(encode(1, 10, 100))
+    bad[4] ^= 0xFF
+    decoder = FrameDecoder(ascii=False)
+    assert decoder.feed(bytes(bad) + encode(2, 10, 200)) == [20 * ASCII_SCALE]
+    assert decoder.errors >= 1
+
+
+def test_lost_frames_are_counted_across_the_sequence_wrap():
+    decoder = FrameDecoder(ascii=False)
+    decoder.feed(encode(254, 1, 1) + encode(255, 1, 1) + encode(2, 1, 1))
+    assert decoder.lost == 2 # 0 and 1
+
+
+def test_text_lines_replies_and_frames_mixed():
+    decoder = FrameDecoder()
+    decoder.text_scale = 0.5
+    out = decoder.feed(b'3.50\r\n#cfg 2 8 100 text\n' + encode(0, 4, 400) + b'garbage\n1.00')
+    assert out == [1.75, 100 * ASCII_SCALE]
+    assert decoder.replies == [b'#cfg 2 8 100 text']
+    assert decoder.errors == 1
+    assert decoder.feed(b'\n') == [0.5] # the line completed by the next read
+
+
+def test_endless_text_is_dropped():
+    decoder = FrameDecoder(max_line=16)
+    assert decoder.feed(b'x' * 40) == []
+    assert decoder.errors == 1
+    assert decoder.buffer == bytearray()
+
+
+def test_legacy_decoder():
+    assert decode_ascii(b'1.5\r\n\r\nnope\n2\n') == [1.5, 2.0]
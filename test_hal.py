@@ -0,0 +1,65 @@
+import logging
+import sys
+import time
+
+import pytest
+
+from hal import BACKENDS, BackendError, DigitalOutput, MockBackend, PWMOutput, open_backend
+
+
+def test_unchanged_levels_are_not_written():
+    backend = MockBackend()
+    out = DigitalOutput(backend, [11, 13])
+    out.set([1, 0])
+    out.set([1, 0])
+    out.set(1)
+    assert backend.writes == {11: 2, 13: 2} # setup + one change each
+
+
+def test_ramp_reaches_its_duty():
+    backend = MockBackend()
+    pwm = PWMOutput(backend, 12)
+    pwm.ramp(100, duration=0.05, step=0.01)
+    assert pwm.wait(5)
+    assert pwm.duty == 100
+    assert backend.value(12) == 100
+
+
+def test_set_during_a_ramp_step_wins():
+    backend = MockBackend()
+    pwm = PWMOutput(backend, 12)
+    with pwm._lock:
+        pwm.ramp(100, duration=0.01, step=0.001)
+        time.sleep(0.05) # the ramp's first step is waiting for the lock
+        pwm.set(0)
+        ramp = pwm._ramp
+    pwm.wait(5)
+    time.sleep(0.05)
+    assert pwm.duty == 0
+    assert backend.value(12) == 0
+    assert ramp is None # cancelled by set()
+
+
+def test_no_gpio_library_falls_back_to_mock(monkeypatch, caplog):
+    # None in sys.modules makes the import raise ImportError
+    for module in ('RPi', 'RPi.GPIO', 'lgpio'):
+        monkeypatch.setitem(sys.modules, module, None)
+    with caplog.at_level(logging.WARNING, logger='lamp.control'):
+        backend = open_backend()
+    assert isinstance(backend, MockBackend)
+    assert 'No GPIO library found' in caplog.text
+
+
+def test_named_backend():
+    assert open_backend('mock').name == 'mock'
+    with pytest.raises(BackendError):
+        open_backend('pigpio')
+
+
+def test_named_backend_errors_are_not_hidden(monkeypatch):
+    def broken():
+        raise KeyError('pin 12')
+    monkeypatch.setitem(BACKENDS, 'broken', broken)
+    # Not reported as an unknown backend name
+    with pytest.raises(KeyError):
+        open_backend('broken')
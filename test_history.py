@@ -0,0 +1,87 @@
+import os
+import time
+from array import array
+
+import pytest
+
+from history import HistoryError, Series, TelemetryStore
+
+# Recent enough that no segment is expired
+T = float(int(time.time()) - 3600)
+
+
+def test_full_chunk_becomes_a_segment(tmp_path):
+    series = Series(str(tmp_path), 'light', chunk_size=4)
+    for i in range(10):
+        series.append(float(i), t=T + i)
+    assert len(series.segments) == 2
+    assert len(series) == 10
+    assert series.range(T + 2, T + 7) == ([T + 2, T + 3, T + 4, T + 5, T + 6],
+                                          [2.0, 3.0, 4.0, 5.0, 6.0])
+    assert series.latest() == (T + 9, 9.0)
+
+
+def test_open_chunk_survives_a_crash(tmp_path):
+    series = Series(str(tmp_path), 'light', flush_interval=0)
+    for i in range(3):
+        series.append(float(i), t=T + i)
+    assert not series.segments
+    # No roll and no shutdown, the process just dies
+    again = Series(str(tmp_path), 'light')
+    assert again.range(T, T + 10) == ([T, T + 1, T + 2], [0.0, 1.0, 2.0])
+
+
+def test_flush_only_appends_new_samples(tmp_path):
+    series = Series(str(tmp_path), 'light', flush_interval=3600)
+    series.append(1.0, t=T)
+    series.flush()
+    series.append(2.0, t=T + 1)
+    series.flush()
+    series.flush()
+    assert os.path.getsize(series.open_file) == 2 * 16
+    series.append(3.0, t=T + 2)
+    assert os.path.getsize(series.open_file) == 2 * 16 # held until the next flush
+
+
+def test_roll_removes_the_open_chunk(tmp_path):
+    series = Series(str(tmp_path), 'light', chunk_size=3, flush_interval=0)
+    for i in range(3):
+        series.append(float(i), t=T + i)
+    assert not os.path.exists(series.open_file)
+    assert len(Series(str(tmp_path), 'light')) == 3
+
+
+def test_samples_in_a_segment_and_the_open_chunk_are_loaded_once(tmp_path):
+    series = Series(str(tmp_path), 'light', chunk_size=3)
+    for i in range(3):
+        series.append(float(i), t=T + i)
+    # Crash after the segment was written, before the open file was removed
+    with open(series.open_file, 'wb') as f:
+        array('d', [T + 1, 1.0, T + 2, 2.0, T + 3, 3.0]).tofile(f)
+    again = Series(str(tmp_path), 'light')
+    assert again.range(T, T + 10)[0] == [T, T + 1, T + 2, T + 3]
+    again.flush()
+    assert Series(str(tmp_path), 'light').range(T, T + 10)[0] == [T, T + 1, T + 2, T + 3]
+
+
+def test_store_flush_persists_every_series(tmp_path):
+    store = TelemetryStore(str(tmp_path))
+    store.append('light', 1.5, t=T)
+    store.append('clouds', 40, t=T)
+    store.flush()
+    again = TelemetryStore(str(tmp_path))
+    assert again.range('light', T, T + 10) == ([T], [1.5])
+    assert again.range('clouds', T, T + 10) == ([T], [40.0])
+
+
+def test_rollups(tmp_path):
+    series = Series(str(tmp_path), 'light', chunk_size=4, rollup=10)
+    start = T - T % 10
+    for t, v in ((0, 1.0), (5, 3.0), (12, 2.0), (15, 4.0)):
+        series.append(v, t=start + t)
+    assert series.summary(start, start + 20) == [(start, 1.0, 3.0, 2.0), (start + 10, 2.0, 4.0, 3.0)]
+
+
+def test_values_must_be_numbers(tmp_path):
+    with pytest.raises(HistoryError):
+        TelemetryStore(str(tmp_path)).append('light', 'No data')
@@ -0,0 +1,27 @@
+import time
+
+import pytest
+
+from simulate import Trace, simulate
+
+
+def duty_at(gpio, t):
+    duty = None
+    for when, value in gpio.history[12]:
+        if when > t:
+            break
+        duty = value
+    return duty
+
+
+@pytest.mark.parametrize('planning', [False, True])
+def test_alarm_before_six_is_not_switched_off_by_the_night(planning):
+    start = time.mktime((2024, 3, 4, 5, 0, 0, 0, 0, -1)) # 05:00 local
+    day = time.localtime(start).tm_wday
+    traces = {'light': Trace([start, start + 60], [2.5, 2.5])}
+    gpio = simulate(traces, 1, alarms=[[5, 30, day]], start=start, planning=planning)
+
+    assert duty_at(gpio, start + 25 * 60) == 0
+    for minute in range(30, 40):
+        assert duty_at(gpio, start + minute * 60 + 30) == 100, minute
+    assert duty_at(gpio, start + 42 * 60) == 0 # night again once the alarm is over
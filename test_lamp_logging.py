@@ -0,0 +1,137 @@
+import io
+import json
+import logging
+import os
+import sys
+import threading
+from collections import deque
+
+import pytest
+
+import lamp_logging
+from lamp_logging import RateLimit, Writer, _QueueHandler, configure, get_logger, parse_levels
+
+
+@pytest.fixture
+def lamp_logger():
+    """ configure() takes over the 'lamp' logger, put it back afterwards """
+    root = logging.getLogger('lamp')
+    saved = root.handlers[:], root.propagate, root.level
+    levels = {name: get_logger(name).level for name in lamp_logging.SUBSYSTEMS}
+    yield root
+    lamp_logging.shutdown()
+    root.handlers[:], root.propagate, root.level = saved
+    for name, level in levels.items():
+        get_logger(name).setLevel(level)
+
+
+def record(msg, *args, name='lamp.control', level=logging.INFO):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limit_passes_a_burst_then_counts_the_rest():
+    clock = Clock()
+    limit = RateLimit(burst=2, interval=60, clock=clock)
+    passed = [limit.filter(record('No data found for: %s', 'rain')) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert limit.filter(record('No data found for: %s', 'snow')) # other arguments
+    clock.now = 61
+    again = record('No data found for: %s', 'rain')
+    assert limit.filter(again)
+    assert again.suppressed == 3
+
+
+def test_rate_limit_counts_are_exact_across_threads():
+    limit = RateLimit(burst=4000, interval=3600)
+    start = threading.Barrier(8)
+    passed = []
+
+    def log():
+        start.wait()
+        passed.append(sum(limit.filter(record('Reading Photoresistor')) for _ in range(2000)))
+
+    threads = [threading.Thread(target=log) for _ in range(8)]
+    switch = sys.getswitchinterval()
+    # Switch threads as often as possible, also in the middle of filter()
+    sys.setswitchinterval(1e-6)
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(switch)
+    assert sum(passed) == 4000
+    (window, count, dropped), = limit._seen.values()
+    assert (count, dropped) == (4000, 12000)
+
+
+def test_queue_handler_is_bounded_and_filtered():
+    records = deque()
+    handler = _QueueHandler(records, limit=3)
+    handler.addFilter(RateLimit(burst=4))
+    for i in range(5):
+        handler.handle(record('Sample %d', i))
+    for _ in range(5):
+        handler.handle(record('Repeated'))
+    assert [r.getMessage() for r in records] == ['Sample 0', 'Sample 1', 'Sample 2']
+    assert handler.dropped == 6 # 2 samples and 4 repeats over the limit, 1 repeat filtered
+
+
+def test_writer_drains_by_handler_level():
+    records = deque([record('debug', level=logging.DEBUG), record('warning', level=logging.WARNING)])
+    out = io.StringIO()
+    handler = logging.StreamHandler(out)
+    handler.setLevel(logging.INFO)
+    Writer(records, [handler]).drain()
+    assert out.getvalue() == 'warning\n'
+    assert not records
+
+
+def test_configure_writes_rotating_json_lines(tmp_path, lamp_logger):
+    path = str(tmp_path / 'lamp.log')
+    out = io.StringIO()
+    configure(path, levels='info,weather=warning', stream=out, max_bytes=2000, backups=2)
+    log = get_logger('control')
+    for i in range(60):
+        log.info('Reading Photoresistor %d', i)
+    get_logger('weather').info('Not shown')
+    lamp_logging.shutdown()
+    assert os.path.exists(path + '.1') and os.path.exists(path + '.2')
+    assert not os.path.exists(path + '.3')
+    with open(path, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert entries[-1]['msg'] == 'Reading Photoresistor 59'
+    assert entries[-1]['logger'] == 'lamp.control'
+    assert 'Reading Photoresistor 0' in out.getvalue()
+    assert 'Not shown' not in out.getvalue()
+
+
+def test_repeats_are_reported_when_they_pass_again(lamp_logger):
+    out = io.StringIO()
+    writer = configure(levels='info', stream=out, burst=1)
+    limit = lamp_logger.handlers[0].filters[0]
+    log = get_logger('weather')
+    for _ in range(4):
+        log.warning('No data found for: %r', 'rain')
+    limit.clock = lambda: float('inf')
+    log.warning('No data found for: %r', 'rain')
+    writer.stop()
+    assert out.getvalue().count('No data found') == 2
+    assert '(3 repeats suppressed)' in out.getvalue()
+
+
+def test_parse_levels():
+    assert parse_levels('info,weather=debug') == {'': 'INFO', 'weather': 'DEBUG'}
+    with pytest.raises(ValueError):
+        parse_levels('lamp=debug')
+    with pytest.raises(ValueError):
+        parse_levels('loud')
@@ -0,0 +1,80 @@
+from http.client import HTTPConnection
+
+from metrics import Registry, start_server
+
+
+def test_counter_with_help_and_type():
+    registry = Registry()
+    runs = registry.counter('lamp_job_runs_total', 'Scheduled job runs', ('job',))
+    runs.labels('alarms').inc()
+    runs.labels('brightness').inc(3)
+    plain = registry.counter('lamp_samples_dropped_total', 'Samples dropped')
+    plain.inc()
+    assert registry.render() == (
+        '# HELP lamp_job_runs_total Scheduled job runs\n'
+        '# TYPE lamp_job_runs_total counter\n'
+        'lamp_job_runs_total{job="alarms"} 1\n'
+        'lamp_job_runs_total{job="brightness"} 3\n'
+        '# HELP lamp_samples_dropped_total Samples dropped\n'
+        '# TYPE lamp_samples_dropped_total counter\n'
+        'lamp_samples_dropped_total 1\n')
+
+
+def test_label_values_and_help_are_escaped():
+    registry = Registry()
+    gauge = registry.gauge('lamp_port', 'Serial port\\name\nin use', ('port', 'note'))
+    gauge.labels('C:\\COM3', 'say "hi"\nbye').set(1)
+    assert registry.render().splitlines() == [
+        '# HELP lamp_port Serial port\\\\name\\nin use',
+        '# TYPE lamp_port gauge',
+        'lamp_port{port="C:\\\\COM3",note="say \\"hi\\"\\nbye"} 1']
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram('lamp_fetch_seconds', 'Fetch latency', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value)
+    assert registry.render().splitlines() == [
+        '# HELP lamp_fetch_seconds Fetch latency',
+        '# TYPE lamp_fetch_seconds histogram',
+        'lamp_fetch_seconds_bucket{le="0.1"} 2', # upper bounds are inclusive
+        'lamp_fetch_seconds_bucket{le="1.0"} 3',
+        'lamp_fetch_seconds_bucket{le="+Inf"} 4',
+        'lamp_fetch_seconds_sum 3.65',
+        'lamp_fetch_seconds_count 4']
+
+
+def test_labelled_histogram_keeps_le_last():
+    registry = Registry()
+    jobs = registry.histogram('lamp_job_seconds', 'Job time', ('job',), buckets=(1,))
+    jobs.labels('weather').observe(2)
+    assert registry.render().splitlines()[2:] == [
+        'lamp_job_seconds_bucket{job="weather",le="1.0"} 0',
+        'lamp_job_seconds_bucket{job="weather",le="+Inf"} 1',
+        'lamp_job_seconds_sum{job="weather"} 2.0',
+        'lamp_job_seconds_count{job="weather"} 1']
+
+
+def test_registering_twice_returns_the_same_metric():
+    registry = Registry()
+    assert registry.counter('lamp_x_total', 'x') is registry.counter('lamp_x_total', 'x')
+
+
+def test_scrape():
+    registry = Registry()
+    registry.counter('lamp_x_total', 'x').inc()
+    server = start_server(port=0, registry=registry)
+    try:
+        conn = HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader('Content-Type').startswith('text/plain; version=0.0.4')
+        assert response.read().decode('utf-8') == registry.render()
+        conn.request('GET', '/other')
+        assert conn.getresponse().status == 404
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+
+from alarm_schedule import AlarmSchedule
+from hal import DigitalOutput, MockBackend, PWMOutput
+import lamp_control
+from runtime import AsyncLamp, ticks
+from scheduler import LOOP_ITERATIONS, SystemClock
+from serial_reader import RingBuffer
+
+
+class Weather:
+    """ WeatherProvider stand-in recording the threads fetches run on """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.threads = []
+
+    def get(self, max_age=None):
+        self.threads.append(threading.current_thread())
+        time.sleep(self.delay)
+        return self.cached()
+
+    def cached(self):
+        return {'main': {'feels_like': 290.0}, 'clouds': {'all': 40}, 'weather': [{'description': 'x'}],
+                'sys': {'sunrise': 0, 'sunset': 0}}
+
+
+class Uploader:
+    """ ThingSpeakUploader stand-in whose flush takes ``delay`` seconds """
+
+    def __init__(self, pending=0, delay=0):
+        self.pending = pending
+        self.delay = delay
+        self.drains = 0
+        self.flushes = 0
+        self.running = 0
+        self.overlaps = 0
+
+    def drain(self):
+        self.drains += 1
+        return self.pending
+
+    def flush(self):
+        self.flushes += 1
+        self.running += 1
+        self.overlaps += self.running > 1
+        time.sleep(self.delay)
+        self.running -= 1
+        return True
+
+    def submit(self, fields, created_at=None):
+        pass
+
+
+class History:
+    def append(self, name, value, t=None):
+        pass
+
+
+def make_lamp(**parts):
+    gpio = MockBackend()
+    lamp = dict(clock=SystemClock(), reader=RingBuffer(), weather=Weather(), ramp=0,
+                adjust_interval=0.01, pwm=PWMOutput(gpio, 12), leds=DigitalOutput(gpio, [38, 40]),
+                uploader=Uploader(), alarms=AlarmSchedule([]), history=History())
+    lamp.update(parts)
+    return lamp_control.new_lamp(**lamp)
+
+
+def run_for(runtime, seconds):
+    async def timed():
+        try:
+            await asyncio.wait_for(runtime.run(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(timed())
+
+
+def test_loop_passes_are_counted():
+    before = LOOP_ITERATIONS.value
+    runtime = AsyncLamp(make_lamp(), periods={'upload': (0.05, 0)})
+    run_for(runtime, 0.3)
+    assert runtime.decisions > 5
+    assert LOOP_ITERATIONS.value - before > runtime.decisions # control and upload passes
+
+
+def test_weather_is_only_fetched_off_the_loop():
+    lamp = make_lamp()
+    runtime = AsyncLamp(lamp, periods={'weather': (0.1, 0)})
+    run_for(runtime, 0.35)
+    assert lamp['weather'].threads
+    assert threading.main_thread() not in lamp['weather'].threads
+    assert lamp['leds'].levels == [1, 0] # 290 K is cold
+
+
+def test_timed_out_weather_uses_the_cached_answer():
+    lamp = make_lamp(weather=Weather(delay=0.5))
+    runtime = AsyncLamp(lamp, periods={'weather': (0.1, 0)}, weather_timeout=0.05)
+    run_for(runtime, 0.2)
+    assert lamp['weather'].threads
+    assert threading.main_thread() not in lamp['weather'].threads
+    assert lamp['leds'].levels == [1, 0]
+
+
+def tick_times(period, seconds, busy=0.0):
+    async def collect():
+        loop = asyncio.get_running_loop()
+        times = []
+
+        async def tick():
+            async for _ in ticks(SystemClock(), period):
+                times.append(loop.time())
+                time.sleep(busy) # a job blocking the loop
+        try:
+            await asyncio.wait_for(tick(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return times
+    return asyncio.run(collect())
+
+
+def test_ticks_are_whole_periods_apart():
+    times = tick_times(0.05, 0.5)
+    assert len(times) >= 8
+    for a, b in zip(times, times[1:]):
+        assert abs((b - a) - 0.05) < 0.02
+
+
+def test_busy_ticks_skip_the_missed_periods():
+    times = tick_times(0.05, 0.6, busy=0.07)
+    assert len(times) >= 3
+    for a, b in zip(times, times[1:]):
+        # The next free deadline on the grid, not right after the last run
+        assert abs((b - a) - 0.1) < 0.02
+
+
+def test_a_hung_flush_is_not_overlapped():
+    uploader = Uploader(pending=1, delay=0.25)
+    runtime = AsyncLamp(make_lamp(uploader=uploader), periods={'upload': (0.05, 0)},
+                        upload_timeout=0.05, workers=4)
+    run_for(runtime, 0.6)
+    assert uploader.flushes >= 2
+    assert uploader.overlaps == 0
+    assert uploader.drains == uploader.flushes # no drain while one is sending
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from scheduler import FakeClock, Scheduler, SchedulerError, seconds_until
+
+
+def test_jobs_run_in_deadline_order():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+    scheduler.every(10, lambda: ran.append(('ten', clock.monotonic())), name='ten')
+    scheduler.every(3, lambda: ran.append(('three', clock.monotonic())), name='three')
+    scheduler.once(5, lambda: ran.append(('once', clock.monotonic())))
+    scheduler.run(until=10)
+    assert ran == [('three', 3), ('once', 5), ('three', 6), ('three', 9), ('ten', 10)]
+
+
+def test_periodic_job_keeps_its_phase_and_skips_missed_runs():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+
+    def slow():
+        ran.append(clock.monotonic())
+        if len(ran) == 1:
+            clock.advance(25) # Busy for two and a half periods, one late run then back in phase
+
+    scheduler.every(10, slow, delay=5)
+    scheduler.run(until=60)
+    assert ran == [5, 30, 35, 45, 55]
+
+
+def test_cancelled_job_does_not_run():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    ran = []
+    job = scheduler.every(1, lambda: ran.append(1))
+    scheduler.every(2, job.cancel, name='cancel', delay=2.5)
+    scheduler.run(until=10)
+    assert len(ran) == 2
+    assert [j.name for j in scheduler.jobs()] == ['cancel']
+
+
+def test_run_returns_when_nothing_is_left():
+    clock = FakeClock()
+    scheduler = Scheduler(clock)
+    scheduler.once(1, lambda: None)
+    scheduler.run()
+    assert clock.monotonic() == 1
+    assert scheduler.next_delay() is None
+
+
+def test_stop_from_a_job():
+    scheduler = Scheduler(FakeClock())
+    scheduler.every(1, scheduler.stop)
+    scheduler.run()
+    assert scheduler.clock.monotonic() == 1
+
+
+def test_interval_must_be_positive():
+    with pytest.raises(SchedulerError):
+        Scheduler(FakeClock()).every(0, lambda: None)
+
+
+def test_seconds_until_local_wall_time():
+    wall = time.mktime((2024, 3, 4, 12, 10, 30, 0, 0, -1))
+    clock = FakeClock(wall=wall)
+    assert seconds_until(clock, 60) == 30
+    assert seconds_until(clock, 60, 1) == 31
+    assert seconds_until(clock, 1800, 18 * 60) == 7 * 60 + 30
+    assert seconds_until(clock, 180) == 90
@@ -0,0 +1,96 @@
+import queue
+import time
+
+import pytest
+
+from firmware import AdaptiveSampling
+from serial_reader import RingBuffer, SerialReader
+
+
+class FakeSerial:
+    """ serial.Serial stand-in, readline() returns the lines put in ``lines`` """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.written = b''
+
+    def reset_input_buffer(self):
+        pass
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=0.05)
+        except queue.Empty:
+            return b''
+
+    def write(self, data):
+        self.written += data
+
+    def close(self):
+        pass
+
+
+def reader(handshake=2.0):
+    lines = queue.Queue()
+    port = FakeSerial(lines)
+    r = SerialReader(['fake'], serial_factory=lambda *args, **kwargs: port, handshake=handshake,
+                     retry_delay=0.01)
+    return r, lines, port
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(size=3)
+    for i in range(5):
+        buffer.append(float(i), timestamp=i)
+    assert buffer.window() == [2.0, 3.0, 4.0]
+    assert buffer.window(max_age=1.5, now=4) == [3.0, 4.0]
+    assert buffer.since(3) == ([3.0, 4.0], 5)
+    assert buffer.latest() == 4.0
+
+
+def test_lines_before_the_firmware_answer_are_scaled_not_dropped():
+    r, lines, port = reader()
+    r.start()
+    try:
+        assert r.connected.wait(5)
+        assert port.written.startswith(b'?\n')
+        lines.put(b'400\r\n')
+        lines.put(b'402\r\n')
+        time.sleep(0.2)
+        assert len(r.buffer) == 0 and not r.identified.is_set()
+        lines.put(b'#cfg v=2 o=250 i=4 m=0 c=1\r\n')
+        lines.put(b'404\r\n')
+        assert wait_for(lambda: len(r.buffer) == 3)
+        assert r.identified.is_set()
+        assert r.window() == [200.0, 201.0, 202.0]
+    finally:
+        r.stop(timeout=2)
+
+
+def test_first_sketch_lines_are_released_after_the_handshake():
+    r, lines, port = reader(handshake=0.3)
+    r.start()
+    try:
+        assert r.connected.wait(5)
+        lines.put(b'300\r\n')
+        assert wait_for(r.identified.is_set)
+        assert r.firmware is None
+        lines.put(b'310\r\n')
+        assert wait_for(lambda: len(r.buffer) == 2)
+        assert r.window() == [300.0, 310.0]
+        # Held back readings keep the time they arrived
+        assert r.window(max_age=0.25) == [310.0]
+    finally:
+        r.stop(timeout=2)
+
+
+def test_adaptive_sampling_needs_text_replies():
+    with pytest.raises(ValueError):
+        SerialReader(['fake'], protocol='binary', sampling=AdaptiveSampling())
@@ -0,0 +1,45 @@
+import time
+
+from simulate import Trace, simulate
+
+# Monday 10:00 local, daytime so the sensor drives the lamp
+START = time.mktime((2024, 3, 4, 10, 0, 0, 0, 0, -1))
+
+
+def level_at(history, t):
+    level = None
+    for when, value in history:
+        if when > t:
+            break
+        level = value
+    return level
+
+
+def test_darkness_raises_the_duty():
+    # An hour each of daylight, dusk and a dark room, in volts
+    traces = {'light': Trace([START, START + 3600, START + 7200], [2.5, 1.2, 0.2])}
+    gpio = simulate(traces, 3, start=START)
+    duties = [level_at(gpio.history[12], START + hour * 3600 + 3500) for hour in range(3)]
+    assert duties[0] == 0
+    assert 40 < duties[1] < 60
+    assert duties[2] == 100
+    assert [duty for _, duty in gpio.history[12]] == sorted(duty for _, duty in gpio.history[12])
+
+
+def test_alarm_turns_the_light_on_in_daylight():
+    traces = {'light': Trace([START, START + 60], [2.5, 2.5])}
+    gpio = simulate(traces, 1, alarms=[[10, 20, 0]], start=START)
+    assert level_at(gpio.history[12], START + 15 * 60) == 0
+    for minute in range(20, 30):
+        assert level_at(gpio.history[12], START + minute * 60 + 30) == 100, minute
+    assert level_at(gpio.history[12], START + 45 * 60) == 0 # back to the sensor
+
+
+def test_leds_follow_the_temperature_trace():
+    traces = {'light': Trace([START, START + 60], [2.5, 2.5]),
+              'temperature': Trace([START, START + 1800, START + 3600], [15.0, 35.0, 35.0])}
+    gpio = simulate(traces, 1, start=START)
+    # Weather is read at :18 and :48
+    leds = [(level_at(gpio.history[38], t), level_at(gpio.history[40], t))
+            for t in (START + 20 * 60, START + 50 * 60)]
+    assert leds == [(1, 0), (1, 1)] # cold, then hot
@@ -0,0 +1,31 @@
+import importlib.util
+import os
+import time
+
+from alarm_store import write_snapshot
+from scheduler import FakeClock
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SmartLamp_ver.Final.py')
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('smartlamp', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_main_returns_after_run_for(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # 12:20 local, the first weather job (:48) is after the run
+    wall = time.mktime((2024, 3, 4, 12, 20, 0, 0, 0, -1))
+    day = time.localtime(wall).tm_wday
+    write_snapshot(str(tmp_path / 'Alarms.csv'), [[12, 25, day]])
+
+    lamp = load_script().main(clock=FakeClock(wall=wall), backend='mock', interactive=False,
+                              metrics_port=0, api_port=0, ports=[], run_for=600)
+
+    assert lamp['clock'].time() - wall == 600
+    assert lamp['active_flag'] == 1 # the 12:25 alarm is on for 10 minutes
+    assert lamp['pwm'].duty == 100
+    assert os.path.exists(tmp_path / 'lamp_state.json')
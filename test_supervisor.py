@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+from hal import MockBackend, PWMOutput
+import lamp_control
+from supervisor import StateFile, Supervisor, WorkerThread, restore
+
+
+class Worker:
+    """ Handle of a fake component, dead once ``alive`` is False """
+
+    def __init__(self):
+        self.alive = True
+        self.stopped = False
+
+    def is_alive(self):
+        return self.alive
+
+    def stop(self, timeout=None):
+        self.stopped = True
+        self.alive = False
+
+
+class Starts:
+    """ start callable counting the workers it made """
+
+    def __init__(self):
+        self.workers = []
+
+    def __call__(self):
+        self.workers.append(Worker())
+        return self.workers[-1]
+
+
+def _started(thread):
+    thread.start()
+    return thread
+
+
+def lamp():
+    return lamp_control.new_lamp(pwm=PWMOutput(MockBackend(), 12))
+
+
+def test_dead_thread_is_restarted():
+    runs = []
+    supervisor = Supervisor(interval=0.02, backoff=(0.01, 0.02))
+    # The thread returns at once, as after an uncaught error
+    supervisor.add('serial', lambda: _started(WorkerThread(lambda: runs.append(1), 'serial')))
+    worker = threading.Thread(target=supervisor.run)
+    worker.start()
+    deadline = time.monotonic() + 5
+    while len(runs) < 3 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    supervisor.stop()
+    worker.join(1)
+    assert len(runs) >= 3
+
+
+def test_stale_heartbeat_restarts_the_worker():
+    start = Starts()
+    beat = [time.monotonic()]
+    supervisor = Supervisor(backoff=(0.5, 30))
+    supervisor.add('serial', start, heartbeat=lambda: beat[0], timeout=30)
+    now = time.monotonic()
+    supervisor.check(now + 10)
+    assert len(start.workers) == 1
+    supervisor.check(now + 40)
+    assert start.workers[0].stopped
+    supervisor.check(now + 40.6)
+    assert len(start.workers) == 2
+
+
+def test_backoff_doubles_and_resets_once_stable():
+    start = Starts()
+    supervisor = Supervisor(backoff=(0.5, 3), stable=0.1)
+    supervisor.add('control', start)
+    worker = supervisor.workers['control']
+    now = time.monotonic()
+    delays = []
+    for _ in range(5):
+        worker.handle.alive = False
+        supervisor.check(now)
+        delays.append(worker.restart_at - now)
+        now = worker.restart_at
+        supervisor.check(now)
+    assert delays == [0.5, 1, 2, 3, 3]
+    assert worker.failures == 5
+    time.sleep(0.15)
+    supervisor.check(time.monotonic())
+    assert worker.failures == 0
+
+
+def test_state_is_restored_after_save(tmp_path):
+    state = StateFile(str(tmp_path / 'lamp_state.json'))
+    old = lamp()
+    old['light_flag'] = 1
+    old['average_voltage'] = 321
+    old['light_filter'].reset(250)
+    old['brightness'].duty = 42.5
+    Supervisor(old, state).save()
+    new = lamp()
+    restore(new, state.load())
+    assert new['light_flag'] == 1
+    assert new['average_voltage'] == 321
+    assert new['light_filter'].estimate == 250
+    assert new['brightness'].duty == 42.5
+
+
+def test_steady_state_stays_valid(tmp_path):
+    state = StateFile(str(tmp_path / 'lamp_state.json'), touch_every=0)
+    state.save({'light_flag': 1})
+    hour_ago = time.time() - 3700
+    os.utime(state.path, (hour_ago, hour_ago))
+    assert state.load() == {}
+    # Unchanged for over an hour, the touch keeps it fresh
+    state.save({'light_flag': 1})
+    assert state.load()['light_flag'] == 1
+
+
+def test_unchanged_state_is_touched_at_most_every_few_seconds(tmp_path):
+    state = StateFile(str(tmp_path / 'lamp_state.json'), touch_every=60)
+    state.save({'light_flag': 1})
+    earlier = time.time() - 10
+    os.utime(state.path, (earlier, earlier))
+    state.save({'light_flag': 1})
+    assert os.path.getmtime(state.path) == earlier
+    state.save({'light_flag': 0})
+    assert os.path.getmtime(state.path) > earlier
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from tuning import TuningError, optimize
+
+GRID = {'arduino_lb': np.array([0, 100]),
+        'arduino_ub': np.array([400, 600]),
+        'low': np.array([20, 40]),
+        'high': np.array([60, 80]),
+        'deadband': np.array([2, 5])}
+
+
+def test_series_with_dark_and_bright_spells_has_a_winner():
+    levels = 300 + 250 * np.sin(np.arange(2000) / 100)
+    hours = np.full(2000, 12)
+    config = optimize(levels, hours, grid=GRID)
+    assert config['candidates'] == 32
+    assert config['arduino_lb'] in (0, 100)
+    assert set(config['cost']) == {'energy', 'switches', 'discomfort', 'total'}
+
+
+def test_comfortable_series_has_no_winner():
+    # The room never needs the lamp, every candidate keeps it off at no cost
+    levels = np.full(100, 330.0)
+    hours = np.full(100, 14)
+    with pytest.raises(TuningError):
+        optimize(levels, hours, grid=GRID)
+
+
+def test_no_readings():
+    with pytest.raises(TuningError):
+        optimize(np.array([]), np.array([]), grid=GRID)
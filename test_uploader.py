@@ -0,0 +1,125 @@
+import json
+import threading
+
+import requests
+
+from uploader import MAX_BATCH, ThingSpeakUploader
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Session:
+    """ requests.Session stand-in, answers ``status`` or raises when offline """
+
+    def __init__(self, status=202):
+        self.status = status
+        self.offline = False
+        self.posts = []
+        self.release = None
+        self.posting = threading.Event()
+
+    def post(self, url, json=None, timeout=None):
+        self.posts.append(json['updates'])
+        self.posting.set()
+        if self.release is not None:
+            self.release.wait(5) # a hung request
+        if self.offline:
+            raise requests.ConnectionError('offline')
+        return Response(self.status)
+
+
+def journal_rows(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def uploader(session, journal, **options):
+    return ThingSpeakUploader(1, 'key', journal=str(journal), session=session, coalesce=0, **options)
+
+
+def test_readings_taken_together_are_merged(tmp_path):
+    session = Session()
+    up = ThingSpeakUploader(1, 'key', session=session, coalesce=1)
+    up.submit({'field5': 1.0}, created_at=100)
+    up.submit({'field1': 20}, created_at=100.5)
+    up.submit({'field5': 2.0}, created_at=200)
+    assert up.drain() == 2
+    assert up.flush()
+    assert [sorted(u) for u in session.posts[0]] == [['created_at', 'field1', 'field5'],
+                                                      ['created_at', 'field5']]
+
+
+def test_failed_readings_are_journaled_and_replayed(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    session = Session()
+    session.offline = True
+    up = uploader(session, journal)
+    for i in range(3):
+        up.submit({'field5': i}, created_at=100 + 10 * i)
+    up.drain()
+    assert not up.flush()
+    assert not up.flush() # journaled once, not per attempt
+    assert [row['field5'] for row in journal_rows(journal)] == [0, 1, 2]
+
+    session.offline = False
+    again = uploader(session, journal)
+    assert len(again.pending) == 3
+    assert again.flush()
+    assert not journal.exists()
+    assert again.sent == 3
+
+
+def test_partial_send_rewrites_the_journal(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    session = Session()
+    session.offline = True
+    up = uploader(session, journal)
+    for i in range(MAX_BATCH + 5):
+        up.submit({'field5': i}, created_at=i * 10)
+    up.drain()
+    up.flush()
+    session.offline = False
+    assert up.flush()
+    assert [row['field5'] for row in journal_rows(journal)] == list(range(MAX_BATCH, MAX_BATCH + 5))
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    journal.write_text('{"created_at":"2024-01-01T00:00:00Z","_t":1,"field5":1}\n{"created_at":"20')
+    assert len(uploader(Session(), journal).pending) == 1
+
+
+def test_stop_journals_what_is_queued(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    up = uploader(Session(), journal)
+    up.submit({'field5': 1}, created_at=100)
+    up.stop()
+    assert [row['field5'] for row in journal_rows(journal)] == [1]
+
+
+def test_replaced_hung_uploader_leaves_the_journal_alone(tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    hung_session = Session()
+    hung_session.release = threading.Event()
+    hung = uploader(hung_session, journal)
+    hung.start()
+    hung.submit({'field5': 1}, created_at=100)
+    assert hung_session.posting.wait(5)
+    hung.stop(timeout=0.1) # still in its request
+    assert hung.is_alive()
+
+    session = Session()
+    session.offline = True
+    new = uploader(session, journal)
+    assert len(new.pending) == 1
+    new.submit({'field5': 2}, created_at=200)
+    new.drain()
+    new.flush()
+
+    # The old request succeeds late, it must not rewrite the new journal
+    hung_session.release.set()
+    hung.join(5)
+    assert [row['field5'] for row in journal_rows(journal)] == [1, 2]
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+from weather import WeatherProvider
+
+GEO_URL = 'http://geo.test/json/'
+WEATHER_URL = 'http://weather.test/data/2.5/weather'
+SUNNY = {'clouds': {'all': 0}, 'main': {'temp': 293.0}}
+
+
+def response(status, body=None, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = b'' if body is None else json.dumps(body).encode('utf-8')
+    r.headers.update(headers or {})
+    r.url = WEATHER_URL
+    return r
+
+
+class Session:
+    """ Answers the geolocation lookup, then whatever ``answer`` is set to """
+
+    def __init__(self, answer=None, delay=0):
+        self.answer = answer or response(200, SUNNY)
+        self.delay = delay
+        self.calls = []
+
+    def get(self, url, timeout=None, headers=None, params=None):
+        self.calls.append((url, headers))
+        if url == GEO_URL:
+            return response(200, {'lat': '52.52', 'lon': '13.40'})
+        time.sleep(self.delay)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+    def fetches(self):
+        return [headers for url, headers in self.calls if url == WEATHER_URL]
+
+
+def provider(tmp_path, session, **options):
+    return WeatherProvider('key', str(tmp_path), session=session,
+                           geo_url=GEO_URL, weather_url=WEATHER_URL, **options)
+
+
+def test_fresh_answer_is_served_from_cache(tmp_path):
+    session = Session()
+    weather = provider(tmp_path, session)
+    assert weather.get() == SUNNY
+    assert weather.get() == SUNNY
+    assert len(session.fetches()) == 1
+    assert (weather.hits, weather.misses) == (1, 1)
+
+
+def test_concurrent_callers_share_one_fetch(tmp_path):
+    session = Session(delay=0.2)
+    weather = provider(tmp_path, session)
+    start = threading.Barrier(5)
+    results = []
+
+    def caller():
+        start.wait()
+        results.append(weather.get())
+
+    threads = [threading.Thread(target=caller) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [SUNNY] * 5
+    assert len(session.fetches()) == 1
+
+
+def test_not_modified_keeps_the_cached_body(tmp_path):
+    session = Session(response(200, SUNNY, {'ETag': '"abc"',
+                                            'Last-Modified': 'Mon, 18 May 2020 10:00:00 GMT'}))
+    weather = provider(tmp_path, session)
+    weather.get()
+    weather._cache['fetched'] -= 3600
+    session.answer = response(304)
+    assert weather.get() == SUNNY
+    assert session.fetches()[-1] == {'If-None-Match': '"abc"',
+                                     'If-Modified-Since': 'Mon, 18 May 2020 10:00:00 GMT'}
+    assert weather.age() < 60
+
+
+def test_stale_answer_when_the_api_fails(tmp_path):
+    session = Session()
+    weather = provider(tmp_path, session)
+    weather.get()
+    session.answer = response(500)
+    assert weather.get(max_age=0) == SUNNY
+    session.answer = requests.Timeout('read timed out')
+    assert weather.get(max_age=0) == SUNNY
+    assert weather.errors == 2
+
+
+def test_nothing_cached_and_the_api_down(tmp_path):
+    weather = provider(tmp_path, Session(requests.ConnectionError('refused')))
+    assert weather.get() is None
+    assert weather.errors == 1
+
+
+def test_location_and_weather_survive_a_restart(tmp_path):
+    weather = provider(tmp_path, Session())
+    weather.get()
+    assert os.path.exists(weather.location_file)
+    session = Session()
+    again = provider(tmp_path, session)
+    assert again.cached() == SUNNY
+    assert again.location() == (52.52, 13.40)
+    again.get(max_age=0)
+    assert [url for url, headers in session.calls] == [WEATHER_URL]
@@ -0,0 +1,92 @@
+import json
+import math
+
+import numpy as np
+import pytest
+
+from hal import MockBackend, PWMOutput
+from zones import SampleBuffer, ZoneConfigError, ZoneFusion, ZoneSet, load_zones, parse_row, room_level
+
+NAN = float('nan')
+ZONES = [{'channels': [0, 1, 2]}, {'channels': [2, 3], 'weights': [3, 1]}]
+
+
+def test_median_ignores_one_outlier():
+    fusion = ZoneFusion(ZONES, 4)
+    levels = fusion.fuse([[100, 110, 900, 300], [100, 120, 130, 300]])
+    assert levels[:, 0].tolist() == [110, 120]
+    assert levels[:, 1].tolist() == [600, 215] # two sensors, their mean
+
+
+def test_weighted_mean():
+    fusion = ZoneFusion(ZONES, 4, method='weighted')
+    levels = fusion.fuse([[100, 200, 300, 500]])
+    assert levels[0].tolist() == [200, (3 * 300 + 500) / 4]
+
+
+@pytest.mark.parametrize('method', ['median', 'weighted'])
+def test_broken_sensors_are_left_out(method):
+    fusion = ZoneFusion(ZONES, 4, method=method)
+    levels = fusion.fuse([[100, NAN, 2000, -5], [NAN, NAN, NAN, NAN]])
+    assert levels[0, 0] == 100
+    assert math.isnan(levels[0, 1]) # both sensors of zone 1 are out of range
+    assert np.isnan(levels[1]).all()
+
+
+def test_fusion_matches_row_by_row():
+    rng = np.random.default_rng(1)
+    samples = rng.uniform(0, 1023, (50, 4))
+    samples[rng.random((50, 4)) < 0.2] = NAN
+    fused = ZoneFusion(ZONES, 4).fuse(samples)
+    for row, levels in zip(samples, fused):
+        for zone, level in zip(ZONES, levels):
+            values = [row[c] for c in zone['channels'] if not math.isnan(row[c])]
+            if values:
+                assert level == pytest.approx(float(np.median(values)))
+            else:
+                assert math.isnan(level)
+
+
+def test_parse_row():
+    row = parse_row(b'1.5,2 1 3,x', 4)
+    assert row[:2] == [1.5, 2.0]
+    assert math.isnan(row[2]) and math.isnan(row[3])
+    assert parse_row(b'garbage', 2) is None
+
+
+def test_sample_buffer_rows_and_room_level():
+    buffer = SampleBuffer(2, size=3)
+    for i in range(5):
+        buffer.append([i, 10 * i], timestamp=i)
+    assert buffer.rows().tolist() == [[2, 20], [3, 30], [4, 40]]
+    rows, total = buffer.since_rows(3)
+    assert rows.tolist() == [[3, 30], [4, 40]] and total == 5
+    assert buffer.window() == [11, 16.5, 22]
+    assert buffer.latest() == 22
+    assert room_level(np.array([[NAN, 5000]])).tolist() == []
+
+
+def test_zone_set_feeds_each_zone(tmp_path):
+    path = tmp_path / 'zones.json'
+    path.write_text(json.dumps({'channels': 2, 'zones': [{'name': 'desk', 'channels': [0], 'pwm_pin': 12},
+                                                         {'name': 'sofa', 'channels': [1], 'pwm_pin': 33}]}))
+    config = load_zones(str(path))
+    gpio = MockBackend()
+    zones = ZoneSet(config, [PWMOutput(gpio, 12), PWMOutput(gpio, 33)])
+    zones.update(np.array([[100, NAN], [100, NAN]]))
+    assert zones[0].light_filter.estimate is not None
+    assert zones[1].light_filter.estimate is None
+
+
+@pytest.mark.parametrize('config', [
+    {'channels': 7, 'zones': [{'name': 'a', 'channels': [0], 'pwm_pin': 12}]},
+    {'channels': 2, 'zones': [{'name': 'a', 'channels': [2], 'pwm_pin': 12}]},
+    {'channels': 2, 'zones': [{'name': 'a', 'channels': [0], 'pwm_pin': 12},
+                              {'name': 'b', 'channels': [1], 'pwm_pin': 12}]},
+    {'channels': 2, 'zones': [{'name': 'a', 'channels': [0, 1], 'weights': [1], 'pwm_pin': 12}]},
+    {'channels': 2, 'zones': []}])
+def test_bad_configs_are_rejected(tmp_path, config):
+    path = tmp_path / 'zones.json'
+    path.write_text(json.dumps(config))
+    with pytest.raises(ZoneConfigError):
+        load_zones(str(path))
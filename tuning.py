@@ -0,0 +1,162 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from analytics import load_export
+from channel_cache import ChannelCache
+
+# Candidate grid, every combination with low < high and lb < ub is tried
+GRID = {'arduino_lb': np.arange(0, 201, 25),
+        'arduino_ub': np.arange(300, 1001, 100),
+        'low': np.arange(10, 51, 5),
+        'high': np.arange(50, 91, 5),
+        'deadband': np.array([2, 5, 10])}
+
+# Sensor reading (sketch units) the lamp adds at full duty, and the band of
+# readings the room should stay in while someone may be awake
+LAMP_LEVEL = 150
+COMFORT = (200, 400)
+WEIGHTS = {'energy': 1.0, 'switches': 0.5, 'discomfort': 2.0}
+# Share of the grid tied at the best cost above which there is no winner
+PLATEAU = 0.01
+
+
+class TuningError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def candidates(grid=GRID):
+    """ Valid parameter combinations as a dict of equal length arrays """
+    names = list(grid)
+    rows = [combo for combo in itertools.product(*(grid[n] for n in names))
+            if combo[names.index('low')] < combo[names.index('high')]
+            and combo[names.index('arduino_lb')] < combo[names.index('arduino_ub')]]
+    table = np.array(rows, dtype=np.float64)
+    return {name: table[:, i] for i, name in enumerate(names)}
+
+
+def evaluate(levels, hours, params, lamp_level=LAMP_LEVEL, comfort=COMFORT, block=4096):
+    """ Energy, switches and discomfort of every candidate over a series.
+
+        ``levels`` are photoresistor readings in sketch units and ``hours``
+        their local hour. Targets of all candidates come from one
+        broadcast per block of samples; the deadband hold is sequential in
+        time but runs on all candidates at once.
+
+        Returns a dict of arrays with one value per candidate: mean duty
+        (0-1), duty changes per day and the fraction of awake samples
+        outside ``comfort``.
+    """
+    lb = params['arduino_lb'][:, None]
+    scale = 100 / (params['arduino_ub'] - params['arduino_lb'])[:, None]
+    low = params['low'][:, None]
+    high = params['high'][:, None]
+    deadband = params['deadband']
+    n = len(lb)
+    duty = np.full(n, np.nan)
+    energy = np.zeros(n)
+    switches = np.zeros(n)
+    outside = np.zeros(n)
+    awake_total = 0
+
+    for start in range(0, len(levels), block):
+        level = levels[start:start + block][None, :]
+        night = (hours[start:start + block] == 23) | (hours[start:start + block] < 6)
+        mapped = (level - lb) * scale
+        target = np.clip(np.round(100 * (high - mapped) / (high - low), 1), 0, 100)
+        target[:, night] = 0
+        held = np.empty_like(target)
+        for j in range(target.shape[1]):
+            # BrightnessControl.update() for every candidate at once
+            t = target[:, j]
+            move = (np.isnan(duty) | (np.abs(t - duty) >= deadband)
+                    | (((t == 0) | (t == 100)) & (t != duty)))
+            switches += move & ~np.isnan(duty) & (t != duty)
+            duty = np.where(move, t, duty)
+            held[:, j] = duty
+        energy += held.sum(axis=1)
+        room = level + lamp_level * held / 100
+        awake = ~night
+        outside += ((room < comfort[0]) | (room > comfort[1]))[:, awake].sum(axis=1)
+        awake_total += awake.sum()
+
+    days = max(len(levels) / 480, 1 / 24) # a reading every 3 minutes
+    return {'energy': energy / len(levels) / 100, 'switches': switches / days,
+            'discomfort': outside / max(awake_total, 1)}
+
+
+def optimize(levels, hours, grid=GRID, weights=WEIGHTS, plateau=PLATEAU, **options):
+    """ Best candidate as a config dict, with its costs.
+
+        Raises TuningError when the series cannot tell the candidates
+        apart: no samples, or more than ``plateau`` of the grid tied at
+        the best cost (e.g. all zero when the room never needed the lamp),
+        where argmin would only return the first of them.
+    """
+    if len(levels) == 0:
+        raise TuningError("No photoresistor readings to tune on")
+    params = candidates(grid)
+    costs = evaluate(levels, hours, params, **options)
+    # Switches per day are scaled so ten of them weigh like full power all day
+    total = (weights['energy'] * costs['energy'] + weights['switches'] * costs['switches'] / 10
+             + weights['discomfort'] * costs['discomfort'])
+    best = int(np.argmin(total))
+    ties = int(np.count_nonzero(total <= total[best] + 1e-9))
+    if ties > max(plateau * len(total), 1):
+        raise TuningError("%d of %d candidates cost %.4f over %d samples, the series does not "
+                          "tell them apart; tune on a longer one with dark and bright spells"
+                          % (ties, len(total), total[best], len(levels)))
+    config = {name: int(values[best]) for name, values in params.items()}
+    config['cost'] = {name: round(float(values[best]), 4) for name, values in costs.items()}
+    config['cost']['total'] = round(float(total[best]), 4)
+    config['candidates'] = len(total)
+    return config
+
+
+def load_series(path, tz=None):
+    """ (levels, hours) from the field5 readings of a ThingSpeak export or
+        a channel_cache.py directory """
+    df = ChannelCache(path).frame(tz) if os.path.isdir(path) else load_export(path, tz)
+    light = df['light'].dropna()
+    # field5 is the reading scaled to volts, the controller works in sketch units
+    return light.to_numpy() * 1023 / 5, light.index.hour.to_numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune brightness thresholds and mapping bounds offline')
+    parser.add_argument('export', nargs='?', default='ThingSpeak_Data.json',
+                        help='channel export, or a channel_cache.py directory')
+    parser.add_argument('--out', default='lamp_config.json', help='config the lamp loads at startup')
+    parser.add_argument('--tz', help='timezone of the lamp, for the night hours')
+    parser.add_argument('--lamp-level', type=float, default=LAMP_LEVEL)
+    parser.add_argument('--comfort', type=float, nargs=2, default=COMFORT, metavar=('LOW', 'HIGH'))
+    for name, weight in WEIGHTS.items():
+        parser.add_argument('--w-' + name, type=float, default=weight, help='cost weight')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    levels, hours = load_series(args.export, args.tz)
+    weights = {name: getattr(args, 'w_' + name) for name in WEIGHTS}
+    try:
+        config = optimize(levels, hours, weights=weights, lamp_level=args.lamp_level,
+                          comfort=tuple(args.comfort))
+    except TuningError as e:
+        # Keep the config the lamp already has
+        sys.exit('No winner, %s not written: %s' % (args.out, e.data))
+    config['source'] = args.export
+    config['samples'] = len(levels)
+    config['generated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    print(json.dumps(config, indent=2))
+    print('%d candidates x %d samples in %.2f s' % (config['candidates'], len(levels),
+                                                    time.perf_counter() - started))
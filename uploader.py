@@ -0,0 +1,230 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import requests
+
+import metrics
+from lamp_logging import get_logger
+
+log = get_logger('upload')
+
+
+THINGSPEAK_URL = 'https://api.thingspeak.com'
+# ThingSpeak bulk updates accept at most 960 entries
+MAX_BATCH = 960
+
+
+UPLOAD_SECONDS = metrics.histogram('lamp_upload_seconds', 'ThingSpeak bulk update latency')
+UPLOAD_FAILURES = metrics.counter('lamp_upload_failures_total', 'Failed ThingSpeak bulk updates')
+UPLOAD_READINGS = metrics.counter('lamp_upload_readings_total', 'Readings accepted by ThingSpeak')
+UPLOAD_PENDING = metrics.gauge('lamp_upload_pending', 'Readings waiting to be uploaded')
+UPLOAD_DROPPED = metrics.counter('lamp_upload_dropped_total', 'Readings dropped from a full queue')
+
+
+class UploadError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def timestamp(t=None):
+    """ ThingSpeak created_at format, UTC """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+class ThingSpeakUploader(threading.Thread):
+    """ Background ThingSpeak writer.
+
+        submit() only puts the reading on a queue. The worker thread merges
+        readings taken within ``coalesce`` seconds of each other, sends the
+        pending ones in one bulk update every ``interval`` seconds and
+        appends them to an on-disk journal when the channel can't be reached.
+        Journaled readings are loaded again at start and replayed. After
+        stop() the journal belongs to whoever opens it next, a worker
+        still stuck in a request leaves it alone when it comes back.
+
+        :param url: base url, point it at a local server for tests
+        :param journal: path of the append-only JSON lines journal, None
+            keeps failed readings in memory only
+        :param queue_size: bound of the submit queue, the oldest reading is
+            dropped when it is full, 0 is unbounded
+    """
+
+    def __init__(self, channel_id, api_key, journal=None, url=THINGSPEAK_URL,
+                 interval=15, coalesce=1, timeout=10, session=None, queue_size=0):
+        super().__init__(name='thingspeak-uploader', daemon=True)
+        self.endpoint = '%s/channels/%s/bulk_update.json' % (url.rstrip('/'), channel_id)
+        self.api_key = api_key
+        self.journal = journal
+        self.interval = interval
+        self.coalesce = coalesce
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.queue = queue.Queue(queue_size)
+        self.pending = []
+        self.sent = 0
+        self.failures = 0
+        self.dropped = 0
+        self._journaled = 0
+        self._next_send = 0
+        self._streak = 0
+        self._stop_event = threading.Event()
+        # pending and the journal, shared by the worker and stop()
+        self._lock = threading.RLock()
+        self._released = False
+        self._load_journal()
+
+    def submit(self, fields, created_at=None):
+        """ Queue a reading ({'field1': ..., 'field5': ...}), never blocks """
+        if created_at is None:
+            created_at = time.time()
+        while True:
+            try:
+                self.queue.put_nowait((created_at, dict(fields)))
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                UPLOAD_DROPPED.inc()
+            except queue.Empty:
+                pass
+
+    def _load_journal(self):
+        if self.journal is None or not os.path.exists(self.journal):
+            return
+        with open(self.journal, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line after a power cut
+                    continue
+                self.pending.append(entry)
+        self._journaled = len(self.pending)
+        if self.pending:
+            log.info('Replaying %d journaled readings', len(self.pending))
+
+    def _append_journal(self, entries):
+        if self.journal is None or self._released or not entries:
+            return
+        with open(self.journal, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self, entries):
+        if self.journal is None or self._released:
+            return
+        if not entries:
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+            return
+        tmp = self.journal + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal)
+
+    def _add(self, created_at, fields):
+        if self.pending:
+            last = self.pending[-1]
+            # Photoresistor and weather readings taken together become one entry
+            if (len(self.pending) > self._journaled
+                    and abs(created_at - last['_t']) <= self.coalesce):
+                last.update(fields)
+                return
+        entry = {'created_at': timestamp(created_at), '_t': created_at}
+        entry.update(fields)
+        self.pending.append(entry)
+
+    def payload(self, entries):
+        updates = [{k: v for k, v in entry.items() if k != '_t'} for entry in entries]
+        return {'write_api_key': self.api_key, 'updates': updates}
+
+    def flush(self):
+        """ Send up to MAX_BATCH pending readings in one bulk update.
+            Returns True on success """
+        if not self.pending:
+            return True
+        batch = self.pending[:MAX_BATCH]
+        try:
+            with UPLOAD_SECONDS.time():
+                r = self.session.post(self.endpoint, json=self.payload(batch), timeout=self.timeout)
+            if r.status_code not in (200, 202):
+                raise UploadError("ThingSpeak answered %s" % r.status_code)
+        except (requests.RequestException, UploadError) as e:
+            self.failures += 1
+            UPLOAD_FAILURES.inc()
+            log.warning('connection failed: %s', e)
+            with self._lock:
+                UPLOAD_PENDING.set(len(self.pending))
+                self._append_journal(self.pending[self._journaled:])
+                self._journaled = len(self.pending)
+            return False
+
+        with self._lock:
+            del self.pending[:len(batch)]
+            self.sent += len(batch)
+            UPLOAD_READINGS.inc(len(batch))
+            UPLOAD_PENDING.set(len(self.pending))
+            if self._journaled:
+                self._journaled = max(self._journaled - len(batch), 0)
+                self._rewrite_journal(self.pending[:self._journaled])
+        return True
+
+    def run(self):
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            if self.pending and now >= self._next_send:
+                ok = self.flush()
+                self._streak = 0 if ok else self._streak + 1
+                # Bulk updates share the channel rate limit, back off while offline
+                self._next_send = time.monotonic() + self.interval * min(2 ** self._streak, 16)
+                continue
+            wait = self._next_send - now if self.pending else 1
+            try:
+                created_at, fields = self.queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+            with self._lock:
+                if not self.pending:
+                    # Hold the first reading briefly so readings taken together merge
+                    self._next_send = max(self._next_send, time.monotonic() + self.coalesce)
+                self._add(created_at, fields)
+
+    def drain(self):
+        """ Move queued readings to pending without blocking, for callers
+            driving flush() themselves instead of starting the thread """
+        with self._lock:
+            while True:
+                try:
+                    self._add(*self.queue.get_nowait())
+                except queue.Empty:
+                    return len(self.pending)
+
+    def stop(self, timeout=None):
+        """ Stop the worker and journal whatever could not be sent.
+
+            A worker still stuck in a request after ``timeout`` is left
+            behind without the journal, a new uploader can load it right
+            away. Readings it was sending are journaled too, they may be
+            uploaded twice but are never lost.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        with self._lock:
+            self.drain()
+            self._append_journal(self.pending[self._journaled:])
+            self._journaled = len(self.pending)
+            self._released = True
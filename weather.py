@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+import metrics
+from lamp_logging import get_logger
+
+log = get_logger('weather')
+
+
+GEO_URL = 'https://extreme-ip-lookup.com/json/'
+WEATHER_URL = 'http://api.openweathermap.org/data/2.5/weather'
+
+
+WEATHER_SECONDS = metrics.histogram('lamp_weather_fetch_seconds', 'Weather API fetch latency')
+WEATHER_REQUESTS = metrics.counter('lamp_weather_requests_total', 'Weather lookups by cache result',
+                                   ('result',))
+WEATHER_HIT = WEATHER_REQUESTS.labels('hit')
+WEATHER_MISS = WEATHER_REQUESTS.labels('miss')
+WEATHER_STALE = WEATHER_REQUESTS.labels('stale')
+
+
+class WeatherError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def _load(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class WeatherProvider:
+    """ Cached OpenWeatherMap client.
+
+        The geolocation and the last weather answer are kept on disk, so a
+        restart reuses them instead of doing three round trips. Only one
+        fetch runs at a time, callers arriving meanwhile wait for its
+        result, and when the API fails the last known weather is returned.
+
+        :param cache_dir: directory for location.json and weather.json
+        :param ttl: seconds a weather answer is served without refetching
+        :param geo_ttl: seconds the ip geolocation is trusted
+    """
+
+    def __init__(self, api_key, cache_dir, ttl=600, geo_ttl=7 * 24 * 3600,
+                 timeout=5, session=None, geo_url=GEO_URL, weather_url=WEATHER_URL):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.geo_ttl = geo_ttl
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.geo_url = geo_url
+        self.weather_url = weather_url
+        self.location_file = os.path.join(cache_dir, 'location.json')
+        self.weather_file = os.path.join(cache_dir, 'weather.json')
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._location = _load(self.location_file)
+        self._cache = _load(self.weather_file)
+        self._lock = threading.Lock()
+        self._inflight = None
+
+    def location(self):
+        """ (lat, lon) of this lamp from its public ip, cached on disk """
+        loc = self._location
+        if loc is not None and time.time() - loc.get('fetched', 0) < self.geo_ttl:
+            return loc['lat'], loc['lon']
+        try:
+            r = self.session.get(self.geo_url, timeout=self.timeout)
+            r.raise_for_status()
+            data = r.json()
+            loc = {'lat': float(data.get('lat')), 'lon': float(data.get('lon')),
+                   'fetched': time.time()}
+        except (requests.RequestException, ValueError, TypeError) as e:
+            if self._location is not None:
+                # An old location is still far better than none
+                return self._location['lat'], self._location['lon']
+            raise WeatherError("Location lookup failed: %s" % e)
+        self._location = loc
+        _save(self.location_file, loc)
+        return loc['lat'], loc['lon']
+
+    def age(self):
+        """ Seconds since the cached weather was fetched, None without cache """
+        if self._cache is None:
+            return None
+        return time.time() - self._cache['fetched']
+
+    def cached(self):
+        return None if self._cache is None else self._cache['data']
+
+    def get(self, max_age=None):
+        """ OpenWeatherMap json for the current location.
+
+            Served from cache when younger than ``max_age`` (default ttl),
+            otherwise fetched once for all concurrent callers. Returns the
+            stale answer if fetching fails and None if there is nothing.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        age = self.age()
+        if age is not None and age < max_age:
+            self.hits += 1
+            WEATHER_HIT.inc()
+            return self._cache['data']
+
+        with self._lock:
+            inflight = self._inflight
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight = threading.Event()
+        if not leader:
+            inflight.wait(self.timeout * 3)
+            return self.cached()
+
+        self.misses += 1
+        WEATHER_MISS.inc()
+        try:
+            with WEATHER_SECONDS.time():
+                self._fetch()
+        except (requests.RequestException, WeatherError, ValueError) as e:
+            self.errors += 1
+            WEATHER_STALE.inc()
+            log.warning('Weather fetch failed, using cached data: %s', e)
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+        return self.cached()
+
+    def _fetch(self):
+        lat, lon = self.location()
+        headers = {}
+        if self._cache is not None:
+            # Conditional request, a 304 costs no body
+            if self._cache.get('etag'):
+                headers['If-None-Match'] = self._cache['etag']
+            if self._cache.get('last_modified'):
+                headers['If-Modified-Since'] = self._cache['last_modified']
+        r = self.session.get(self.weather_url, timeout=self.timeout, headers=headers,
+                             params={'lat': lat, 'lon': lon, 'appid': self.api_key})
+        if r.status_code == 304 and self._cache is not None:
+            cache = dict(self._cache, fetched=time.time())
+        else:
+            r.raise_for_status()
+            cache = {'data': r.json(), 'fetched': time.time(),
+                     'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified')}
+        self._cache = cache
+        _save(self.weather_file, cache)
@@ -0,0 +1,269 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from light_filter import BrightnessControl, LightFilter
+
+# Analog pins A0-A5 of an Uno, the most photoresistors one sketch reports
+MAX_CHANNELS = 6
+# Readings outside the ADC range (scaled like the sketch prints them) are
+# from an unplugged or shorted sensor
+VALID_RANGE = (0, 1023)
+
+
+class ZoneConfigError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
+
+
+def load_zones(path):
+    """ Zone config, JSON:
+
+        {"channels": 4, "method": "median",
+         "zones": [{"name": "desk", "channels": [0, 1], "pwm_pin": 12},
+                   {"name": "sofa", "channels": [2, 3], "weights": [2, 1],
+                    "pwm_pin": 33}]}
+
+        ``channels`` is the number of sensors the sketch reports (CHANNELS),
+        zone channels index them from 0 (A0).
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    channels = config.get('channels')
+    if not isinstance(channels, int) or not 1 <= channels <= MAX_CHANNELS:
+        raise ZoneConfigError('channels must be 1 to %d, not %r' % (MAX_CHANNELS, channels))
+    if config.get('method', 'median') not in ('median', 'weighted'):
+        raise ZoneConfigError('Unknown fusion method %r' % config['method'])
+    names, pins = set(), set()
+    for zone in config.get('zones', []):
+        for key in ('name', 'channels', 'pwm_pin'):
+            if key not in zone:
+                raise ZoneConfigError('Zone %r has no %r' % (zone.get('name'), key))
+        if zone['name'] in names or zone['pwm_pin'] in pins:
+            raise ZoneConfigError('Zone %r repeats a name or pwm pin' % zone['name'])
+        names.add(zone['name'])
+        pins.add(zone['pwm_pin'])
+        if not zone['channels'] or not all(0 <= c < channels for c in zone['channels']):
+            raise ZoneConfigError('Zone %r reads channels outside 0-%d' % (zone['name'], channels - 1))
+        if len(zone.get('weights', zone['channels'])) != len(zone['channels']):
+            raise ZoneConfigError('Zone %r needs one weight per channel' % zone['name'])
+    if not names:
+        raise ZoneConfigError('No zones in %s' % path)
+    return config
+
+
+def parse_row(line, channels):
+    """ One comma separated line of the sketch, NaN for missing or garbled
+        values. None when nothing in it parses """
+    row = [float('nan')] * channels
+    parsed = False
+    for i, field in enumerate(line.split(b',')[:channels]):
+        try:
+            # 'mean min max' of a MINMAX report, the mean is the reading
+            row[i] = float(field.split(None, 1)[0])
+            parsed = True
+        except (ValueError, IndexError):
+            pass
+    return row if parsed else None
+
+
+class SampleBuffer:
+    """ Fixed size ring buffer of sample rows, one column per sensor.
+
+        rows() and since_rows() return 2-D arrays for the fusion stage.
+        window(), since() and latest() give the mean over the sensors so
+        code written for one sensor (RingBuffer) reads the room level.
+    """
+
+    def __init__(self, channels, size=64):
+        self.size = size
+        self.channels = channels
+        self.values = np.zeros((size, channels))
+        self.times = np.zeros(size)
+        self.index = 0
+        self.count = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def append(self, row, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            self.values[self.index] = row
+            self.times[self.index] = timestamp
+            self.index = (self.index + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+            self.total += 1
+
+    def __len__(self):
+        return self.count
+
+    def _last(self, n):
+        # Indices of the latest n rows, oldest first
+        return np.arange(self.index - n, self.index) % self.size
+
+    def rows(self, n=None, max_age=None, now=None):
+        """ Latest ``n`` rows, oldest first, only the ones newer than
+            ``max_age`` seconds when given """
+        with self._lock:
+            if n is None or n > self.count:
+                n = self.count
+            last = self._last(n)
+            values = self.values[last]
+            times = self.times[last]
+        if max_age is not None:
+            if now is None:
+                now = time.monotonic()
+            values = values[now - times <= max_age]
+        return values
+
+    def since_rows(self, seen):
+        """ Rows appended after the first ``seen`` ones and the new total """
+        with self._lock:
+            total = self.total
+            n = min(total - seen, self.count)
+            if n <= 0:
+                return np.empty((0, self.channels)), total
+            return self.values[self._last(n)], total
+
+    def window(self, n=None, max_age=None, now=None):
+        return room_level(self.rows(n, max_age, now)).tolist()
+
+    def since(self, seen):
+        rows, total = self.since_rows(seen)
+        return room_level(rows).tolist(), total
+
+    def latest(self):
+        with self._lock:
+            if self.count == 0:
+                return None
+            row = self.values[self.index - 1]
+        level = room_level(row[None, :])
+        return float(level[0]) if len(level) else None
+
+    def clear(self):
+        with self._lock:
+            self.index = 0
+            self.count = 0
+
+
+def _valid(samples):
+    return (samples >= VALID_RANGE[0]) & (samples <= VALID_RANGE[1])
+
+
+def room_level(samples):
+    """ Mean of the working sensors per row, rows without one are dropped """
+    valid = _valid(samples)
+    counts = valid.sum(axis=1)
+    sums = np.where(valid, samples, 0).sum(axis=1)
+    keep = counts > 0
+    return sums[keep] / counts[keep]
+
+
+class ZoneFusion:
+    """ Light level per zone from rows of sensor samples.
+
+        'weighted' is the weighted mean of the working sensors of a zone,
+        one matrix product for all rows and zones. 'median' sorts the
+        zone's readings of every row at once, a sensor in direct sun or
+        shadow does not pull the zone level. Sensors out of VALID_RANGE or
+        missing from a row are left out, a zone with none left is NaN.
+
+        :param zones: list of {'channels': [...], 'weights': [...]}
+    """
+
+    def __init__(self, zones, channels, method='median'):
+        if method not in ('median', 'weighted'):
+            raise ZoneConfigError('Unknown fusion method %r' % method)
+        self.method = method
+        self.channels = channels
+        self.weights = np.zeros((channels, len(zones)))
+        for z, zone in enumerate(zones):
+            for channel, weight in zip(zone['channels'], zone.get('weights', [1] * len(zone['channels']))):
+                self.weights[channel, z] = weight
+        self.members = self.weights.T > 0 # zones x channels
+
+    def fuse(self, samples):
+        """ (rows, channels) samples -> (rows, zones) levels """
+        samples = np.asarray(samples, dtype=np.float64)
+        valid = _valid(samples)
+        if self.method == 'weighted':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(valid, samples, 0) @ self.weights / (valid @ self.weights)
+        # rows x zones x channels, NaN where a sensor is not used, sorted last
+        grid = np.where(self.members & valid[:, None, :], samples[:, None, :], np.nan)
+        grid.sort(axis=2)
+        k = np.sum(~np.isnan(grid), axis=2, keepdims=True)
+        lo = np.take_along_axis(grid, np.maximum(k - 1, 0) // 2, axis=2)
+        hi = np.take_along_axis(grid, k // 2, axis=2)
+        return np.where(k > 0, (lo + hi) / 2, np.nan)[:, :, 0]
+
+
+class Zone:
+    """ One zone's filter, brightness curve and PWM output """
+
+    __slots__ = ('name', 'pwm', 'light_filter', 'brightness')
+
+    def __init__(self, name, pwm, brightness, light_filter=None):
+        self.name = name
+        self.pwm = pwm
+        self.brightness = brightness
+        self.light_filter = light_filter or LightFilter()
+
+
+class ZoneSet(list):
+    """ The zones of a lamp and the fusion stage feeding their filters """
+
+    def __init__(self, config, outputs, brightness=None):
+        b = brightness or BrightnessControl()
+        super().__init__(
+            Zone(zone['name'], output,
+                 BrightnessControl(b.arduino_lb, b.arduino_ub, b.low, b.high, b.deadband))
+            for zone, output in zip(config['zones'], outputs))
+        self.fusion = ZoneFusion(config['zones'], config['channels'], config.get('method', 'median'))
+
+    def update(self, rows):
+        """ Fuse new sample rows and feed every zone's filter """
+        if not len(rows):
+            return
+        for zone, levels in zip(self, self.fusion.fuse(rows).T):
+            for level in levels.tolist():
+                if level == level: # NaN when none of its sensors work
+                    zone.light_filter.update(level)
+
+
+def benchmark(batch=20, number=2000):
+    """ µs per fused batch of ``batch`` rows as the sensor count grows,
+        against fusing row by row in Python """
+    import statistics
+    import timeit
+
+    rng = np.random.default_rng(0)
+    print('%8s %6s %14s %14s %14s' % ('channels', 'zones', 'median us', 'weighted us', 'python us'))
+    for channels in (1, 2, 4, 6, 16, 64):
+        zone_count = max(channels // 2, 1)
+        zones = [{'channels': list(range(z, channels, zone_count))} for z in range(zone_count)]
+        samples = rng.normal(300, 20, (batch, channels))
+        samples[::7, 0] = 5000 # a shorted sensor now and then
+        median, weighted = ZoneFusion(zones, channels), ZoneFusion(zones, channels, 'weighted')
+
+        def python():
+            for row in samples.tolist():
+                for zone in zones:
+                    values = sorted(row[c] for c in zone['channels'] if 0 <= row[c] <= 1023)
+                    if values:
+                        statistics.median(values)
+
+        times = [min(timeit.repeat(func, number=number // 10, repeat=5)) / (number // 10) * 1e6
+                 for func in (lambda: median.fuse(samples), lambda: weighted.fuse(samples), python)]
+        print('%8d %6d %14.1f %14.1f %14.1f' % ((channels, zone_count) + tuple(times)))
+
+
+if __name__ == '__main__':
+    benchmark()